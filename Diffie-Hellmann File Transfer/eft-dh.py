@@ -4,12 +4,34 @@ import socket
 import sys
 import hashlib
 import os
+import stat
 import struct
-from cryptography.hazmat.primitives.asymmetric import dh
+import queue
+import threading
+import time
+import asyncio
+import itertools
+import functools
+import json
+import shutil
+import tempfile
+import contextlib
+import fcntl
+from concurrent.futures import ThreadPoolExecutor
+from cryptography.hazmat.primitives.asymmetric import dh, x25519
+from cryptography.hazmat.primitives.serialization import Encoding, PublicFormat
 from cryptography.hazmat.primitives.ciphers.aead import AESGCM
+from cryptography.exceptions import InvalidTag
 from cryptography.hazmat.primitives.kdf.hkdf import HKDF
 from cryptography.hazmat.primitives import hashes
 
+from transfer_core import (BatchReader, BatchWriter, CODEC_NAMES, CODEC_ZLIB, DURABILITY_LEVELS, FRAME_LENGTH_MASK,
+                           Manifest, OutputFile, RESUME_RETRIES, RESUME_RETRY_DELAY, STATS, SegmentCipher, TAG_SIZE,
+                           available_codecs, chunk_nonce, choose_codec, compress_chunk, decompress_chunk,
+                           dh_exchange, enable_stats, frame_buffer, ordered_pipeline, read_chunks, read_file_list,
+                           receive_resumable, recv_chunks, recv_chunks_async, recv_exact, recv_frame, send_frame,
+                           send_parts, send_resumable)
+
 # DH parameters
 g = 2
 p = int(
@@ -22,12 +44,208 @@ p = int(
 param_numbers = dh.DHParameterNumbers(p, g)
 dh_parameters = param_numbers.parameters()
 
+# Versioned framing. The server opens every connection with its key in the
+# legacy decimal form, which legacy clients wait for and current clients
+# skip. A current client's first bytes are EDH_MAGIC; a legacy client's
+# are the digits of its own key, which is how the server tells them apart.
+EDH_MAGIC = b'EDH2'
+PROTOCOL_VERSION = 4
+DECIMAL_KEY_VERSION = 2
+BINARY_KEY_VERSION = 3
+DEFAULT_MAX_FRAME_SIZE = 1 << 20
+MIN_FRAME_SIZE = 1024
+LEGACY_KEY_SIZE = 384
+
+# Key agreements offered by a version 3 hello. Public keys travel as
+# fixed-width binary: big-endian y for the finite-field group, raw bytes for
+# X25519. Version 2 hellos and legacy clients use the 384-digit decimal form.
+KEX_FFDH = 1
+KEX_X25519 = 2
+KEX_RESUME = 3
+KEX_NAMES = {'ffdh': KEX_FFDH, 'x25519': KEX_X25519}
+KEY_SIZES = {KEX_FFDH: (p.bit_length() + 7) // 8, KEX_X25519: 32}
+
+# Version 4 hellos (and the server's reply) end with a block of
+# type/length/value extensions. The server echoes the ones it accepts.
+EXT_STRIPE = 1
+STRIPE_EXT = struct.Struct('>16sHH')  # transfer id, stream index, stream count
+CHUNK_OFFSET = struct.Struct('>Q')
+OUTPUT_PATH = "decrypted_output.txt"
+EXT_TICKET = 2
+RANDOM_SIZE = 32
+TICKET_LIFETIME = 3600
+TICKET_AAD = b'eft-dh ticket'
+EXT_BATCH = 3
+EXT_RESUMABLE = 4
+EXT_COMPRESS = 5
+EXT_SIZE = 6
+SIZE_EXT = struct.Struct('>Q')
+STRIPE_BACKLOG = 64
+DAEMON_BACKLOG = 1024
+DAEMON_KEY_POOL = 16
+MAX_PREALLOC_MB = 4096
+READ_TIMEOUT = 60
+
+class KeyPool:
+    """Ephemeral DH private keys generated ahead of time on a background thread.
+
+    Each key is handed out exactly once. If the pool is empty (or sized 0) a
+    fresh key is generated inline, so a burst of connections never waits on
+    the refill thread.
+    """
+
+    def __init__(self, size: int, generate=None):
+        self._generate = generate or (lambda: generate_key(KEX_FFDH))
+        self._keys = queue.Queue(maxsize=size)
+        if size > 0:
+            threading.Thread(target=self._fill, daemon=True).start()
+
+    def _fill(self):
+        while True:
+            self._keys.put(self._generate())
+
+    def take(self):
+        try:
+            return self._keys.get_nowait()
+        except queue.Empty:
+            return self._generate()
+
+def exchange(private_key, peer_public_key) -> bytes:
+    # Finite-field peers are kept as their public value; see dh_exchange.
+    with STATS.phase('exchange'):
+        if isinstance(peer_public_key, int):
+            return dh_exchange(private_key, peer_public_key)
+        return private_key.exchange(peer_public_key)
+
 def derive_key(shared_key: bytes) -> bytes:
-    shared_int = int.from_bytes(shared_key, 'big')
-    hex_string = '%x' % shared_int
-    digest = hashlib.sha256(hex_string.encode('utf-8')).digest()
+    with STATS.phase('kdf'):
+        shared_int = int.from_bytes(shared_key, 'big')
+        hex_string = '%x' % shared_int
+        digest = hashlib.sha256(hex_string.encode('utf-8')).digest()
     return digest[:32]
 
+def hkdf(secret: bytes, info: bytes, salt=None) -> bytes:
+    with STATS.phase('kdf'):
+        return HKDF(algorithm=hashes.SHA256(), length=32, salt=salt, info=info).derive(secret)
+
+def agree(private_key, peer_public_key) -> bytes:
+    return derive_key(exchange(private_key, peer_public_key))
+
+def resumption_secret(session_key: bytes) -> bytes:
+    return hkdf(session_key, b'eft-dh resumption')
+
+def resumed_session_key(secret: bytes, client_random: bytes, server_random: bytes) -> bytes:
+    return hkdf(secret, b'eft-dh resumed session', salt=bytes(client_random) + bytes(server_random))
+
+class TicketRejected(Exception):
+    pass
+
+class TicketKeeper:
+    """Seals resumption secrets into tickets that only this server can open.
+
+    A ticket is a random nonce followed by AES-GCM over the issue time and
+    the secret, so the server keeps no per-client state. Tickets expire
+    after `lifetime` seconds.
+    """
+
+    def __init__(self, key: bytes, lifetime: int = TICKET_LIFETIME):
+        self._aesgcm = AESGCM(key)
+        self.lifetime = lifetime
+
+    @classmethod
+    def from_file(cls, path, lifetime: int = TICKET_LIFETIME):
+        # Persisting the ticket key lets tickets survive server restarts,
+        # which matters for the one-shot server.
+        try:
+            with open(path, 'rb') as f:
+                key = f.read()
+        except FileNotFoundError:
+            key = AESGCM.generate_key(bit_length=256)
+            fd = os.open(path, os.O_WRONLY | os.O_CREAT | os.O_EXCL, 0o600)
+            with os.fdopen(fd, 'wb') as f:
+                f.write(key)
+        return cls(key, lifetime)
+
+    def issue(self, secret: bytes) -> bytes:
+        nonce = os.urandom(12)
+        sealed = self._aesgcm.encrypt(nonce, struct.pack('>Q', int(time.time())) + secret, TICKET_AAD)
+        return struct.pack('>I', self.lifetime) + nonce + sealed
+
+    def redeem(self, ticket: bytes):
+        try:
+            plain = self._aesgcm.decrypt(ticket[:12], ticket[12:], TICKET_AAD)
+        except (InvalidTag, ValueError):
+            return None
+        issued = struct.unpack('>Q', plain[:8])[0]
+        if not 0 <= time.time() - issued <= self.lifetime:
+            return None
+        return plain[8:]
+
+class TicketCache:
+    """Client-side store of (ticket, resumption secret) per server.
+
+    The file holds secrets, so it is created readable by the owner only.
+    Clients sharing a cache (say, several cron jobs) take an exclusive
+    flock on PATH.lock for each read-modify-write, so no ticket is handed
+    out twice or lost, and each writes its own temporary file before
+    renaming it into place.
+    """
+
+    def __init__(self, path):
+        self.path = path
+
+    @contextlib.contextmanager
+    def _locked(self):
+        fd = os.open(self.path + '.lock', os.O_RDWR | os.O_CREAT, 0o600)
+        try:
+            fcntl.flock(fd, fcntl.LOCK_EX)
+            yield
+        finally:
+            os.close(fd)
+
+    def _load(self) -> dict:
+        try:
+            with open(self.path) as f:
+                return json.load(f)
+        except (FileNotFoundError, ValueError):
+            return {}
+
+    def _save(self, entries: dict):
+        # mkstemp creates the file readable by the owner only.
+        fd, tmp = tempfile.mkstemp(dir=os.path.dirname(os.path.abspath(self.path)),
+                                   prefix=os.path.basename(self.path) + '.', suffix='.tmp')
+        try:
+            with os.fdopen(fd, 'w') as f:
+                json.dump(entries, f)
+            os.replace(tmp, self.path)
+        except BaseException:
+            os.unlink(tmp)
+            raise
+
+    def take(self, server: str):
+        """Remove and return (ticket, secret) for server, or None."""
+        with self._locked():
+            entries = self._load()
+            entry = entries.pop(server, None)
+            if entry is None:
+                return None
+            self._save(entries)
+        if entry['expires'] < time.time():
+            return None
+        return bytes.fromhex(entry['ticket']), bytes.fromhex(entry['secret'])
+
+    def put(self, server: str, ticket_ext: bytes, session_key: bytes):
+        lifetime = struct.unpack('>I', ticket_ext[:4])[0]
+        entry = {
+            'ticket': ticket_ext[4:].hex(),
+            'secret': resumption_secret(session_key).hex(),
+            'expires': time.time() + lifetime,
+        }
+        with self._locked():
+            entries = self._load()
+            entries[server] = entry
+            self._save(entries)
+
 def int_to_padded_decimal_string(value: int, length: int = 384) -> str:
     dec_str = str(value)
     return dec_str.zfill(length)
@@ -35,138 +253,770 @@ def int_to_padded_decimal_string(value: int, length: int = 384) -> str:
 def padded_decimal_string_to_int(padded_str: str) -> int:
     return int(padded_str, 10)
 
-def encrypt_and_send_stdin(conn, session_key):
-    plaintext = sys.stdin.buffer.read()
-    nonce = os.urandom(16)
-    aesgcm = AESGCM(session_key)
-    ciphertext = aesgcm.encrypt(nonce, plaintext, None)
-    length = 16 + len(ciphertext)  
-    length_bytes = struct.pack('>H', length)
-    segment = length_bytes + nonce + ciphertext
-    conn.sendall(segment)
-    
-
-
-def receive_and_decrypt_file(conn, session_key):
-    length_bytes = conn.recv(2)
-    if len(length_bytes) < 2:
-        raise ValueError("Failed to receive length field")
-
-    length = struct.unpack('>H', length_bytes)[0]
-    data = b''
-    while len(data) < length:
-        chunk = conn.recv(length - len(data))
-        if not chunk:
-            raise ConnectionError("Connection closed prematurely!")
-        data += chunk
-
-    if len(data) < 16:
-        raise ValueError("Segment too short to contain nonce")
-
-    nonce = data[:16]
-    ciphertext = data[16:]
+def public_key_bytes(private_key) -> bytes:
+    pub_val_int = private_key.public_key().public_numbers().y
+    return int_to_padded_decimal_string(pub_val_int).encode('utf-8')
+
+def load_public_key(key_bytes: bytes) -> int:
+    key_str = key_bytes.decode('utf-8')
+    if len(key_str) != 384:
+        raise ValueError(f"Invalid public key length: {len(key_str)} (expected 384)")
+    return padded_decimal_string_to_int(key_str)
+
+def generate_key(kex: int):
+    # Keys made by a KeyPool refill thread are timed here too, even though
+    # they are off the handshake path.
+    with STATS.phase('keygen'):
+        if kex == KEX_X25519:
+            return x25519.X25519PrivateKey.generate()
+        return dh_parameters.generate_private_key()
+
+def encode_public_key(private_key, kex: int) -> bytes:
+    if kex == KEX_X25519:
+        return private_key.public_key().public_bytes(Encoding.Raw, PublicFormat.Raw)
+    return private_key.public_key().public_numbers().y.to_bytes(KEY_SIZES[KEX_FFDH], 'big')
+
+def decode_public_key(key_bytes: bytes, kex: int):
+    if kex == KEX_X25519:
+        return x25519.X25519PublicKey.from_public_bytes(bytes(key_bytes))
+    return int.from_bytes(key_bytes, 'big')
+
+def encode_extensions(extensions: dict) -> bytes:
+    body = b''.join(struct.pack('>BH', ext_type, len(value)) + value
+                    for ext_type, value in extensions.items())
+    return struct.pack('>H', len(body)) + body
+
+def recv_extensions(conn) -> dict:
+    return parse_extensions(recv_exact(conn, struct.unpack('>H', recv_exact(conn, 2))[0]))
+
+def parse_extensions(body) -> dict:
+    extensions = {}
+    offset = 0
+    while offset < len(body):
+        ext_type, length = struct.unpack_from('>BH', body, offset)
+        offset += 3
+        extensions[ext_type] = bytes(body[offset:offset + length])
+        offset += length
+    return extensions
+
+def negotiate_extensions(client_extensions: dict, allow_stripe: bool = True, allow_resume: bool = True) -> dict:
+    accepted = {}
+    if EXT_STRIPE in client_extensions and allow_stripe:
+        STRIPE_EXT.unpack(client_extensions[EXT_STRIPE])
+        accepted[EXT_STRIPE] = client_extensions[EXT_STRIPE]
+    if EXT_BATCH in client_extensions:
+        accepted[EXT_BATCH] = b''
+    if EXT_RESUMABLE in client_extensions and allow_resume:
+        accepted[EXT_RESUMABLE] = b''
+    if len(client_extensions.get(EXT_SIZE, b'')) == SIZE_EXT.size:
+        # Only a hint for preallocation; echoed so the caller can see it.
+        accepted[EXT_SIZE] = client_extensions[EXT_SIZE]
+    codec = choose_codec(client_extensions.get(EXT_COMPRESS, b''))
+    if codec is not None:
+        accepted[EXT_COMPRESS] = bytes([codec])
+    return accepted
+
+def negotiated_codec(extensions: dict):
+    return extensions[EXT_COMPRESS][0] if EXT_COMPRESS in extensions else None
+
+def size_hint(extensions: dict):
+    return SIZE_EXT.unpack(extensions[EXT_SIZE])[0] if EXT_SIZE in extensions else None
+
+def stdin_size():
+    """Bytes left on stdin when it is a regular file, otherwise None."""
+    fd = sys.stdin.buffer.fileno()
+    st = os.fstat(fd)
+    if not stat.S_ISREG(st.st_mode):
+        return None
+    return max(st.st_size - os.lseek(fd, 0, os.SEEK_CUR), 0)
+
+def encrypt_and_send_stdin(conn, session_key, max_frame=None, workers: int = 1, stdin=None, codec=None):
+    stdin = stdin or sys.stdin.buffer
+
+    if max_frame is None:
+        send_parts(conn, SegmentCipher(session_key).seal(stdin.read()))
+        return
+
     aesgcm = AESGCM(session_key)
 
-    try:
-        plaintext = aesgcm.decrypt(nonce, ciphertext, None)
-    except Exception as e:
-        raise ValueError(f"Decryption failed: {e}")
+    def seal(item):
+        counter, chunk, final = item
+        if codec is not None:
+            chunk = compress_chunk(codec, chunk)
+        with STATS.phase('encrypt'):
+            return aesgcm.encrypt(chunk_nonce(counter, final), chunk, None), final
 
-    file_path = "decrypted_output.txt" 
+    # With compression every chunk gains a codec byte, so read one less.
+    chunks = read_chunks(stdin, max_frame - TAG_SIZE - (codec is not None))
+    for ciphertext, final in ordered_pipeline(chunks, seal, workers):
+        send_frame(conn, ciphertext, final)
+
+def receive_chunks(conn, aesgcm, max_frame: int, out, workers: int = 1, codec=None):
+    def open_chunk(item):
+        counter, ciphertext, final = item
+        try:
+            with STATS.phase('decrypt'):
+                plaintext = aesgcm.decrypt(chunk_nonce(counter, final), ciphertext, None)
+        except Exception as e:
+            raise ValueError(f"Decryption failed on chunk {counter}: {e}")
+        return plaintext if codec is None else decompress_chunk(plaintext, max_frame)
+
+    total = 0
+    for plaintext in ordered_pipeline(recv_chunks(conn, max_frame), open_chunk, workers):
+        out.write(plaintext)
+        total += len(plaintext)
+    return total
+
+def write_output_file(receive, open_output=OutputFile, size=None):
+    """Call receive(f) with a fresh output file; returns the bytes written.
+
+    The data lands in a temporary file that replaces decrypted_output.txt
+    only once the whole transfer has authenticated, so a failed transfer
+    leaves any previous output untouched.
+    """
+    file_path = OUTPUT_PATH
+
+    try:
+        with open_output(file_path, size=size) as f:
+            written = receive(f)
+        print(f"[Server] Wrote {written} bytes to {file_path}", file=sys.stderr)
 
-    try:   
-        if os.path.exists(file_path):
-            try:
-                os.remove(file_path)
-            except Exception as e:
-                print(f"[Server] Could not delete existing file: {e}", file=sys.stderr)
-
-        with open(file_path, "wb") as f:
-            f.write(plaintext)
-            f.flush()
-            os.fsync(f.fileno())
-        print(f"[Server] Wrote {len(plaintext)} bytes to {file_path}", file=sys.stderr)
-        
     except Exception as e:
         print(f"[Server] Error writing to file {file_path}: {e}", file=sys.stderr)
         raise
 
     print("[Server] Decrypted data written to 'decrypted_output.txt'", file=sys.stderr)
+    return written
 
-def run_server(port):
-    HOST = '0.0.0.0'
+def receive_and_decrypt_file(conn, session_key, max_frame=None, workers: int = 1, codec=None,
+                             open_output=OutputFile, size=None):
+    aesgcm = AESGCM(session_key)
+
+    def receive(f):
+        if max_frame is not None:
+            return receive_chunks(conn, aesgcm, max_frame, f, workers, codec)
+        try:
+            plaintext = SegmentCipher(session_key).recv(conn)
+        except InvalidTag:
+            raise ValueError("Decryption failed: authentication tag mismatch")
+        f.write(plaintext)
+        return len(plaintext)
+
+    return write_output_file(receive, open_output, size)
+
+class SealedChannel:
+    """Whole messages over encrypted frames for the resumable protocol.
+
+    Each direction has its own key derived from the session key, so both
+    sides can count nonces from zero. A message may span several frames;
+    the final flag marks its last one.
+    """
+
+    def __init__(self, conn, session_key: bytes, max_frame: int, client: bool):
+        upload = AESGCM(hkdf(session_key, b'eft-dh resume upload'))
+        download = AESGCM(hkdf(session_key, b'eft-dh resume download'))
+        self.conn = conn
+        self.max_frame = max_frame
+        self.sealer, self.opener = (upload, download) if client else (download, upload)
+        self.sent = self.received = 0
+        self.buffer = None
+
+    def send(self, payload):
+        view = memoryview(payload)
+        chunk_size = self.max_frame - TAG_SIZE
+        offset = 0
+        while True:
+            chunk = view[offset:offset + chunk_size]
+            offset += chunk_size
+            final = offset >= len(view)
+            with STATS.phase('encrypt'):
+                ciphertext = self.sealer.encrypt(chunk_nonce(self.sent, final), chunk, None)
+            send_frame(self.conn, ciphertext, final)
+            self.sent += 1
+            if final:
+                return
+
+    def recv(self) -> bytes:
+        if self.buffer is None:
+            self.buffer = frame_buffer(self.max_frame)
+        parts = []
+        while True:
+            ciphertext, final = recv_frame(self.conn, self.max_frame, self.buffer)
+            try:
+                with STATS.phase('decrypt'):
+                    parts.append(self.opener.decrypt(chunk_nonce(self.received, final), ciphertext, None))
+            except InvalidTag:
+                raise ValueError(f"Decryption failed on resumable frame {self.received}")
+            self.received += 1
+            if final:
+                return b''.join(parts)
+
+def send_striped(streams, stdin, max_frame: int):
+    """Spread stdin over several (socket, session_key) streams.
+
+    Each stream pulls the next chunk from a shared reader, so faster
+    connections carry more of the file. Every frame is the chunk's file
+    offset followed by its ciphertext, with the offset bound in as AAD.
+    A stream ends with an empty final chunk once the input is exhausted.
+    """
+    chunk_size = max_frame - TAG_SIZE - CHUNK_OFFSET.size
+    lock = threading.Lock()
+    next_offset = 0
+
+    def read_next():
+        nonlocal next_offset
+        with lock:
+            chunk = stdin.read(chunk_size)
+            offset = next_offset
+            next_offset += len(chunk)
+        return offset, chunk
+
+    def pump(conn, session_key):
+        aesgcm = AESGCM(session_key)
+        counter = 0
+        while True:
+            offset, chunk = read_next()
+            final = not chunk
+            header = CHUNK_OFFSET.pack(offset)
+            with STATS.phase('encrypt'):
+                ciphertext = aesgcm.encrypt(chunk_nonce(counter, final), chunk, header)
+            send_frame(conn, header + ciphertext, final)
+            if final:
+                return
+            counter += 1
+
+    with ThreadPoolExecutor(max_workers=len(streams)) as pool:
+        list(pool.map(lambda stream: pump(*stream), streams))
 
-    private_key = dh_parameters.generate_private_key()
-    public_key = private_key.public_key()
-    pub_val_int = public_key.public_numbers().y
-    pub_val_str = int_to_padded_decimal_string(pub_val_int)
+def receive_striped(streams, max_frame: int, out, size=None) -> int:
+    """Decrypt every stream on its own thread and write each chunk at its offset.
+
+    Chunks go through out.write_at(), so the OutputFile's durability,
+    mapping and reservation apply to them as to a sequential write. The
+    chunks of all streams must tile the file from offset 0 exactly
+    once, and with size (the SIZE extension) they must end at size; a
+    chunk reaching past size is refused before it is written.
+    """
+    def drain(conn, session_key):
+        aesgcm = AESGCM(session_key)
+        counter = 0
+        chunks = []
+        buffer = frame_buffer(max_frame)
+        while True:
+            payload, final = recv_frame(conn, max_frame, buffer)
+            if len(payload) < CHUNK_OFFSET.size:
+                raise ValueError("Frame too short to contain an offset")
+            header = bytes(payload[:CHUNK_OFFSET.size])
+            offset = CHUNK_OFFSET.unpack(header)[0]
+            try:
+                with STATS.phase('decrypt'):
+                    plaintext = aesgcm.decrypt(chunk_nonce(counter, final), payload[CHUNK_OFFSET.size:], header)
+            except Exception as e:
+                raise ValueError(f"Decryption failed on chunk {counter}: {e}")
+            if plaintext:
+                if size is not None and offset + len(plaintext) > size:
+                    raise ValueError(f"Chunk at offset {offset} runs past the announced size of {size} bytes")
+                out.write_at(offset, plaintext)
+                chunks.append((offset, len(plaintext)))
+            if final:
+                return chunks
+            counter += 1
+
+    with ThreadPoolExecutor(max_workers=len(streams)) as pool:
+        results = list(pool.map(lambda stream: drain(*stream), streams))
+    end = 0
+    for offset, length in sorted(chunk for chunks in results for chunk in chunks):
+        if offset < end:
+            raise ValueError(f"Striped chunks overlap at offset {offset}")
+        if offset > end:
+            raise ValueError(f"Striped transfer is missing bytes {end} to {offset}")
+        end = offset + length
+    if size is not None and end != size:
+        raise ValueError(f"Striped transfer covered {end} of {size} bytes")
+    return end
+
+# The server handshake is written as a generator of I/O requests so the same
+# logic runs on a blocking socket (run_steps) and under asyncio
+# (run_steps_async). It yields (RECV, n) for exactly n bytes, (SEND, data),
+# and (CALL, fn) for key generation and agreement, which gives fn() and
+# runs off the event loop under asyncio.
+RECV, SEND, CALL = range(3)
+
+def server_handshake_steps(key_pool, max_frame_size: int, allow_stripe: bool = True, tickets=None,
+                           allow_resume: bool = True):
+    """Server side of the key exchange.
+
+    Returns (session_key, max_frame, extensions), where max_frame is None
+    for a legacy client (which sends one 16-bit frame) and extensions are
+    the ones the server accepted. The server's finite-field key goes out
+    first in the legacy form, and the client's first four bytes decide the
+    protocol: EDH_MAGIC, or the digits of a legacy client's key. A
+    finite-field handshake with a current client reuses the same key. A
+    client that asks for it gets a
+    resumption ticket; a client presenting a valid ticket skips the key
+    agreement entirely. Raises TicketRejected when a presented ticket is
+    invalid or expired, after telling the client so.
+    """
+    private_key = yield CALL, key_pool.take
+    yield SEND, public_key_bytes(private_key)
+    magic = yield RECV, len(EDH_MAGIC)
+    if magic != EDH_MAGIC:
+        if not magic.isdigit():
+            raise ValueError("Unrecognised client hello")
+        print("[Server] No client hello, using legacy protocol.", file=sys.stderr)
+        client_public_key = load_public_key(magic + (yield RECV, LEGACY_KEY_SIZE - len(magic)))
+        return (yield CALL, functools.partial(agree, private_key, client_public_key)), None, {}
+
+    version, client_max_frame = struct.unpack('>BI', (yield RECV, 5))
+    if client_max_frame < MIN_FRAME_SIZE:
+        raise ValueError(f"Client frame size {client_max_frame} is below {MIN_FRAME_SIZE}")
+    max_frame = min(client_max_frame, max_frame_size)
+
+    kex = None
+    if version == DECIMAL_KEY_VERSION:
+        client_public_key = load_public_key((yield RECV, LEGACY_KEY_SIZE))
+        server_key = public_key_bytes(private_key)
+    elif version in (BINARY_KEY_VERSION, PROTOCOL_VERSION):
+        kex = (yield RECV, 1)[0]
+        if kex == KEX_RESUME and version == PROTOCOL_VERSION:
+            client_random = yield RECV, RANDOM_SIZE
+            server_key = os.urandom(RANDOM_SIZE)
+        elif kex in KEY_SIZES:
+            client_public_key = decode_public_key((yield RECV, KEY_SIZES[kex]), kex)
+            if kex != KEX_FFDH:
+                private_key = yield CALL, functools.partial(generate_key, kex)
+            server_key = encode_public_key(private_key, kex)
+        else:
+            raise ValueError(f"Unsupported key agreement {kex}")
+    else:
+        raise ValueError(f"Unsupported protocol version {version}")
+
+    client_extensions = {}
+    if version >= PROTOCOL_VERSION:
+        length = struct.unpack('>H', (yield RECV, 2))[0]
+        client_extensions = parse_extensions((yield RECV, length))
+
+    reply = struct.pack('>BI', version, max_frame) + server_key
+    if kex == KEX_RESUME:
+        secret = tickets.redeem(client_extensions.get(EXT_TICKET, b'')) if tickets else None
+        if secret is None:
+            # No ticket extension in the reply tells the client to fall back
+            # to a full handshake on a new connection.
+            yield SEND, reply + encode_extensions({})
+            raise TicketRejected("Resumption ticket rejected")
+        session_key = resumed_session_key(secret, client_random, server_key)
+    else:
+        session_key = yield CALL, functools.partial(agree, private_key, client_public_key)
+
+    extensions = negotiate_extensions(client_extensions, allow_stripe, allow_resume)
+    if EXT_TICKET in client_extensions and tickets:
+        extensions[EXT_TICKET] = tickets.issue(resumption_secret(session_key))
+    if version >= PROTOCOL_VERSION:
+        reply += encode_extensions(extensions)
+    yield SEND, reply
+    return session_key, max_frame, extensions
+
+def run_steps(conn, steps):
+    request = next(steps)
+    while True:
+        op, arg = request
+        if op == RECV:
+            result = recv_exact(conn, arg)
+        elif op == CALL:
+            result = arg()
+        else:
+            conn.sendall(arg)
+            result = None
+        try:
+            request = steps.send(result)
+        except StopIteration as done:
+            return done.value
+
+async def read_exact(reader, length: int) -> bytes:
+    try:
+        return await asyncio.wait_for(reader.readexactly(length), READ_TIMEOUT)
+    except asyncio.IncompleteReadError:
+        raise ConnectionError("Connection closed prematurely!")
+
+async def run_steps_async(reader, writer, steps, pool=None):
+    loop = asyncio.get_running_loop()
+    request = next(steps)
+    while True:
+        op, arg = request
+        if op == RECV:
+            result = await read_exact(reader, arg)
+        elif op == CALL:
+            # Key generation and the exchange would otherwise hold up every
+            # other connection on the loop.
+            result = await loop.run_in_executor(pool, arg)
+        else:
+            writer.write(arg)
+            await writer.drain()
+            result = None
+        try:
+            request = steps.send(result)
+        except StopIteration as done:
+            return done.value
+
+def server_handshake(conn, key_pool, max_frame_size: int, tickets=None):
+    with STATS.phase('handshake'):
+        return run_steps(conn, server_handshake_steps(key_pool, max_frame_size, tickets=tickets))
+
+def client_handshake(s, key_pool, kex: int, max_frame_size: int, extensions=None):
+    """Run the client side of the key exchange.
+
+    Returns (session_key, max_frame, extensions), with the extensions the
+    server accepted.
+    """
+    with STATS.phase('handshake'):
+        private_key = key_pool.take()
+        s.sendall(EDH_MAGIC + struct.pack('>BIB', PROTOCOL_VERSION, max_frame_size, kex)
+                  + encode_public_key(private_key, kex) + encode_extensions(extensions or {}))
+
+        # The server's opening key is for legacy clients.
+        recv_exact(s, LEGACY_KEY_SIZE)
+        version, max_frame = struct.unpack('>BI', recv_exact(s, 5))
+        if version != PROTOCOL_VERSION or not MIN_FRAME_SIZE <= max_frame <= max_frame_size:
+            raise ValueError(f"Server rejected hello (version {version}, max frame {max_frame})")
+        server_public_key = decode_public_key(recv_exact(s, KEY_SIZES[kex]), kex)
+        accepted = recv_extensions(s)
+        return derive_key(exchange(private_key, server_public_key)), max_frame, accepted
+
+def client_resume_handshake(s, ticket: bytes, secret: bytes, max_frame_size: int, extensions=None):
+    """Resume a session from a ticket, with no key agreement.
+
+    Returns (session_key, max_frame, extensions), or None if the server
+    rejected the ticket and a full handshake is needed.
+    """
+    with STATS.phase('handshake'):
+        client_random = os.urandom(RANDOM_SIZE)
+        extensions = {**(extensions or {}), EXT_TICKET: ticket}
+        s.sendall(EDH_MAGIC + struct.pack('>BIB', PROTOCOL_VERSION, max_frame_size, KEX_RESUME)
+                  + client_random + encode_extensions(extensions))
+
+        recv_exact(s, LEGACY_KEY_SIZE)
+        version, max_frame = struct.unpack('>BI', recv_exact(s, 5))
+        server_random = recv_exact(s, RANDOM_SIZE)
+        accepted = recv_extensions(s)
+        if EXT_TICKET not in accepted:
+            return None
+        if version != PROTOCOL_VERSION or not MIN_FRAME_SIZE <= max_frame <= max_frame_size:
+            raise ValueError(f"Server rejected hello (version {version}, max frame {max_frame})")
+        return resumed_session_key(secret, client_random, server_random), max_frame, accepted
+
+def accept_stripes(s, first_stream, stripe, key_pool, max_frame_size: int, tickets=None, size=None):
+    """Accept and handshake the remaining connections of a striped transfer.
+
+    Every stream must carry the same transfer id, stream count and size.
+    """
+    transfer_id, index, count = STRIPE_EXT.unpack(stripe)
+    streams = {index: first_stream}
+    while len(streams) < count:
+        conn, addr = s.accept()
+        session_key, max_frame, extensions = server_handshake(conn, key_pool, max_frame_size, tickets)
+        other_id, index, other_count = STRIPE_EXT.unpack(extensions.get(EXT_STRIPE, bytes(STRIPE_EXT.size)))
+        if (other_id != transfer_id or other_count != count or index in streams or index >= count
+                or size_hint(extensions) != size):
+            conn.close()
+            raise ValueError(f"Unexpected connection from {addr} during striped transfer")
+        streams[index] = (conn, session_key)
+    print(f"[Server] Receiving striped transfer over {count} connections", file=sys.stderr)
+    return [streams[i] for i in range(count)]
+
+def receive_batch(conn, session_key, max_frame: int, output_dir, workers: int = 1, codec=None):
+    writer = BatchWriter(output_dir)
+    receive_chunks(conn, AESGCM(session_key), max_frame, writer, workers, codec)
+    writer.close()
+    print(f"[Server] Received {writer.files} files ({writer.bytes} bytes) into {output_dir}", file=sys.stderr)
+
+def run_server(port, max_frame_size=DEFAULT_MAX_FRAME_SIZE, workers=1, key_pool=None, tickets=None, output_dir='.',
+               open_output=OutputFile):
+    HOST = '0.0.0.0'
+    key_pool = key_pool or KeyPool(0)
+    tickets = tickets or TicketKeeper(AESGCM.generate_key(bit_length=256))
    
 
     with socket.socket(socket.AF_INET, socket.SOCK_STREAM) as s:
         s.settimeout(60)
         s.bind((HOST, port))
-        s.listen(1)
+        s.listen(STRIPE_BACKLOG)
         print(f"[Server] Listening on port {port}...", file=sys.stderr)
 
-        conn, addr = s.accept()
-        with conn:
+        while True:
+            with STATS.phase('accept'):
+                conn, addr = s.accept()
             print(f"[Server] Connection from {addr}", file=sys.stderr)
-            conn.sendall(pub_val_str.encode('utf-8'))
-
-            client_pub_bytes = b''
-            while len(client_pub_bytes) < 384:
-                chunk = conn.recv(384 - len(client_pub_bytes))
-                if not chunk:
-                    raise ConnectionError("Client closed connection early.")
-                client_pub_bytes += chunk
-            client_pub_str = client_pub_bytes.decode('utf-8')
-            if len(client_pub_str) != 384:
-                raise ValueError(f"Invalid client public key length: {len(client_pub_str)} (expected 384)")
-            client_pub_val = padded_decimal_string_to_int(client_pub_str)
-
-            client_public_numbers = dh.DHPublicNumbers(client_pub_val, param_numbers)
-            client_public_key = client_public_numbers.public_key()
-            shared_secret = private_key.exchange(client_public_key)
-            session_key = derive_key(shared_secret)
+            try:
+                session_key, max_frame, extensions = server_handshake(conn, key_pool, max_frame_size, tickets)
+            except TicketRejected as e:
+                # The client reconnects with a full handshake.
+                print(f"[Server] {e}, waiting for a full handshake.", file=sys.stderr)
+                conn.close()
+                continue
+            if EXT_RESUMABLE not in extensions:
+                break
+
+            with conn:
+                try:
+                    target = receive_resumable(SealedChannel(conn, session_key, max_frame, client=False), OUTPUT_PATH)
+                except OSError as e:
+                    # The checkpoint is saved; keep accepting so the client
+                    # can reconnect and resume.
+                    print(f"[Server] Transfer interrupted ({e}), waiting for the client to resume...", file=sys.stderr)
+                    continue
+            print(f"[Server] Wrote {target.manifest.size} bytes to {OUTPUT_PATH} "
+                  f"({target.resumed} of {len(target.manifest)} chunks already present)", file=sys.stderr)
+            return
+
+        with conn:
+            if EXT_STRIPE in extensions:
+                size = size_hint(extensions)
+                streams = accept_stripes(s, (conn, session_key), extensions[EXT_STRIPE], key_pool, max_frame_size, tickets,
+                                         size)
+                try:
+                    write_output_file(lambda f: receive_striped(streams, max_frame, f, size), open_output, size)
+                finally:
+                    for stream_conn, _ in streams:
+                        stream_conn.close()
+                print("[Server] File received and decrypted successfully.", file=sys.stderr)
+                return
+
+            if EXT_BATCH in extensions:
+                print("[Server] Waiting to receive encrypted batch...", file=sys.stderr)
+                receive_batch(conn, session_key, max_frame, output_dir, workers, negotiated_codec(extensions))
+                return
 
             print("[Server] Waiting to receive encrypted file...", file=sys.stderr)
-            receive_and_decrypt_file(conn, session_key)
+            receive_and_decrypt_file(conn, session_key, max_frame, workers, negotiated_codec(extensions),
+                                     open_output, size_hint(extensions))
             print("[Server] File received and decrypted successfully.", file=sys.stderr)
 
 
-def run_client(host, port):
-    with socket.socket(socket.AF_INET, socket.SOCK_STREAM) as s:
-        s.settimeout(60)
-        print(f"[Client] Connecting to {host}:{port}...", file=sys.stderr)
-        s.connect((host, port))
-
-        server_pub_bytes = b''
-        while len(server_pub_bytes) < 384:
-            chunk = s.recv(384 - len(server_pub_bytes))
-            if not chunk:
-                raise ConnectionError("Server closed connection early!")
-            server_pub_bytes += chunk
-        server_pub_str = server_pub_bytes.decode('utf-8')
-        if len(server_pub_str) != 384:
-            raise ValueError(f"Invalid server public key length: {len(server_pub_str)} (expected 384)")
-        server_pub_val = padded_decimal_string_to_int(server_pub_str)
-        server_pub_numbers = dh.DHPublicNumbers(server_pub_val, param_numbers)
-        server_public_key = server_pub_numbers.public_key()
-
-        private_key = dh_parameters.generate_private_key()
-        public_key = private_key.public_key()
-        pub_val_int = public_key.public_numbers().y
-        pub_val_str = int_to_padded_decimal_string(pub_val_int)
-        s.sendall(pub_val_str.encode('utf-8'))
-
-        
-
-        shared_secret = private_key.exchange(server_public_key)
-        session_key = derive_key(shared_secret)
+async def wait_job(future):
+    """Await a job submitted to a thread pool until it has returned.
+
+    A job that has started cannot be stopped, and nothing else may touch
+    its file while it runs, so a cancellation of this task is held back
+    and raised once the job is done.
+    """
+    waiter = asyncio.wrap_future(future)
+    cancelled = False
+    while not waiter.done():
+        try:
+            await asyncio.wait([waiter])
+        except asyncio.CancelledError:
+            cancelled = True
+    if cancelled:
+        raise asyncio.CancelledError
+    return waiter.result()
+
+async def receive_upload(reader, session_key, max_frame, out, pool, codec=None) -> int:
+    """Decrypt one upload into out, reading the next frame while the pool
+    decrypts and writes the previous one. If the upload fails, it returns
+    only once no job is left writing to out."""
+    aesgcm = AESGCM(session_key)
+
+    def open_segment(data):
+        if len(data) < 16:
+            raise ValueError("Segment too short to contain nonce")
+        plaintext = aesgcm.decrypt(data[:16], data[16:], None)
+        out.write(plaintext)
+        return len(plaintext)
+
+    def open_chunk(counter, ciphertext, final):
+        try:
+            with STATS.phase('decrypt'):
+                plaintext = aesgcm.decrypt(chunk_nonce(counter, final), ciphertext, None)
+        except Exception as e:
+            raise ValueError(f"Decryption failed on chunk {counter}: {e}")
+        if codec is not None:
+            plaintext = decompress_chunk(plaintext, max_frame)
+        out.write(plaintext)
+        return len(plaintext)
+
+    total = 0
+    pending = None
+    try:
+        if max_frame is None:
+            length = struct.unpack('>H', await read_exact(reader, 2))[0]
+            pending = pool.submit(open_segment, await read_exact(reader, length))
+            return await wait_job(pending)
+        async for counter, ciphertext, final in recv_chunks_async(functools.partial(read_exact, reader), max_frame):
+            if pending is not None:
+                total += await wait_job(pending)
+            pending = pool.submit(open_chunk, counter, ciphertext, final)
+            if final:
+                return total + await wait_job(pending)
+    except BaseException:
+        if pending is not None and not pending.cancel():
+            with contextlib.suppress(BaseException):
+                await wait_job(pending)
+        raise
+
+async def handle_upload(reader, writer, key_pool, tickets, max_frame_size, output_dir, pool, sequence, open_output):
+    peer = writer.get_extra_info('peername')
+    name = f"{time.strftime('%Y%m%d-%H%M%S')}-{next(sequence):06d}-{peer[0]}-{peer[1]}"
+    path = os.path.join(output_dir, name + '.bin')
+    partial = path + '.part'
+    print(f"[Server] Connection from {peer}", file=sys.stderr)
+    try:
+        session_key, max_frame, extensions = await run_steps_async(
+            reader, writer, server_handshake_steps(key_pool, max_frame_size, allow_stripe=False, tickets=tickets, allow_resume=False),
+            pool)
+        if EXT_BATCH in extensions:
+            # A batch becomes a directory, renamed into place once complete.
+            path = os.path.join(output_dir, name)
+            partial = path + '.part'
+            out = BatchWriter(partial)
+            await receive_upload(reader, session_key, max_frame, out, pool, negotiated_codec(extensions))
+            out.close()
+            os.replace(partial, path)
+            print(f"[Server] {peer}: wrote {out.files} files ({out.bytes} bytes) to {path}", file=sys.stderr)
+            return
+        out = open_output(path, size=size_hint(extensions), temp_path=partial)
+        try:
+            written = await receive_upload(reader, session_key, max_frame, out, pool, negotiated_codec(extensions))
+            await wait_job(pool.submit(out.commit))
+        except BaseException:
+            # receive_upload has no job left on out by now; abort() closes
+            # and unlinks, so it runs on the pool rather than the loop.
+            with contextlib.suppress(BaseException):
+                await wait_job(pool.submit(out.abort))
+            raise
+        print(f"[Server] {peer}: wrote {written} bytes to {path}", file=sys.stderr)
+    except Exception as e:
+        print(f"[Server] {peer}: transfer failed: {e}", file=sys.stderr)
+        if os.path.isdir(partial):
+            shutil.rmtree(partial, ignore_errors=True)
+        elif os.path.exists(partial):
+            os.remove(partial)
+    finally:
+        writer.close()
+
+async def serve_uploads(port, output_dir, max_frame_size, workers, key_pool, tickets, open_output):
+    # Handshakes and frame reads run as tasks on one event loop; AES-GCM and
+    # file writes go to a shared thread pool.
+    pool = ThreadPoolExecutor(max_workers=workers if workers > 1 else None)
+    sequence = itertools.count(1)
+    server = await asyncio.start_server(
+        lambda reader, writer: handle_upload(reader, writer, key_pool, tickets, max_frame_size, output_dir, pool, sequence,
+                                               open_output),
+        '0.0.0.0', port, backlog=DAEMON_BACKLOG)
+    print(f"[Server] Daemon listening on port {port}, writing to {output_dir}", file=sys.stderr)
+    async with server:
+        await server.serve_forever()
+
+def run_daemon(port, output_dir, max_frame_size=DEFAULT_MAX_FRAME_SIZE, workers=1, key_pool=None, tickets=None,
+               open_output=OutputFile):
+    os.makedirs(output_dir, exist_ok=True)
+    tickets = tickets or TicketKeeper(AESGCM.generate_key(bit_length=256))
+    try:
+        asyncio.run(serve_uploads(port, output_dir, max_frame_size, workers, key_pool or KeyPool(DAEMON_KEY_POOL),
+                                  tickets, open_output))
+    except KeyboardInterrupt:
+        print("[Server] Shutting down.", file=sys.stderr)
+
+def run_striped_client(host, port, streams, max_frame_size=DEFAULT_MAX_FRAME_SIZE, key_pool=None, kex=KEX_X25519):
+    key_pool = key_pool or KeyPool(0, lambda: generate_key(kex))
+    transfer_id = os.urandom(16)
+    size = stdin_size()
 
+    def open_stream(index):
+        s = socket.create_connection((host, port), timeout=60)
+        stripe = STRIPE_EXT.pack(transfer_id, index, streams)
+        request = {EXT_STRIPE: stripe}
+        if size is not None:
+            # The server holds the streams to exactly this many bytes.
+            request[EXT_SIZE] = SIZE_EXT.pack(size)
+        session_key, max_frame, accepted = client_handshake(s, key_pool, kex, max_frame_size, request)
+        if accepted.get(EXT_STRIPE) != stripe:
+            s.close()
+            raise ValueError("Server does not support striped transfers")
+        return s, session_key, max_frame
+
+    print(f"[Client] Opening {streams} connections to {host}:{port}...", file=sys.stderr)
+    with ThreadPoolExecutor(max_workers=streams) as pool:
+        opened = list(pool.map(open_stream, range(streams)))
+    try:
+        max_frame = min(stream[2] for stream in opened)
         print("[Client] Encrypting and sending data...", file=sys.stderr)
-        encrypt_and_send_stdin(s, session_key)
+        send_striped([(s, session_key) for s, session_key, _ in opened], sys.stdin.buffer, max_frame)
         print("[Client] File sent successfully.", file=sys.stderr)
+    finally:
+        for s, _, _ in opened:
+            s.close()
+
+def run_resumable_client(host, port, max_frame_size=DEFAULT_MAX_FRAME_SIZE, key_pool=None, kex=KEX_X25519):
+    key_pool = key_pool or KeyPool(0, lambda: generate_key(kex))
+    fd = sys.stdin.buffer.fileno()
+    print("[Client] Hashing input chunks...", file=sys.stderr)
+    manifest = Manifest.from_fd(fd)
+
+    for attempt in range(RESUME_RETRIES + 1):
+        try:
+            with socket.create_connection((host, port), timeout=60) as s:
+                print(f"[Client] Connected to {host}:{port}", file=sys.stderr)
+                session_key, max_frame, accepted = client_handshake(s, key_pool, kex, max_frame_size,
+                                                                    {EXT_RESUMABLE: b''})
+                if EXT_RESUMABLE not in accepted:
+                    raise ValueError("Server does not support resumable transfers")
+                send_resumable(SealedChannel(s, session_key, max_frame, client=True), fd, manifest)
+                print("[Client] File sent successfully.", file=sys.stderr)
+                return
+        except OSError as e:
+            if attempt == RESUME_RETRIES:
+                raise
+            print(f"[Client] Transfer interrupted ({e}), retrying in {RESUME_RETRY_DELAY}s...", file=sys.stderr)
+            time.sleep(RESUME_RETRY_DELAY)
+
+def run_client(host, port, max_frame_size=DEFAULT_MAX_FRAME_SIZE, workers=1, key_pool=None, kex=KEX_X25519,
+               ticket_cache=None, batch=None, codec=None):
+    key_pool = key_pool or KeyPool(0, lambda: generate_key(kex))
+    server = f"{host}:{port}"
+    cached = ticket_cache.take(server) if ticket_cache else None
+    request = {EXT_TICKET: b''} if ticket_cache else {}
+    if batch:
+        request[EXT_BATCH] = b''
+    elif stdin_size() is not None:
+        request[EXT_SIZE] = SIZE_EXT.pack(stdin_size())
+    if codec is not None:
+        # zlib is always there, so offer it as the fallback.
+        request[EXT_COMPRESS] = bytes(dict.fromkeys([codec, CODEC_ZLIB]))
+
+    while True:
+        with socket.socket(socket.AF_INET, socket.SOCK_STREAM) as s:
+            s.settimeout(60)
+            print(f"[Client] Connecting to {host}:{port}...", file=sys.stderr)
+            with STATS.phase('connect'):
+                s.connect((host, port))
+
+            if cached:
+                handshake = client_resume_handshake(s, *cached, max_frame_size, request)
+                cached = None
+                if handshake is None:
+                    print("[Client] Ticket rejected, retrying with a full handshake.", file=sys.stderr)
+                    continue
+                print("[Client] Resumed session from ticket.", file=sys.stderr)
+            else:
+                handshake = client_handshake(s, key_pool, kex, max_frame_size, request)
+            session_key, max_frame, accepted = handshake
+
+            if ticket_cache and EXT_TICKET in accepted:
+                ticket_cache.put(server, accepted[EXT_TICKET], session_key)
+            codec = negotiated_codec(accepted)
+
+            if batch:
+                if EXT_BATCH not in accepted:
+                    raise ValueError("Server does not accept batches")
+                print(f"[Client] Sending batch of {len(batch)} paths...", file=sys.stderr)
+                encrypt_and_send_stdin(s, session_key, max_frame, workers, BatchReader(batch), codec)
+                print("[Client] Batch sent successfully.", file=sys.stderr)
+                return
+
+            print("[Client] Encrypting and sending data...", file=sys.stderr)
+            encrypt_and_send_stdin(s, session_key, max_frame, workers, codec=codec)
+            print("[Client] File sent successfully.", file=sys.stderr)
+            return
 
 
 
@@ -177,18 +1027,112 @@ if __name__ == "__main__":
     parser.add_argument('-l', '--listen', type=int, metavar='PORT', help='Run as server listening on PORT')
     parser.add_argument('server_ip', nargs='?', help='Server IP to connect to')
     parser.add_argument('port', nargs='?', type=int, help='Port number')
+    parser.add_argument('--max-frame-size', type=int, default=DEFAULT_MAX_FRAME_SIZE,
+                        help='Largest frame to send or accept (negotiated down to the peer)')
+    parser.add_argument('--workers', type=int, default=1, metavar='N',
+                        help='Encrypt/decrypt chunks on N threads')
+    parser.add_argument('--key-pool', type=int, metavar='N',
+                        help=f'Keep N ephemeral DH keys pre-generated in the background '
+                             f'(default 1, or {DAEMON_KEY_POOL} with --daemon; 0 disables)')
+    parser.add_argument('--kex', choices=sorted(KEX_NAMES), default='x25519',
+                        help='Client key agreement (the server accepts either)')
+    parser.add_argument('--streams', type=int, default=1, metavar='N',
+                        help='Client: stripe the file across N parallel connections')
+    parser.add_argument('--ticket-cache', metavar='FILE',
+                        help='Client: store resumption tickets in FILE and resume sessions from it')
+    parser.add_argument('--ticket-key', metavar='FILE',
+                        help='Server: keep the ticket key in FILE so tickets survive restarts')
+    parser.add_argument('--ticket-lifetime', type=int, default=TICKET_LIFETIME, metavar='SECONDS',
+                        help='Server: how long issued resumption tickets stay valid')
+    parser.add_argument('--daemon', action='store_true',
+                        help='Server: keep running and accept many concurrent uploads')
+    parser.add_argument('-o', '--output-dir', default='.', metavar='DIR',
+                        help='Server: directory that receives batches (and, with --daemon, one file per upload)')
+    parser.add_argument('--durability', choices=DURABILITY_LEVELS, default='close',
+                        help='Server: none, fsync on close (default), or periodic fdatasync while writing')
+    parser.add_argument('--sync-every', type=int, default=64, metavar='MB',
+                        help='Server: with --durability periodic, fdatasync after every MB megabytes')
+    parser.add_argument('--mmap', action='store_true',
+                        help='Server: write through a memory mapping when the client announces the size')
+    parser.add_argument('--max-prealloc', type=int, default=MAX_PREALLOC_MB, metavar='MB',
+                        help='Server: ignore announced sizes above MB megabytes (or above the free space) '
+                             'instead of reserving them')
+    parser.add_argument('--batch', action='append', default=[], metavar='PATH',
+                        help='Client: send this file or directory tree instead of stdin (repeatable)')
+    parser.add_argument('--batch-list', metavar='FILE',
+                        help='Client: send the files and directories listed in FILE, one per line')
+    parser.add_argument('--compress', choices=sorted(CODEC_NAMES), metavar='CODEC',
+                        help='Client: compress chunks before encryption with zlib, lzma or zstd (if installed)')
+    parser.add_argument('--resumable', action='store_true',
+                        help='Client: send stdin (a regular file) so an interrupted transfer can pick up where it left off')
+    parser.add_argument('--stats', action='store_true',
+                        help='Print per-phase timings and byte counters as a JSON line on stderr at exit')
 
     args = parser.parse_args()
+    if not MIN_FRAME_SIZE <= args.max_frame_size <= FRAME_LENGTH_MASK:
+        parser.error(f"--max-frame-size must be between {MIN_FRAME_SIZE} and {FRAME_LENGTH_MASK}")
+    if args.workers < 1:
+        parser.error("--workers must be at least 1")
+    if args.key_pool is None:
+        args.key_pool = DAEMON_KEY_POOL if args.daemon else 1
+    if args.key_pool < 0:
+        parser.error("--key-pool must not be negative")
+    if not 1 <= args.streams <= 0xFFFF:
+        parser.error("--streams must be between 1 and 65535")
+    if args.daemon and args.listen is None:
+        parser.error("--daemon requires -l PORT")
+    if args.max_prealloc < 0:
+        parser.error("--max-prealloc must not be negative")
+    if args.sync_every < 1:
+        parser.error("--sync-every must be at least 1")
+    if args.batch_list:
+        args.batch += read_file_list(args.batch_list)
+    if args.batch and args.streams > 1:
+        parser.error("--batch cannot be combined with --streams")
+    if args.resumable and (args.batch or args.streams > 1):
+        parser.error("--resumable cannot be combined with --batch or --streams")
+    if args.compress and (args.resumable or args.streams > 1):
+        parser.error("--compress cannot be combined with --resumable or --streams")
+    if args.compress and CODEC_NAMES[args.compress] not in available_codecs():
+        parser.error(f"{args.compress} compression is not available (pip install zstandard)")
+
+    role = 'daemon' if args.daemon else 'server' if args.listen is not None else 'client'
+    enable_stats('eft-dh', role, args.stats)
 
     try:
+        # Start filling the pool now so key generation overlaps with binding
+        # and connecting instead of sitting on the handshake path.
+        kex = KEX_NAMES[args.kex]
+        if args.listen is not None:
+            # The server pool holds finite-field keys, the expensive kind;
+            # X25519 keys are cheap enough to generate per connection.
+            kex = KEX_FFDH
+        key_pool = KeyPool(args.key_pool, lambda: generate_key(kex))
         if args.listen is not None:
-            run_server(args.listen)
+            if args.ticket_key:
+                tickets = TicketKeeper.from_file(args.ticket_key, args.ticket_lifetime)
+            else:
+                tickets = TicketKeeper(AESGCM.generate_key(bit_length=256), args.ticket_lifetime)
+        open_output = functools.partial(OutputFile, durability=args.durability, sync_bytes=args.sync_every << 20,
+                                        use_mmap=args.mmap, max_prealloc=args.max_prealloc << 20)
+        if args.daemon:
+            run_daemon(args.listen, args.output_dir, args.max_frame_size, args.workers, key_pool, tickets, open_output)
+        elif args.listen is not None:
+            run_server(args.listen, args.max_frame_size, args.workers, key_pool, tickets, args.output_dir, open_output)
         else:
             if args.server_ip is None or args.port is None:
                 parser.print_usage(sys.stderr)
                 print("\nError: Client mode requires SERVER_IP_ADDRESS and PORT.")
                 sys.exit(1)
-            run_client(args.server_ip, args.port)
+            if args.resumable:
+                run_resumable_client(args.server_ip, args.port, args.max_frame_size, key_pool, kex)
+            elif args.streams > 1:
+                run_striped_client(args.server_ip, args.port, args.streams, args.max_frame_size, key_pool, kex)
+            else:
+                ticket_cache = TicketCache(args.ticket_cache) if args.ticket_cache else None
+                codec = CODEC_NAMES[args.compress] if args.compress else None
+                run_client(args.server_ip, args.port, args.max_frame_size, args.workers, key_pool, kex, ticket_cache,
+                           args.batch, codec)
     except Exception as e:
         print(f"Error: {e}", file=sys.stderr)
         sys.exit(1)
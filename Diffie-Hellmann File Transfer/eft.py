@@ -10,7 +10,7 @@ import socket
 
 from Crypto.Protocol.KDF import PBKDF2
 
-from Crypto.Util.Padding import pad, unpad
+from Crypto.Util.Padding import unpad
 
 from Crypto.Hash import SHA256
 
@@ -20,6 +20,97 @@ from Crypto.Random import get_random_bytes
 
 from struct import pack, unpack
 
+from transfer_core import (BatchReader, BatchWriter, CODEC_LZMA, CODEC_NAMES, CODEC_ZLIB, CODEC_ZSTD,
+                           DURABILITY_LEVELS, FRAME_LENGTH_MASK, OutputFile, STATS, TAG_SIZE, available_codecs,
+                           chunk_nonce, compress_chunk, decompress_chunk, enable_stats, ordered_pipeline,
+                           read_chunks, read_file_list, recv_chunks, recv_exact, send_frame)
+
+
+
+EFT_MAGIC = b'EFT2'
+
+PROTOCOL_VERSION = 3
+
+STREAM_VERSION = 2
+
+FLAG_BATCH = 0x01
+
+CODEC_FLAGS = {CODEC_ZLIB: 0x02, CODEC_LZMA: 0x04, CODEC_ZSTD: 0x08}
+
+DEFAULT_MAX_FRAME_SIZE = 1 << 20
+
+MIN_FRAME_SIZE = 1024
+
+OUTPUT_PATH = "decrypted_output.txt"
+
+
+
+def send_stream(sock, key, max_frame, stdin, workers=1, codec=None):
+
+    def seal(item):
+
+        # PyCryptodome GCM objects are single-use, so each chunk still gets
+        # its own; only the framing and nonce scheme come from transfer_core.
+        counter, chunk, final = item
+
+        if codec is not None:
+
+            chunk = compress_chunk(codec, chunk)
+
+        with STATS.phase('encrypt'):
+
+            cipher = AES.new(key, AES.MODE_GCM, nonce=chunk_nonce(counter, final))
+
+            ciphertext, tag = cipher.encrypt_and_digest(chunk)
+
+        return ciphertext + tag, final
+
+    # With compression every chunk gains a codec byte, so read one less.
+    chunks = read_chunks(stdin, max_frame - TAG_SIZE - (codec is not None))
+
+    for payload, final in ordered_pipeline(chunks, seal, workers):
+
+        send_frame(sock, payload, final)
+
+
+
+def receive_stream(sock, key, max_frame, outputs, workers=1, codec=None):
+
+    def open_chunk(item):
+
+        counter, payload, final = item
+
+        if len(payload) < TAG_SIZE:
+
+            raise ValueError("Frame too short to contain a tag")
+
+        with STATS.phase('decrypt'):
+
+            cipher = AES.new(key, AES.MODE_GCM, nonce=chunk_nonce(counter, final))
+
+            view = memoryview(payload)
+
+            plaintext = cipher.decrypt_and_verify(view[:-TAG_SIZE], view[-TAG_SIZE:])
+
+        return plaintext if codec is None else decompress_chunk(plaintext, max_frame)
+
+    total = 0
+
+    for plaintext in ordered_pipeline(recv_chunks(sock, max_frame), open_chunk, workers):
+
+        for out in outputs:
+
+            out.write(plaintext)
+
+        total += len(plaintext)
+
+    # Outputs buffer small chunks into larger writes; push out the rest.
+    for out in outputs:
+
+        out.flush()
+
+    return total
+
 
 
 def parse_args():
@@ -34,6 +125,26 @@ def parse_args():
 
 
 
+    parser.add_argument('--workers', type=int, default=1, metavar='N', help='Encrypt/decrypt chunks on N threads')
+
+    parser.add_argument('--max-frame-size', type=int, default=DEFAULT_MAX_FRAME_SIZE, help='Largest frame to send or accept (negotiated down to the peer)')
+
+    parser.add_argument('--compress', choices=sorted(CODEC_NAMES), metavar='CODEC', help='Client: compress chunks before encryption with zlib, lzma or zstd (if installed)')
+
+    parser.add_argument('--batch', action='append', default=[], metavar='PATH', help='Client: send this file or directory tree instead of stdin (repeatable)')
+
+    parser.add_argument('--batch-list', metavar='FILE', help='Client: send the files and directories listed in FILE, one per line')
+
+    parser.add_argument('-o', '--output-dir', metavar='DIR', help='Server: accept a batch and unpack it into DIR (batches are refused without it)')
+
+    parser.add_argument('--durability', choices=DURABILITY_LEVELS, default='close', help='Server: none, fsync on close (default), or periodic fdatasync while writing')
+
+    parser.add_argument('--sync-every', type=int, default=64, metavar='MB', help='Server: with --durability periodic, fdatasync after every MB megabytes')
+
+    parser.add_argument('--stats', action='store_true', help='Print per-phase timings and byte counters as a JSON line on stderr at exit')
+
+
+
     parser.add_argument('host', nargs ='?', help='Server IP address (client mode only)')
 
     parser.add_argument('port', nargs ='?', type=int, help='Server port (client mode only)')
@@ -56,6 +167,26 @@ def parse_args():
 
         parser.error("You must specify either '-l PORT' (server) or 'HOST PORT' (client)")
 
+    if not MIN_FRAME_SIZE <= args.max_frame_size <= FRAME_LENGTH_MASK:
+
+        parser.error(f"--max-frame-size must be between {MIN_FRAME_SIZE} and {FRAME_LENGTH_MASK}")
+
+    if args.workers < 1:
+
+        parser.error("--workers must be at least 1")
+
+    if args.batch_list:
+
+        args.batch += read_file_list(args.batch_list)
+
+    if args.sync_every < 1:
+
+        parser.error("--sync-every must be at least 1")
+
+    if args.compress and CODEC_NAMES[args.compress] not in available_codecs():
+
+        parser.error(f"{args.compress} compression is not available (pip install zstandard)")
+
     return mode, args
 
 
@@ -64,8 +195,14 @@ if __name__ == "__main__":
 
     mode, args = parse_args()
 
+    enable_stats('eft', mode, args.stats)
+
     password = args.password.encode()
 
+    # The decrypted file is written to a temporary file and renamed over
+    # OUTPUT_PATH once the transfer authenticates.
+    output_options = dict(durability=args.durability, sync_bytes=args.sync_every << 20)
+
 
 
     if mode == 'server':
@@ -80,31 +217,91 @@ if __name__ == "__main__":
 
 
 
-            conn, addr = server_socket.accept()
+            with STATS.phase('accept'):
+                conn, addr = server_socket.accept()
 
             with conn:
 
-                salt = b''
-                while len(salt) < 16:
-                    chunk = conn.recv(16 - len(salt))
-                    if not chunk:
-                        raise ConnectionError("Connection closed while receiving salt")
-                    salt += chunk
-
-                length_bytes = b''
-                while len(length_bytes) < 2:
-                    chunk = conn.recv(2 - len(length_bytes))
-                    if not chunk:
-                        raise ConnectionError("Connection closed while receiving length")
-                    length_bytes += chunk
-                expected_length = unpack('>H', length_bytes)[0]
-
-                payload = b''
-                while len(payload) < expected_length:
-                    chunk = conn.recv(expected_length - len(payload))
-                    if not chunk:
-                        raise ConnectionError("Connection closed while receiving payload")
-                    payload += chunk
+                # Current clients open with a versioned hello; older ones
+                # start straight away with the salt and a 16-bit length.
+                first = recv_exact(conn, len(EFT_MAGIC))
+
+                if first == EFT_MAGIC:
+                    version, client_max_frame = unpack('>BI', recv_exact(conn, 5))
+                    if version not in (STREAM_VERSION, PROTOCOL_VERSION):
+                        raise ConnectionError(f"Unsupported protocol version {version}")
+                    # Version 3 adds a flags byte; version 2 is a plain stream.
+                    flags = recv_exact(conn, 1)[0] if version == PROTOCOL_VERSION else 0
+                    if client_max_frame < MIN_FRAME_SIZE:
+                        raise ConnectionError(f"Client frame size {client_max_frame} is below {MIN_FRAME_SIZE}")
+                    salt = bytes(recv_exact(conn, 16))
+                    max_frame = min(client_max_frame, args.max_frame_size)
+                    # Accept a batch only with somewhere to unpack it, and the
+                    # first offered codec we have.
+                    batch_offered = flags & FLAG_BATCH
+                    codec = next((c for c, bit in CODEC_FLAGS.items() if flags & bit and c in available_codecs()), None)
+                    flags = (FLAG_BATCH if batch_offered and args.output_dir else 0) | CODEC_FLAGS.get(codec, 0)
+                    if version == PROTOCOL_VERSION:
+                        conn.sendall(pack('>BIB', version, max_frame, flags))
+                    else:
+                        conn.sendall(pack('>BI', version, max_frame))
+
+                    if batch_offered and not flags & FLAG_BATCH:
+
+                        sys.stderr.write("Error: client sent a batch; pass -o/--output-dir to accept one\n")
+
+                        sys.stderr.flush()
+
+                        sys.exit(1)
+
+                    with STATS.phase('kdf'):
+                        key = PBKDF2(password, salt, dkLen=32)
+
+                    if flags & FLAG_BATCH:
+
+                        writer = BatchWriter(args.output_dir)
+
+                        try:
+
+                            receive_stream(conn, key, max_frame, (writer,), args.workers, codec)
+
+                            writer.close()
+
+                        except (ValueError, KeyError) as e:
+
+                            sys.stderr.write(f"Error: batch failed: {e}\n")
+
+                            sys.stderr.flush()
+
+                            sys.exit(1)
+
+                        print(f"Received {writer.files} files ({writer.bytes} bytes) into {args.output_dir}", file=sys.stderr)
+
+                        sys.exit(0)
+
+                    try:
+
+                        with OutputFile(OUTPUT_PATH, **output_options) as f:
+
+                            written = receive_stream(conn, key, max_frame, (f, sys.stdout.buffer), args.workers, codec)
+
+                    except (ValueError, KeyError):
+
+                        # Chunks already echoed to stdout were authenticated,
+                        # but a truncated transfer never replaces the file.
+                        sys.stderr.write("Error: integrity check failed.\n")
+
+                        sys.stderr.flush()
+
+                        sys.exit(1)
+
+                    print(f"Decrypted plaintext length {written} bytes", file=sys.stderr)
+
+                    sys.exit(0)
+
+                salt = bytes(first + recv_exact(conn, 16 - len(first)))
+                expected_length = unpack('>H', recv_exact(conn, 2))[0]
+                payload = recv_exact(conn, expected_length)
 
                 
                 if len(payload) < 32:
@@ -121,17 +318,19 @@ if __name__ == "__main__":
 
                 try:
 
-                    key = PBKDF2(password, salt, dkLen=32)
+                    with STATS.phase('kdf'):
+                        key = PBKDF2(password, salt, dkLen=32)
 
-                    cipher = AES.new(key, AES.MODE_GCM, nonce=nonce)
-                    plaintext = cipher.decrypt_and_verify(ciphertext, tag)
+                    with STATS.phase('decrypt'):
+                        cipher = AES.new(key, AES.MODE_GCM, nonce=nonce)
+                        plaintext = cipher.decrypt_and_verify(ciphertext, tag)
                     plaintext = unpad(plaintext, AES.block_size)
 
                     print(f"Decrypted plaintext length {len(plaintext)} bytes", file=sys.stderr)
 
 
 
-                    with open("decrypted_output.txt", "wb") as f:
+                    with OutputFile(OUTPUT_PATH, **output_options) as f:
 
                         f.write(plaintext)
 
@@ -157,35 +356,48 @@ if __name__ == "__main__":
 
         salt = get_random_bytes(16)
 
-        key = PBKDF2(password, salt, dkLen=32)
+        with STATS.phase('kdf'):
+            key = PBKDF2(password, salt, dkLen=32)
 
 
 
-        plaintext = sys.stdin.buffer.read()
+        with socket.socket(socket.AF_INET, socket.SOCK_STREAM) as s:
 
-        plaintext = pad(plaintext, AES.block_size)
+            with STATS.phase('connect'):
+                s.connect((args.host, args.port))
 
-        nonce = get_random_bytes(16)
+            # Plain streams keep the version 2 hello so older servers still
+            # accept them; batches and compression need version 3 for the
+            # flags byte.
+            codec = CODEC_NAMES[args.compress] if args.compress else None
 
-        cipher = AES.new(key, AES.MODE_GCM, nonce=nonce)
+            if args.batch or codec is not None:
 
-        
+                offer = (FLAG_BATCH if args.batch else 0) | CODEC_FLAGS.get(codec, 0)
 
+                hello_version, hello = PROTOCOL_VERSION, pack('>BIB', PROTOCOL_VERSION, args.max_frame_size, offer)
 
+            else:
 
-        ciphertext, tag = cipher.encrypt_and_digest(plaintext)
+                hello_version, hello = STREAM_VERSION, pack('>BI', STREAM_VERSION, args.max_frame_size)
 
+            s.sendall(EFT_MAGIC + hello + salt)
 
+            version, max_frame = unpack('>BI', recv_exact(s, 5))
 
-        payload = nonce + tag + ciphertext
+            flags = recv_exact(s, 1)[0] if version == PROTOCOL_VERSION else 0
 
-        length_bytes = pack('>H', len(payload))
+            if version != hello_version or not MIN_FRAME_SIZE <= max_frame <= args.max_frame_size:
 
+                raise ConnectionError(f"Server rejected hello (version {version}, max frame {max_frame})")
 
+            if args.batch and not flags & FLAG_BATCH:
 
-        with socket.socket(socket.AF_INET, socket.SOCK_STREAM) as s:
+                raise ConnectionError("Server does not accept batches")
 
-            s.connect((args.host, args.port))
+            # The server may decline compression, in which case send raw.
+            codec = codec if flags & CODEC_FLAGS.get(codec, 0) else None
 
-            s.sendall(salt + length_bytes + payload)
+            source = BatchReader(args.batch) if args.batch else sys.stdin.buffer
 
+            send_stream(s, key, max_frame, source, args.workers, codec)
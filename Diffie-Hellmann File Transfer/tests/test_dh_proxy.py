@@ -0,0 +1,109 @@
+import importlib.util
+import os
+import sys
+import tempfile
+import time
+import unittest
+
+HERE = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, HERE)
+
+spec = importlib.util.spec_from_file_location('dh_proxy', os.path.join(HERE, 'dh-proxy.py'))
+dh_proxy = importlib.util.module_from_spec(spec)
+spec.loader.exec_module(dh_proxy)
+
+KEY_IN = bytes(range(32))
+KEY_OUT = bytes(range(32, 64))
+
+
+def segment(cipher, plaintext):
+    return b''.join(cipher.seal(plaintext))
+
+
+def plaintexts(parts):
+    cipher = dh_proxy.SegmentCipher(KEY_OUT)
+    data = b''.join(bytes(part) for part in parts)
+    out = []
+    while data:
+        length = dh_proxy.SEGMENT_HEADER.unpack_from(data)[0]
+        end = dh_proxy.SEGMENT_HEADER.size + length
+        out.append(cipher.open(data[dh_proxy.SEGMENT_HEADER.size:end]))
+        data = data[end:]
+    return out
+
+
+class RuleSetTest(unittest.TestCase):
+
+    def test_regex_hold_covers_possible_starts_only(self):
+        rules = dh_proxy.RuleSet([], [(rb'id=\d{1,8}', b'id=0')])
+        self.assertEqual(rules.hold(b'x' * 4096), 0)
+        self.assertEqual(rules.hold(b'x' * 4096 + b'i'), 1)
+        self.assertEqual(rules.hold(b'x' * 4096 + b'id=12'), 5)
+        # A start further back than the widest match cannot grow any more.
+        self.assertEqual(rules.hold(b'id' + b'x' * 10), 0)
+
+    def test_regex_first_bytes(self):
+        self.assertEqual(dh_proxy.regex_first_bytes(rb'(?i:ab)|c?d'), set(b'aAcd'))
+        self.assertEqual(dh_proxy.regex_first_bytes(rb'[^x]y'), dh_proxy.ANY_BYTE - {ord('x')})
+
+    def test_unbounded_regex_rejected(self):
+        with tempfile.NamedTemporaryFile('w', suffix='.rules', delete=False) as f:
+            f.write('regex\tclient\tid=\\d+\tid=0\n')
+        self.addCleanup(os.unlink, f.name)
+        with self.assertRaisesRegex(ValueError, 'bound its repeats'):
+            dh_proxy.load_rules(f.name)
+
+
+class SegmentRelayTest(unittest.TestCase):
+
+    def relay(self, hold_time=60, rules=dh_proxy.DEFAULT_RULES):
+        rewriter = dh_proxy.Rewriter(rules, hold_time)
+        return dh_proxy.SegmentRelay(dh_proxy.SegmentCipher(KEY_IN), dh_proxy.SegmentCipher(KEY_OUT),
+                                     lambda plaintext: None, 'client', rewriter.stream('client'))
+
+    def test_match_split_across_feeds(self):
+        relay = self.relay()
+        sender = dh_proxy.SegmentCipher(KEY_IN)
+        first = relay.feed(segment(sender, b'please trans'))
+        self.assertEqual(first, [])
+        self.assertIsNotNone(relay.deadline())
+        second = relay.feed(segment(sender, b'fer now'))
+        self.assertIsNone(relay.deadline())
+        self.assertEqual(plaintexts(second + relay.finish()), [b'please hacked', b' now'])
+
+    def test_segment_split_across_feeds(self):
+        relay = self.relay()
+        data = segment(dh_proxy.SegmentCipher(KEY_IN), b'one transfer')
+        parts = relay.feed(data[:5]) + relay.feed(data[5:])
+        self.assertEqual(plaintexts(parts), [b'one hacked'])
+
+    def test_release_sends_waiting_segment_unchanged(self):
+        relay = self.relay()
+        sender = dh_proxy.SegmentCipher(KEY_IN)
+        self.assertEqual(relay.feed(segment(sender, b'please trans')), [])
+        held = relay.release()
+        self.assertIsNone(relay.deadline())
+        self.assertEqual(plaintexts(held), [b'please trans'])
+        self.assertEqual(plaintexts(relay.feed(segment(sender, b'fer'))), [b'fer'])
+        self.assertEqual(relay.finish(), [])
+
+    def test_segment_count_preserved(self):
+        relay = self.relay(rules=[('regex', 'client', rb'id=\d{1,8}', b'id=0')])
+        sender = dh_proxy.SegmentCipher(KEY_IN)
+        sent = [b'a', b'b id=1', b'2', b'', b'34 c', b'i', b'd', b'=7']
+        parts = []
+        for plaintext in sent:
+            parts += relay.feed(segment(sender, plaintext))
+        parts += relay.finish()
+        self.assertEqual(plaintexts(parts), [b'a', b'b id=0', b'', b'', b' c', b'id=0', b'', b''])
+
+    def test_release_after_deadline(self):
+        relay = self.relay(hold_time=0)
+        sender = dh_proxy.SegmentCipher(KEY_IN)
+        relay.feed(segment(sender, b'trans'))
+        self.assertLessEqual(relay.deadline(), time.monotonic())
+        self.assertEqual(plaintexts(relay.release()), [b'trans'])
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,187 @@
+import os
+import socket
+import stat
+import sys
+import tempfile
+import unittest
+
+HERE = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, HERE)
+
+from cryptography.hazmat.primitives.asymmetric import dh
+
+import transfer_core
+from transfer_core import (FRAME_FINAL, FRAME_HEADER, BatchReader, BatchWriter, Manifest, chunk_nonce, decode_bitmap,
+                           dh_exchange, encode_bitmap, frame_buffer, parse_frame_header, recv_frame, send_frame)
+
+# The 1024-bit group dh-proxy.py and eft-dh.py use.
+P = int(
+    "00cc81ea8157352a9e9a318aac4e33ffba80fc8da3373fb44895109e4c3ff6cedcc55c02228fccbd"
+    "551a504feb4346d2aef47053311ceaba95f6c540b967b9409e9f0502e598cfc71327c5a455e2e807"
+    "bede1e0b7d23fbea054b951ca964eaecae7ba842ba1fc6818c453bf19eb9c5c86e723e69a210d4b7"
+    "2561cab97b3fb3060b",
+    16
+)
+
+
+class FrameTest(unittest.TestCase):
+
+    def test_parse_frame_header(self):
+        self.assertEqual(parse_frame_header(FRAME_HEADER.pack(5), 10), (5, False))
+        self.assertEqual(parse_frame_header(FRAME_HEADER.pack(FRAME_FINAL | 10), 10), (10, True))
+        with self.assertRaisesRegex(ValueError, 'exceeds negotiated maximum'):
+            parse_frame_header(FRAME_HEADER.pack(11), 10)
+
+    def test_recv_frame_round_trip(self):
+        a, b = socket.socketpair()
+        self.addCleanup(a.close)
+        self.addCleanup(b.close)
+        send_frame(a, b'hello')
+        send_frame(a, b'', final=True)
+        self.assertEqual(recv_frame(b, 16), (b'hello', False))
+        self.assertEqual(recv_frame(b, 16), (b'', True))
+
+    def test_recv_frame_into_buffer(self):
+        a, b = socket.socketpair()
+        self.addCleanup(a.close)
+        self.addCleanup(b.close)
+        buffer = frame_buffer(16)
+        send_frame(a, b'first')
+        send_frame(a, b'second', final=True)
+        payload, final = recv_frame(b, 16, buffer)
+        self.assertEqual((bytes(payload), final), (b'first', False))
+        payload, final = recv_frame(b, 16, buffer)
+        self.assertEqual((bytes(payload), final), (b'second', True))
+
+    def test_recv_frame_closed_mid_frame(self):
+        a, b = socket.socketpair()
+        self.addCleanup(b.close)
+        a.sendall(FRAME_HEADER.pack(8) + b'abc')
+        a.close()
+        with self.assertRaises(ConnectionError):
+            recv_frame(b, 16)
+
+
+class ChunkNonceTest(unittest.TestCase):
+
+    def test_layout(self):
+        self.assertEqual(chunk_nonce(0, False), bytes(12))
+        self.assertEqual(chunk_nonce(1, True), bytes(10) + b'\x01\x01')
+        self.assertEqual(len(chunk_nonce((1 << 88) - 1, False)), 12)
+
+    def test_final_flag_changes_nonce(self):
+        self.assertNotEqual(chunk_nonce(7, False), chunk_nonce(7, True))
+        self.assertEqual(len({chunk_nonce(i, False) for i in range(1000)}), 1000)
+
+
+class ManifestTest(unittest.TestCase):
+
+    def manifest(self, data, chunk_size):
+        with tempfile.TemporaryFile() as f:
+            f.write(data)
+            f.flush()
+            return Manifest.from_fd(f.fileno(), chunk_size)
+
+    def test_encode_decode(self):
+        manifest = self.manifest(b'x' * 10, 4)
+        self.assertEqual((manifest.chunk_size, manifest.size, len(manifest)), (4, 10, 3))
+        decoded = Manifest.decode(manifest.encode())
+        self.assertEqual(decoded.hashes, manifest.hashes)
+        self.assertEqual(decoded.id, manifest.id)
+
+    def test_matches(self):
+        manifest = self.manifest(b'abcdefghij', 4)
+        self.assertTrue(manifest.matches(0, b'abcd'))
+        self.assertTrue(manifest.matches(2, b'ij'))
+        self.assertFalse(manifest.matches(1, b'abcd'))
+        self.assertFalse(manifest.matches(2, b'ijk'))
+
+    def test_decode_rejects_wrong_hash_count(self):
+        data = self.manifest(b'x' * 10, 4).encode()
+        with self.assertRaisesRegex(ValueError, 'Malformed'):
+            Manifest.decode(data[:-1])
+
+    def test_bitmap_round_trip(self):
+        indices = [0, 3, 7, 8, 12]
+        bitmap = encode_bitmap(indices, 13)
+        self.assertEqual(bitmap, bytes([0b10010001, 0b10001000]))
+        self.assertEqual(decode_bitmap(bitmap, 13), indices)
+        self.assertEqual(decode_bitmap(encode_bitmap([], 0), 0), [])
+        with self.assertRaisesRegex(ValueError, 'does not match'):
+            decode_bitmap(bitmap, 17)
+
+
+class BatchTest(unittest.TestCase):
+
+    def test_round_trip(self):
+        with tempfile.TemporaryDirectory() as src, tempfile.TemporaryDirectory() as dst:
+            os.makedirs(os.path.join(src, 'tree', 'sub'))
+            files = {'tree/a.txt': b'alpha', 'tree/sub/b.bin': os.urandom(70000), 'tree/empty': b''}
+            for name, data in files.items():
+                with open(os.path.join(src, name), 'wb') as f:
+                    f.write(data)
+            os.chmod(os.path.join(src, 'tree/a.txt'), 0o600)
+            reader = BatchReader([os.path.join(src, 'tree')])
+            writer = BatchWriter(dst)
+            # Odd-sized pieces split headers and names across writes.
+            while True:
+                piece = reader.read(7)
+                if not piece:
+                    break
+                writer.write(piece)
+            writer.close()
+            self.assertEqual(writer.files, len(files))
+            for name, data in files.items():
+                with open(os.path.join(dst, name), 'rb') as f:
+                    self.assertEqual(f.read(), data)
+            self.assertEqual(stat.S_IMODE(os.stat(os.path.join(dst, 'tree/a.txt')).st_mode), 0o600)
+
+    def test_truncated_batch(self):
+        with tempfile.TemporaryDirectory() as src, tempfile.TemporaryDirectory() as dst:
+            with open(os.path.join(src, 'f'), 'wb') as f:
+                f.write(b'data')
+            stream = BatchReader([os.path.join(src, 'f')]).read()
+            writer = BatchWriter(dst)
+            writer.write(stream[:-3])
+            with self.assertRaisesRegex(ValueError, 'ended before'):
+                writer.close()
+
+    def test_unsafe_path_refused(self):
+        with tempfile.TemporaryDirectory() as dst:
+            name = b'../escape'
+            entry = transfer_core.BATCH_ENTRY.pack(len(name), stat.S_IFREG | 0o644, 0) + name
+            with self.assertRaisesRegex(ValueError, 'unsafe path'):
+                BatchWriter(dst).write(entry)
+
+
+class DHExchangeTest(unittest.TestCase):
+
+    def setUp(self):
+        self.parameters = dh.DHParameterNumbers(P, 2).parameters()
+
+    def test_matches_exchange(self):
+        for _ in range(3):
+            ours = self.parameters.generate_private_key()
+            theirs = self.parameters.generate_private_key()
+            expected = ours.exchange(theirs.public_key())
+            self.assertEqual(dh_exchange(ours, theirs.public_key().public_numbers().y), expected)
+
+    def test_pow_fallback_matches(self):
+        ours = self.parameters.generate_private_key()
+        theirs = self.parameters.generate_private_key()
+        expected = ours.exchange(theirs.public_key())
+        saved, transfer_core.LIBCRYPTO = transfer_core.LIBCRYPTO, None
+        try:
+            self.assertEqual(dh_exchange(ours, theirs.public_key().public_numbers().y), expected)
+        finally:
+            transfer_core.LIBCRYPTO = saved
+
+    def test_rejects_out_of_range_values(self):
+        ours = self.parameters.generate_private_key()
+        for y in (0, 1, P - 1, P, P + 5):
+            with self.assertRaises(ValueError):
+                dh_exchange(ours, y)
+
+
+if __name__ == '__main__':
+    unittest.main()
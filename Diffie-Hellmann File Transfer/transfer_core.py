@@ -0,0 +1,1137 @@
+#!/usr/bin/env python3
+
+"""Helpers shared by uft.py, eft.py, eft-dh.py and dh-proxy.py.
+
+Framing and AEAD: exact reads go through recv_into straight into their
+destination, readers that are done with each frame before the next reuse
+one frame_buffer() per connection, and frames leave in a single sendmsg
+call. Streams use 32-bit frame
+headers whose top bit marks the final frame, with chunk nonces counted
+from zero. SegmentCipher keeps one AES-GCM context per key for the
+original 16-bit-length segments. dh_exchange() agrees a finite-field key
+with a peer's public value without the per-call group validation that
+loading it as a key would cost, in libcrypto when it can be loaded.
+
+Batch transfers: many files are serialised into one byte stream, which
+each tool then carries exactly like a single stdin stream. Every entry is
+a header (path length, mode, size), the UTF-8 relative path, and `size`
+bytes of content. A zero-length path ends the batch.
+
+Resumable transfers: the sender describes the file as a manifest of
+fixed-size chunks with a SHA-256 per chunk, and the receiver answers with
+a bitmap of the chunks it still needs. The receiver keeps the chunks it
+has verified in a sidecar checkpoint next to the partial file, so a
+reconnect only moves what is missing. The tools carry these messages over
+their own framing through any object with send(payload) and recv().
+
+Compression: once a codec is negotiated, every chunk is compressed before
+it is encrypted and its plaintext starts with one byte naming how it was
+sent. Chunks that do not shrink go raw, so compressed media costs little.
+
+Output files: receivers write through OutputFile, which fills a temporary
+file and renames it over the destination only once the transfer has
+authenticated, with a selectable durability level.
+
+Instrumentation: STATS collects monotonic per-phase timings and byte
+counters. The framing and output code here records its own phases (send,
+recv, read, write, fsync); the scripts add key generation, exchange, KDF
+and AES-GCM. Until --stats (or EFT_PROFILE) enables it, every hook is a
+no-op.
+"""
+
+import atexit
+import ctypes
+import ctypes.util
+import hashlib
+import json
+import lzma
+import mmap
+import os
+import queue
+import stat
+import struct
+import sys
+import threading
+import time
+import zlib
+from concurrent.futures import ThreadPoolExecutor
+from pathlib import PurePosixPath
+
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+try:
+    from cryptography.hazmat.primitives.ciphers.aead import AESGCM
+except ImportError:
+    # Only SegmentCipher needs it; uft.py and eft.py run without it.
+    AESGCM = None
+
+
+def _load_libcrypto():
+    # dh_exchange() does its modular exponentiation here when it can: it
+    # is as fast as exchange() and ctypes drops the GIL for the call.
+    name = ctypes.util.find_library('crypto')
+    if not name:
+        return None
+    try:
+        lib = ctypes.CDLL(name)
+        pointer = ctypes.c_void_p
+        lib.BN_CTX_new.restype = pointer
+        lib.BN_CTX_new.argtypes = []
+        lib.BN_CTX_free.argtypes = [pointer]
+        lib.BN_new.restype = pointer
+        lib.BN_new.argtypes = []
+        lib.BN_clear_free.argtypes = [pointer]
+        lib.BN_bin2bn.restype = pointer
+        lib.BN_bin2bn.argtypes = [ctypes.c_char_p, ctypes.c_int, pointer]
+        lib.BN_bn2binpad.argtypes = [pointer, ctypes.c_char_p, ctypes.c_int]
+        lib.BN_mod_exp_mont_consttime.argtypes = [pointer] * 6
+    except (OSError, AttributeError):
+        return None
+    return lib
+
+
+LIBCRYPTO = _load_libcrypto()
+
+FRAME_HEADER = struct.Struct('>I')
+FRAME_FINAL = 0x80000000
+FRAME_LENGTH_MASK = 0x7FFFFFFF
+TAG_SIZE = 16
+SEGMENT_HEADER = struct.Struct('>H')
+SEGMENT_NONCE_SIZE = 16
+
+BATCH_ENTRY = struct.Struct('>HIQ')
+READ_SIZE = 1 << 20
+PIPELINE_POLL_INTERVAL = 0.1
+PIPELINE_JOIN_TIMEOUT = 5
+
+RESUME_CHUNK_SIZE = 1 << 22
+MANIFEST_HEADER = struct.Struct('>IQ')  # chunk size, file size
+CHUNK_INDEX = struct.Struct('>Q')
+CHUNK_HASH_SIZE = 32
+CHECKPOINT_INTERVAL = 1.0
+MAX_RESUME_ROUNDS = 3
+RESUME_RETRIES = 5
+RESUME_RETRY_DELAY = 2
+
+CODEC_RAW = 0
+CODEC_ZLIB = 1
+CODEC_LZMA = 2
+CODEC_ZSTD = 3
+CODEC_NAMES = {'zlib': CODEC_ZLIB, 'lzma': CODEC_LZMA, 'zstd': CODEC_ZSTD}
+COMPRESS_PROBE_SIZE = 4096
+COMPRESS_RATIO = 0.9
+
+DURABILITY_LEVELS = ('none', 'close', 'periodic')
+SYNC_INTERVAL = 64 << 20
+WRITE_BUFFER_SIZE = 1 << 20
+
+PROFILE_ENV = 'EFT_PROFILE'
+PROFILE_TOP = 10
+
+
+class _Phase:
+    __slots__ = ('stats', 'name', 'start')
+
+    def __init__(self, stats, name):
+        self.stats = stats
+        self.name = name
+
+    def __enter__(self):
+        self.start = time.monotonic()
+
+    def __exit__(self, exc_type, exc, tb):
+        self.stats.record(self.name, time.monotonic() - self.start)
+
+
+class _NoPhase:
+    __slots__ = ()
+
+    def __enter__(self):
+        pass
+
+    def __exit__(self, exc_type, exc, tb):
+        pass
+
+
+_NO_PHASE = _NoPhase()
+
+
+class Stats:
+    """Per-phase timings and counters, emitted as one JSON line on stderr.
+
+    phase(name) times a with-block and count(name, n) adds to a counter.
+    Phases may nest (handshake includes kdf), and phases run on pipeline
+    worker threads add up across threads, so they can exceed the wall time.
+
+    PROFILE_ENV turns on extra hooks: "cprofile" profiles the main thread
+    into <tool>-<role>-<pid>.prof, and "tracemalloc" adds the peak and the
+    largest allocation sites to the report. Either also enables the report.
+    """
+
+    def __init__(self):
+        self.enabled = False
+        self.phases = {}
+        self.counters = {}
+        self._lock = threading.Lock()
+        self._profiler = None
+        self._tracemalloc = False
+
+    def enable(self, tool, role, profile=None):
+        """Start collecting; the report is written when the process exits."""
+        profile = os.environ.get(PROFILE_ENV, '') if profile is None else profile
+        hooks = {hook.strip().lower() for hook in profile.split(',') if hook.strip()}
+        self.enabled = True
+        self.tool = tool
+        self.role = role
+        self.started = time.monotonic()
+        self.phases = {}
+        self.counters = {}
+        if 'tracemalloc' in hooks:
+            import tracemalloc
+            tracemalloc.start()
+            self._tracemalloc = True
+        if 'cprofile' in hooks:
+            import cProfile
+            self._profiler = cProfile.Profile()
+            self._profiler.enable()
+        atexit.register(self.emit)
+
+    def phase(self, name):
+        return _Phase(self, name) if self.enabled else _NO_PHASE
+
+    def record(self, name, seconds):
+        with self._lock:
+            entry = self.phases.get(name)
+            if entry is None:
+                self.phases[name] = [seconds, 1]
+            else:
+                entry[0] += seconds
+                entry[1] += 1
+
+    def count(self, name, value=1):
+        if self.enabled:
+            with self._lock:
+                self.counters[name] = self.counters.get(name, 0) + value
+
+    def snapshot(self):
+        """Phases and counters so far, without stopping any profiling hook."""
+        with self._lock:
+            return {
+                'phases': {name: {'seconds': seconds, 'calls': calls}
+                           for name, (seconds, calls) in sorted(self.phases.items())},
+                'counters': dict(sorted(self.counters.items())),
+            }
+
+    def merge(self, snapshot):
+        """Add the phases and counters of another process's snapshot()."""
+        with self._lock:
+            for name, phase in snapshot['phases'].items():
+                entry = self.phases.setdefault(name, [0.0, 0])
+                entry[0] += phase['seconds']
+                entry[1] += phase['calls']
+            for name, value in snapshot['counters'].items():
+                self.counters[name] = self.counters.get(name, 0) + value
+
+    def report(self):
+        report = {
+            'tool': self.tool,
+            'role': self.role,
+            'elapsed_s': time.monotonic() - self.started,
+            **self.snapshot(),
+        }
+        if self._tracemalloc:
+            import tracemalloc
+            current, peak = tracemalloc.get_traced_memory()
+            top = tracemalloc.take_snapshot().statistics('lineno')[:PROFILE_TOP]
+            report['tracemalloc'] = {
+                'current_kb': current >> 10,
+                'peak_kb': peak >> 10,
+                'top': [{'site': str(stat.traceback[0]), 'kb': stat.size >> 10, 'count': stat.count}
+                        for stat in top],
+            }
+        if self._profiler is not None:
+            self._profiler.disable()
+            path = f'{self.tool}-{self.role}-{os.getpid()}.prof'
+            self._profiler.dump_stats(path)
+            report['cprofile'] = os.path.abspath(path)
+        return report
+
+    def emit(self):
+        sys.stderr.write(json.dumps({'stats': self.report()}) + '\n')
+        sys.stderr.flush()
+
+
+STATS = Stats()
+
+
+def enable_stats(tool, role, requested):
+    """Turn STATS on for --stats or when PROFILE_ENV asks for a hook."""
+    if requested or os.environ.get(PROFILE_ENV):
+        STATS.enable(tool, role)
+
+
+def recv_exact_into(sock, view):
+    """Fill the writable buffer view from sock, without allocating."""
+    view = memoryview(view).cast('B')
+    length = len(view)
+    received = 0
+    with STATS.phase('recv'):
+        while received < length:
+            chunk = sock.recv_into(view[received:])
+            if not chunk:
+                raise ConnectionError("Connection closed prematurely!")
+            received += chunk
+    STATS.count('bytes_received', length)
+
+
+def recv_exact(sock, length):
+    buf = bytearray(length)
+    recv_exact_into(sock, buf)
+    return buf
+
+
+def send_parts(sock, parts):
+    """Send several buffers with as few sendmsg calls as possible, without
+    joining them first."""
+    parts = [memoryview(part) for part in parts if len(part)]
+    if STATS.enabled:
+        STATS.count('bytes_sent', sum(part.nbytes for part in parts))
+    with STATS.phase('send'):
+        while parts:
+            sent = sock.sendmsg(parts)
+            while parts and sent >= len(parts[0]):
+                sent -= len(parts.pop(0))
+            if sent:
+                parts[0] = parts[0][sent:]
+
+
+def send_frame(sock, payload, final=False):
+    # Each frame has a 32-bit header: the top bit marks the last frame of the
+    # transfer, the rest is the payload length.
+    send_parts(sock, (FRAME_HEADER.pack((FRAME_FINAL if final else 0) | len(payload)), payload))
+    STATS.count('frames_sent')
+
+
+def parse_frame_header(data, max_frame):
+    """(payload length, final flag) from a frame header, checked against max_frame."""
+    header = FRAME_HEADER.unpack(data)[0]
+    length = header & FRAME_LENGTH_MASK
+    if length > max_frame:
+        raise ValueError(f"Frame of {length} bytes exceeds negotiated maximum {max_frame}")
+    return length, bool(header & FRAME_FINAL)
+
+
+def frame_buffer(max_frame):
+    """A buffer recv_frame can read any frame of up to max_frame bytes into."""
+    return bytearray(FRAME_HEADER.size + max_frame)
+
+
+def recv_frame(sock, max_frame, buffer=None):
+    """(payload, final flag) for the next frame on sock.
+
+    Without buffer the payload is a new bytearray. With a frame_buffer()
+    the frame is read into it and the payload is a memoryview of it, valid
+    until the next call, which saves an allocation per frame for readers
+    that are done with each payload before asking for the next.
+    """
+    if buffer is None:
+        header = recv_exact(sock, FRAME_HEADER.size)
+    else:
+        header = memoryview(buffer)[:FRAME_HEADER.size]
+        recv_exact_into(sock, header)
+    length, final = parse_frame_header(header, max_frame)
+    STATS.count('frames_received')
+    if buffer is None:
+        return recv_exact(sock, length), final
+    payload = memoryview(buffer)[FRAME_HEADER.size:FRAME_HEADER.size + length]
+    recv_exact_into(sock, payload)
+    return payload, final
+
+
+async def recv_frame_async(read_exact, max_frame):
+    """recv_frame under asyncio; read_exact(n) is a coroutine returning n bytes."""
+    length, final = parse_frame_header(await read_exact(FRAME_HEADER.size), max_frame)
+    STATS.count('frames_received')
+    return await read_exact(length), final
+
+
+def chunk_nonce(counter, final):
+    # 88-bit chunk counter plus a final-chunk byte. Keys are fresh for every
+    # connection (or salt), so nonces never repeat under a key, and a
+    # receiver that is cut off before the final chunk (or sees the flag
+    # moved) fails to authenticate.
+    return counter.to_bytes(11, 'big') + (b'\x01' if final else b'\x00')
+
+
+def read_chunks(stdin, chunk_size):
+    # Read one chunk ahead so the last chunk can be flagged as final.
+    counter = 0
+    with STATS.phase('read'):
+        chunk = stdin.read(chunk_size)
+    while True:
+        with STATS.phase('read'):
+            next_chunk = stdin.read(chunk_size) if chunk else b''
+        final = not next_chunk
+        yield counter, chunk, final
+        if final:
+            return
+        chunk = next_chunk
+        counter += 1
+
+
+def recv_chunks(sock, max_frame):
+    counter = 0
+    while True:
+        payload, final = recv_frame(sock, max_frame)
+        yield counter, payload, final
+        if final:
+            return
+        counter += 1
+
+
+async def recv_chunks_async(read_exact, max_frame):
+    counter = 0
+    while True:
+        payload, final = await recv_frame_async(read_exact, max_frame)
+        yield counter, payload, final
+        if final:
+            return
+        counter += 1
+
+
+def ordered_pipeline(items, transform, workers):
+    # Read stage -> thread-pool crypto stage -> caller's send/write stage.
+    # A feeder thread pulls items and submits them to the pool, and the
+    # futures go through a bounded queue, so results come back in order and
+    # only about 3 * workers chunks are held in memory at once. Both AES-GCM
+    # backends release the GIL, so the pool uses several cores. If the
+    # consumer stops early, the feeder notices within PIPELINE_POLL_INTERVAL
+    # and is joined before the generator returns (for at most
+    # PIPELINE_JOIN_TIMEOUT, in case it is stuck reading an item).
+    if workers <= 1:
+        yield from map(transform, items)
+        return
+
+    in_flight = queue.Queue(maxsize=2 * workers)
+    stop = threading.Event()
+    pool = ThreadPoolExecutor(max_workers=workers)
+
+    def put(entry):
+        # Wait for room in the queue, but not for a consumer that has left.
+        while not stop.is_set():
+            try:
+                in_flight.put(entry, timeout=PIPELINE_POLL_INTERVAL)
+                return True
+            except queue.Full:
+                pass
+        return False
+
+    def feed():
+        try:
+            for item in items:
+                if stop.is_set():
+                    return
+                try:
+                    future = pool.submit(transform, item)
+                except RuntimeError:
+                    # The pool was shut down under us: either the consumer
+                    # has left, and nobody wants the error, or the
+                    # interpreter is exiting and it goes to the consumer.
+                    if stop.is_set():
+                        return
+                    raise
+                if not put(future):
+                    return
+        except Exception as e:
+            put(e)
+            return
+        put(None)
+
+    feeder = threading.Thread(target=feed, name='pipeline-feeder', daemon=True)
+    feeder.start()
+    try:
+        while True:
+            future = in_flight.get()
+            if future is None:
+                return
+            if isinstance(future, Exception):
+                raise future
+            yield future.result()
+    finally:
+        stop.set()
+        pool.shutdown(wait=False, cancel_futures=True)
+        feeder.join(PIPELINE_JOIN_TIMEOUT)
+
+
+def dh_exchange(private_key, peer_y: int) -> bytes:
+    """private_key.exchange() for a finite-field peer given by its public value.
+
+    Every way cryptography offers to build the peer's key (DHPublicNumbers,
+    load_der_public_key, even a cached parameters object) re-runs the
+    primality checks on the group, which costs about a hundred times the
+    exchange. The group is our own, so the check that matters is
+    1 < y < p - 1; the secret is padded to the size of p exactly as
+    exchange() pads it. Without libcrypto this falls back to pow(), which
+    is about ten times slower and holds the GIL.
+    """
+    numbers = private_key.private_numbers()
+    p = numbers.public_numbers.parameter_numbers.p
+    if not 1 < peer_y < p - 1:
+        raise ValueError("Invalid DH public key")
+    return modexp(peer_y, numbers.x, p)
+
+
+def modexp(base, exponent, modulus):
+    """base ** exponent % modulus as big-endian bytes the size of modulus."""
+    size = (modulus.bit_length() + 7) // 8
+    lib = LIBCRYPTO
+    if lib is None:
+        return pow(base, exponent, modulus).to_bytes(size, 'big')
+    ctx = lib.BN_CTX_new()
+    numbers = [lib.BN_bin2bn(value.to_bytes(size, 'big'), size, None) for value in (base, exponent, modulus)]
+    result = lib.BN_new()
+    try:
+        if not (ctx and result and all(numbers)
+                and lib.BN_mod_exp_mont_consttime(result, *numbers, ctx, None) == 1):
+            raise MemoryError("libcrypto could not compute the DH secret")
+        out = ctypes.create_string_buffer(size)
+        lib.BN_bn2binpad(result, out, size)
+        return out.raw
+    finally:
+        for number in numbers + [result]:
+            lib.BN_clear_free(number)
+        lib.BN_CTX_free(ctx)
+
+
+class SegmentCipher:
+    """AES-GCM for the original segment format: a 16-bit length, a 16-byte
+    nonce and the ciphertext.
+
+    The key schedule is set up once per key instead of once per message.
+    Sealed nonces are a random 32-bit prefix, 64 zero bits and a 32-bit
+    message counter, so each one stays distinct from the random nonces
+    the peer draws under the same key.
+    """
+
+    def __init__(self, key):
+        self.aead = AESGCM(key)
+        self.prefix = os.urandom(4) + bytes(8)
+        self.counter = 0
+
+    def seal(self, plaintext):
+        """Return the segment as a list of buffers ready for send_parts."""
+        if self.counter > 0xFFFFFFFF:
+            raise ValueError("Too many segments under one key")
+        nonce = self.prefix + self.counter.to_bytes(4, 'big')
+        self.counter += 1
+        with STATS.phase('encrypt'):
+            ciphertext = self.aead.encrypt(nonce, plaintext, None)
+        length = SEGMENT_NONCE_SIZE + len(ciphertext)
+        if length > 0xFFFF:
+            raise ValueError("Input too large for the legacy 16-bit frame")
+        return [SEGMENT_HEADER.pack(length), nonce, ciphertext]
+
+    def open(self, segment):
+        if len(segment) < SEGMENT_NONCE_SIZE:
+            raise ValueError("Segment is too short")
+        view = memoryview(segment)
+        with STATS.phase('decrypt'):
+            return self.aead.decrypt(bytes(view[:SEGMENT_NONCE_SIZE]), view[SEGMENT_NONCE_SIZE:], None)
+
+    def recv(self, sock):
+        length = SEGMENT_HEADER.unpack(recv_exact(sock, SEGMENT_HEADER.size))[0]
+        return self.open(recv_exact(sock, length))
+
+
+def read_file_list(path):
+    with open(path) as f:
+        return [line.rstrip('\n') for line in f if line.strip()]
+
+
+def iter_batch_entries(paths):
+    """Yield (archive_path, full_path, stat_result) for every directory and
+    regular file under paths. A directory argument keeps its own name as
+    the top of the tree, like tar."""
+    for path in paths:
+        path = os.path.normpath(path)
+        base = os.path.dirname(os.path.abspath(path))
+        if not os.path.isdir(path):
+            yield os.path.basename(path), path, os.stat(path)
+            continue
+        for dirpath, dirnames, filenames in os.walk(path):
+            dirnames.sort()
+            yield os.path.relpath(dirpath, base), dirpath, os.stat(dirpath)
+            for name in sorted(filenames):
+                full_path = os.path.join(dirpath, name)
+                st = os.stat(full_path)
+                if not stat.S_ISREG(st.st_mode):
+                    print(f"Skipping {full_path}: not a regular file", file=sys.stderr)
+                    continue
+                yield os.path.relpath(full_path, base), full_path, st
+
+
+def batch_pieces(paths):
+    for archive_path, full_path, st in iter_batch_entries(paths):
+        name = PurePosixPath(*archive_path.split(os.sep)).as_posix().encode('utf-8')
+        size = st.st_size if stat.S_ISREG(st.st_mode) else 0
+        yield BATCH_ENTRY.pack(len(name), st.st_mode, size) + name
+        if not size:
+            continue
+        with open(full_path, 'rb') as f:
+            remaining = size
+            while remaining:
+                chunk = f.read(min(READ_SIZE, remaining))
+                if not chunk:
+                    raise ValueError(f"{full_path} shrank while it was being sent")
+                remaining -= len(chunk)
+                yield chunk
+    yield BATCH_ENTRY.pack(0, 0, 0)
+
+
+class BatchReader:
+    """Read-only file object producing the batch stream for paths.
+
+    read(n) only returns short at the end of the stream, so it can stand in
+    for sys.stdin.buffer in every sender.
+    """
+
+    def __init__(self, paths):
+        self._pieces = batch_pieces(paths)
+        self._current = memoryview(b'')
+
+    def read(self, size=-1):
+        out = bytearray()
+        while size < 0 or len(out) < size:
+            if not self._current:
+                piece = next(self._pieces, None)
+                if piece is None:
+                    break
+                self._current = memoryview(piece)
+            take = len(self._current) if size < 0 else size - len(out)
+            out += self._current[:take]
+            self._current = self._current[take:]
+        return bytes(out)
+
+    def readinto(self, buf):
+        data = self.read(len(buf))
+        buf[:len(data)] = data
+        return len(data)
+
+
+def safe_join(root, archive_path):
+    """Map an archive path under root, refusing anything that escapes it."""
+    parts = PurePosixPath(archive_path).parts
+    if archive_path.startswith('/') or any(part in ('..', '') for part in parts):
+        raise ValueError(f"Refusing unsafe path in batch: {archive_path!r}")
+    return os.path.join(root, *parts) if parts else root
+
+
+class BatchWriter:
+    """Writable file object that unpacks a batch stream under root.
+
+    Data can arrive in pieces of any size; files are created and filled as
+    their bytes come in. close() fails if the stream stopped mid-batch.
+    """
+
+    def __init__(self, root):
+        self.root = root
+        self.files = 0
+        self.bytes = 0
+        self._header = bytearray()
+        self._entry = None
+        self._out = None
+        self._remaining = 0
+        self._done = False
+        os.makedirs(root, exist_ok=True)
+
+    def write(self, data):
+        view = memoryview(data)
+        while view:
+            if self._done:
+                raise ValueError("Data after the end of the batch")
+            if self._out is not None:
+                take = min(self._remaining, len(view))
+                self._out.write(view[:take])
+                view = view[take:]
+                self._remaining -= take
+                self.bytes += take
+                if not self._remaining:
+                    self._finish_file()
+                continue
+            view = self._read_header(view)
+        return len(data)
+
+    def _read_header(self, view):
+        need = BATCH_ENTRY.size
+        if len(self._header) >= BATCH_ENTRY.size:
+            need += BATCH_ENTRY.unpack_from(self._header)[0]
+        take = min(need - len(self._header), len(view))
+        self._header += view[:take]
+        view = view[take:]
+        if len(self._header) < BATCH_ENTRY.size:
+            return view
+        name_len, mode, size = BATCH_ENTRY.unpack_from(self._header)
+        if len(self._header) < BATCH_ENTRY.size + name_len:
+            return view
+
+        name = bytes(self._header[BATCH_ENTRY.size:]).decode('utf-8')
+        self._header.clear()
+        if not name_len:
+            self._done = True
+            return view
+        path = safe_join(self.root, name)
+        if stat.S_ISDIR(mode):
+            os.makedirs(path, exist_ok=True)
+            os.chmod(path, stat.S_IMODE(mode) | stat.S_IRWXU)
+            return view
+        if not stat.S_ISREG(mode):
+            raise ValueError(f"Unsupported entry type in batch: {name!r}")
+        os.makedirs(os.path.dirname(path) or '.', exist_ok=True)
+        self._entry = (path, mode)
+        self._out = open(path, 'wb')
+        self._remaining = size
+        if not size:
+            self._finish_file()
+        return view
+
+    def _finish_file(self):
+        path, mode = self._entry
+        self._out.close()
+        os.chmod(path, stat.S_IMODE(mode) & 0o777)
+        self._out = None
+        self._entry = None
+        self.files += 1
+
+    def flush(self):
+        if self._out is not None:
+            self._out.flush()
+
+    def close(self):
+        if self._out is not None:
+            self._out.close()
+            self._out = None
+        if not self._done:
+            raise ValueError("Batch stream ended before its last entry")
+
+
+def chunk_hash(data):
+    return hashlib.sha256(data).digest()
+
+
+class Manifest:
+    """Chunk size, file size and the SHA-256 of every chunk of a file."""
+
+    def __init__(self, chunk_size, size, hashes):
+        self.chunk_size = chunk_size
+        self.size = size
+        self.hashes = hashes
+        self.id = hashlib.sha256(self.encode()).hexdigest()
+
+    @classmethod
+    def from_fd(cls, fd, chunk_size=RESUME_CHUNK_SIZE):
+        st = os.fstat(fd)
+        if not stat.S_ISREG(st.st_mode):
+            raise ValueError("Resumable transfers need a regular file on stdin")
+        hashes = [chunk_hash(os.pread(fd, chunk_size, offset)) for offset in range(0, st.st_size, chunk_size)]
+        return cls(chunk_size, st.st_size, hashes)
+
+    @classmethod
+    def decode(cls, data):
+        chunk_size, size = MANIFEST_HEADER.unpack_from(data)
+        body = bytes(data[MANIFEST_HEADER.size:])
+        if not chunk_size or len(body) != -(-size // chunk_size) * CHUNK_HASH_SIZE:
+            raise ValueError("Malformed chunk manifest")
+        return cls(chunk_size, size, [body[i:i + CHUNK_HASH_SIZE] for i in range(0, len(body), CHUNK_HASH_SIZE)])
+
+    def encode(self):
+        return MANIFEST_HEADER.pack(self.chunk_size, self.size) + b''.join(self.hashes)
+
+    def __len__(self):
+        return len(self.hashes)
+
+    def read_chunk(self, fd, index):
+        offset = index * self.chunk_size
+        return os.pread(fd, min(self.chunk_size, self.size - offset), offset)
+
+    def matches(self, index, data):
+        offset = index * self.chunk_size
+        return len(data) == min(self.chunk_size, self.size - offset) and chunk_hash(data) == self.hashes[index]
+
+
+def encode_bitmap(indices, count):
+    bitmap = bytearray((count + 7) // 8)
+    for index in indices:
+        bitmap[index >> 3] |= 0x80 >> (index & 7)
+    return bytes(bitmap)
+
+
+def decode_bitmap(bitmap, count):
+    if len(bitmap) != (count + 7) // 8:
+        raise ValueError("Chunk bitmap does not match the manifest")
+    return [index for index in range(count) if bitmap[index >> 3] & (0x80 >> (index & 7))]
+
+
+class CheckpointedFile:
+    """Receiver side of a resumable transfer into path.
+
+    Chunks are written in place into path.part and the verified ones are
+    recorded in path.ckpt, which is rewritten at most once per
+    CHECKPOINT_INTERVAL. finish() renames the completed file into place.
+    """
+
+    def __init__(self, path, manifest):
+        self.path = path
+        self.manifest = manifest
+        self.partial = path + '.part'
+        self.checkpoint = path + '.ckpt'
+        self.fd = os.open(self.partial, os.O_RDWR | os.O_CREAT, 0o644)
+        self.done = self._load()
+        self.resumed = len(self.done)
+        os.ftruncate(self.fd, manifest.size)
+        self._saved = time.monotonic()
+
+    def _load(self):
+        try:
+            with open(self.checkpoint) as f:
+                state = json.load(f)
+            if state['manifest'] != self.manifest.id:
+                return set()
+            claimed = decode_bitmap(bytes.fromhex(state['done']), len(self.manifest))
+        except (OSError, ValueError, KeyError):
+            return set()
+        # Re-hash what the checkpoint claims, so chunks that never reached
+        # the disk or were damaged since are fetched again.
+        return {index for index in claimed
+                if self.manifest.matches(index, self.manifest.read_chunk(self.fd, index))}
+
+    def missing(self):
+        return [index for index in range(len(self.manifest)) if index not in self.done]
+
+    def write_chunk(self, index, data):
+        if index >= len(self.manifest) or not self.manifest.matches(index, data):
+            return False
+        view = memoryview(data)
+        offset = index * self.manifest.chunk_size
+        while view:
+            written = os.pwrite(self.fd, view, offset)
+            view = view[written:]
+            offset += written
+        self.done.add(index)
+        if time.monotonic() - self._saved >= CHECKPOINT_INTERVAL:
+            self.save()
+        return True
+
+    def save(self):
+        temp = self.checkpoint + '.tmp'
+        with open(temp, 'w') as f:
+            json.dump({'manifest': self.manifest.id,
+                       'done': encode_bitmap(self.done, len(self.manifest)).hex()}, f)
+        os.replace(temp, self.checkpoint)
+        self._saved = time.monotonic()
+
+    def finish(self):
+        os.fsync(self.fd)
+        os.close(self.fd)
+        self.fd = None
+        os.replace(self.partial, self.path)
+        if os.path.exists(self.checkpoint):
+            os.remove(self.checkpoint)
+
+    def close(self):
+        if self.fd is not None:
+            self.save()
+            os.close(self.fd)
+            self.fd = None
+
+
+def send_resumable(channel, fd, manifest):
+    """Send the chunks of fd the receiver asks for, round after round,
+    until it reports the file complete."""
+    channel.send(manifest.encode())
+    needed = decode_bitmap(channel.recv(), len(manifest))
+    rounds = 0
+    while needed:
+        if rounds == MAX_RESUME_ROUNDS:
+            raise ValueError(f"{len(needed)} chunks still fail verification; did the input change?")
+        for index in needed:
+            channel.send(CHUNK_INDEX.pack(index) + manifest.read_chunk(fd, index))
+        channel.send(b'')
+        needed = decode_bitmap(channel.recv(), len(manifest))
+        rounds += 1
+
+
+def receive_resumable(channel, path):
+    """Receive a resumable transfer into path and return its
+    CheckpointedFile. An interrupted transfer leaves the partial file and
+    its checkpoint behind for the next attempt."""
+    target = CheckpointedFile(path, Manifest.decode(channel.recv()))
+    try:
+        needed = target.missing()
+        while True:
+            if not needed:
+                target.finish()
+            channel.send(encode_bitmap(needed, len(target.manifest)))
+            if not needed:
+                return target
+            # A round ends with an empty message; chunks that failed their
+            # hash are simply asked for again.
+            while True:
+                message = channel.recv()
+                if not message:
+                    break
+                index = CHUNK_INDEX.unpack_from(message)[0]
+                target.write_chunk(index, memoryview(message)[CHUNK_INDEX.size:])
+            needed = target.missing()
+    finally:
+        target.close()
+
+
+def available_codecs():
+    return [CODEC_ZLIB, CODEC_LZMA] + ([CODEC_ZSTD] if zstandard else [])
+
+
+def choose_codec(offered):
+    """Pick the first codec in the peer's preference order that we have."""
+    supported = available_codecs()
+    return next((codec for codec in offered if codec in supported), None)
+
+
+def _compress(codec, data):
+    if codec == CODEC_ZLIB:
+        return zlib.compress(data)
+    if codec == CODEC_LZMA:
+        return lzma.compress(data)
+    return zstandard.ZstdCompressor().compress(data)
+
+
+def compress_chunk(codec, data):
+    """Return the chunk's plaintext: a codec byte, then the compressed data
+    if it saves at least a tenth, otherwise the raw data. A cheap probe of
+    the first few KB skips the full attempt for incompressible input."""
+    with STATS.phase('compress'):
+        return _compress_chunk(codec, data)
+
+
+def _compress_chunk(codec, data):
+    if len(data) > COMPRESS_PROBE_SIZE:
+        probe = zlib.compress(data[:COMPRESS_PROBE_SIZE], 1)
+        if len(probe) > COMPRESS_PROBE_SIZE * COMPRESS_RATIO:
+            return bytes([CODEC_RAW]) + data
+    packed = _compress(codec, data)
+    if len(packed) < len(data) * COMPRESS_RATIO:
+        return bytes([codec]) + packed
+    return bytes([CODEC_RAW]) + data
+
+
+def decompress_chunk(data, limit):
+    """Undo compress_chunk, refusing chunks that expand beyond limit."""
+    with STATS.phase('decompress'):
+        return _decompress_chunk(data, limit)
+
+
+def _decompress_chunk(data, limit):
+    codec, body = data[0], memoryview(data)[1:]
+    if codec == CODEC_RAW:
+        return body
+    if codec == CODEC_ZLIB:
+        decompressor = zlib.decompressobj()
+        plaintext = decompressor.decompress(body, limit)
+        complete = decompressor.eof and not decompressor.unconsumed_tail
+    elif codec == CODEC_LZMA:
+        decompressor = lzma.LZMADecompressor()
+        plaintext = decompressor.decompress(body, limit)
+        complete = decompressor.eof
+    elif codec == CODEC_ZSTD and zstandard:
+        plaintext = zstandard.ZstdDecompressor().stream_reader(body).read(limit + 1)
+        complete = len(plaintext) <= limit
+    else:
+        raise ValueError(f"Unsupported compression codec {codec}")
+    if not complete:
+        raise ValueError(f"Compressed chunk is corrupt or expands beyond {limit} bytes")
+    return plaintext
+
+
+class OutputFile:
+    """Write engine for received files.
+
+    Data goes to temp_path (default path + '.tmp'), opened with O_TRUNC,
+    and commit() renames it over path, so readers never see a partial
+    file. Small writes are coalesced into WRITE_BUFFER_SIZE syscalls.
+    durability is 'none' (no syncs), 'close' (fsync the file and its
+    directory on commit) or 'periodic' (also fdatasync every sync_bytes).
+    When the final size is known it is reserved up front with
+    posix_fallocate, and use_mmap copies chunks into a shared mapping
+    instead of calling write. The size usually comes from the peer, so it
+    is only a hint: above max_prealloc bytes, or above the free space on
+    the filesystem, nothing is reserved and the file grows as written.
+    write_at() places chunks that arrive out of order, from several
+    threads at once, under the same durability, mapping and reservation.
+    """
+
+    def __init__(self, path, durability='close', sync_bytes=SYNC_INTERVAL, size=None, use_mmap=False,
+                 temp_path=None, max_prealloc=None):
+        self.path = path
+        self.temp_path = temp_path or path + '.tmp'
+        self.durability = durability
+        self.sync_bytes = sync_bytes
+        self.position = 0
+        self._buffer = bytearray()
+        self._unsynced = 0
+        self._map = None
+        self._lock = threading.Lock()
+        self.fd = os.open(self.temp_path, os.O_RDWR | os.O_CREAT | os.O_TRUNC, 0o644)
+        self.preallocated = False
+        if size and not self._can_reserve(size, max_prealloc):
+            size = None
+        if size:
+            try:
+                os.posix_fallocate(self.fd, 0, size)
+                self.preallocated = True
+            except (AttributeError, OSError):
+                # Not every platform or filesystem can preallocate.
+                pass
+            if use_mmap:
+                os.ftruncate(self.fd, size)
+                self.preallocated = True
+                self._map = mmap.mmap(self.fd, size)
+
+    def _can_reserve(self, size, limit):
+        if limit is not None and size > limit:
+            return False
+        try:
+            st = os.fstatvfs(self.fd)
+        except (AttributeError, OSError):
+            return True
+        return size <= st.f_bavail * st.f_frsize
+
+    def fileno(self):
+        return self.fd
+
+    def write(self, data):
+        with STATS.phase('write'):
+            return self._write(data)
+
+    def _write(self, data):
+        length = len(data)
+        if self._map is not None:
+            if self.position + length <= len(self._map):
+                self._map[self.position:self.position + length] = data
+                self.position += length
+                self._written(length)
+                return length
+            # More data than announced: carry on with ordinary writes.
+            self._unmap()
+        if self._buffer or length < WRITE_BUFFER_SIZE:
+            self._buffer += data
+            if len(self._buffer) >= WRITE_BUFFER_SIZE:
+                self.flush()
+        else:
+            self._write_all(data)
+        return length
+
+    def write_at(self, offset, data):
+        """Write data at offset; position becomes the end of the furthest write."""
+        with STATS.phase('write'):
+            return self._write_at(offset, data)
+
+    def _write_at(self, offset, data):
+        length = len(data)
+        with self._lock:
+            self.flush()
+            if self._map is not None:
+                if offset + length <= len(self._map):
+                    self._map[offset:offset + length] = data
+                    self._placed(offset + length, length)
+                    return length
+                # Past the announced size: carry on with ordinary writes.
+                self._unmap()
+        # Outside the lock, so writes from several threads overlap.
+        view = memoryview(data)
+        while view:
+            written = os.pwrite(self.fd, view, offset)
+            view = view[written:]
+            offset += written
+        with self._lock:
+            self._placed(offset, length)
+        return length
+
+    def _placed(self, end, length):
+        self.position = max(self.position, end)
+        self._written(length)
+
+    def _write_all(self, data):
+        view = memoryview(data)
+        while view:
+            written = os.pwrite(self.fd, view, self.position)
+            view = view[written:]
+            self.position += written
+            self._written(written)
+
+    def _written(self, length):
+        self._unsynced += length
+        if self.durability == 'periodic' and self._unsynced >= self.sync_bytes:
+            with STATS.phase('fsync'):
+                if self._map is not None:
+                    self._map.flush()
+                else:
+                    os.fdatasync(self.fd)
+            self._unsynced = 0
+
+    def _unmap(self):
+        if self.durability != 'none':
+            self._map.flush()
+        self._map.close()
+        self._map = None
+
+    def flush(self):
+        if self._buffer:
+            buffered, self._buffer = self._buffer, bytearray()
+            self._write_all(buffered)
+
+    def commit(self):
+        """Finish the file and atomically move it into place."""
+        with STATS.phase('commit'):
+            self._commit()
+
+    def _commit(self):
+        self.flush()
+        if self._map is not None:
+            self._unmap()
+        if self.preallocated:
+            os.ftruncate(self.fd, self.position)
+        if self.durability != 'none':
+            with STATS.phase('fsync'):
+                os.fsync(self.fd)
+        os.close(self.fd)
+        self.fd = None
+        os.replace(self.temp_path, self.path)
+        if self.durability != 'none':
+            directory = os.open(os.path.dirname(os.path.abspath(self.path)), os.O_RDONLY)
+            try:
+                with STATS.phase('fsync'):
+                    os.fsync(directory)
+            finally:
+                os.close(directory)
+
+    def abort(self):
+        """Drop the temporary file, leaving any existing path untouched."""
+        if self.fd is None:
+            return
+        if self._map is not None:
+            self._map.close()
+            self._map = None
+        os.close(self.fd)
+        self.fd = None
+        os.remove(self.temp_path)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        if exc_type is None:
+            self.commit()
+        else:
+            self.abort()
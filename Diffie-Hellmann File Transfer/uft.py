@@ -1,85 +1,300 @@
 #!/usr/bin/env python3
 
+import argparse
+import os
 import sys
+import stat
+import select
 import socket
+import time
 
-BUFFER_SIZE = 4096
+from transfer_core import (BatchReader, BatchWriter, Manifest, RESUME_RETRIES, RESUME_RETRY_DELAY, STATS,
+                           enable_stats, read_file_list, receive_resumable, recv_exact, send_parts,
+                           send_resumable)
 
-def print_usage_and_exit():
-    print("Usage:")
-    print(" Server: uft -l PORT > output_file")
-    print(" Client: uft SERVER_IP PORT < input_file")
-    sys.exit(1)
+BUFFER_SIZE = 0xFFFF
+HEADER_SIZE = 2
+EXTENDED_HEADER_SIZE = HEADER_SIZE + 8
+MAX_FRAME_SIZE = HEADER_SIZE + 0xFFFF
+RECV_BUFFER_SIZE = 1 << 20
+PIPE_SIZE = 1 << 20
+IOV_MAX = os.sysconf('SC_IOV_MAX') if hasattr(os, 'sysconf') else 1024
 
-def run_server(port):
+def parse_args():
+    parser = argparse.ArgumentParser(description="Unencrypted File Transfer (UFT)")
+    parser.add_argument('-l', dest='listen_port', type=int, help='Server listen port')
+    parser.add_argument('-b', '--buffer-size', type=int, default=BUFFER_SIZE,
+                        help='Client read size per frame; above 65535 needs a current server')
+    parser.add_argument('--zero-copy', action='store_true',
+                        help='Client: sendfile/splice stdin straight into the socket when it is a file or pipe')
+    parser.add_argument('--batch', action='append', default=[], metavar='PATH',
+                        help='Client: send this file or directory tree instead of stdin (repeatable)')
+    parser.add_argument('--batch-list', metavar='FILE',
+                        help='Client: send the files and directories listed in FILE, one per line')
+    parser.add_argument('-o', '--output-dir', metavar='DIR',
+                        help='Server: expect a batch and recreate its tree under DIR')
+    parser.add_argument('--resumable', action='store_true',
+                        help='Client: send stdin (a regular file) so an interrupted transfer can pick up where it left off')
+    parser.add_argument('--resume-file', metavar='FILE',
+                        help='Server: expect a --resumable client and write its file to FILE')
+    parser.add_argument('--stats', action='store_true',
+                        help='Print per-phase timings and byte counters as a JSON line on stderr at exit')
+    parser.add_argument('host', nargs='?', help='Server IP address (client mode only)')
+    parser.add_argument('port', nargs='?', type=int, help='Server port (client mode only)')
+
+    args = parser.parse_args()
+
+    if args.listen_port:
+        mode = 'server'
+    elif args.host and args.port:
+        mode = 'client'
+    else:
+        parser.error("You must specify either '-l PORT' (server) or 'HOST PORT' (client)")
+    if args.buffer_size <= 0:
+        parser.error("--buffer-size must be positive")
+    if args.batch_list:
+        args.batch += read_file_list(args.batch_list)
+    return mode, args
+
+def frame_header(length):
+    # Frames up to 64 KB keep the original 2-byte header. Larger frames send a
+    # zero length (never used for a real frame) followed by a 64-bit length.
+    if 0 < length <= 0xFFFF:
+        return length.to_bytes(HEADER_SIZE, 'big')
+    return bytes(HEADER_SIZE) + length.to_bytes(EXTENDED_HEADER_SIZE - HEADER_SIZE, 'big')
+
+def write_all(fd, chunks):
+    # Gather-write the frame payloads with as few writev calls as possible.
+    i = 0
+    with STATS.phase('write'):
+        while i < len(chunks):
+            written = os.writev(fd, chunks[i:i + IOV_MAX])
+            while i < len(chunks) and written >= len(chunks[i]):
+                written -= len(chunks[i])
+                i += 1
+            if written:
+                chunks[i] = chunks[i][written:]
+
+class FrameChannel:
+    # Whole messages for the resumable protocol, one frame each.
+    def __init__(self, sock):
+        self.sock = sock
+
+    def send(self, payload):
+        send_parts(self.sock, (frame_header(len(payload)), payload))
+
+    def recv(self):
+        length = int.from_bytes(recv_exact(self.sock, HEADER_SIZE), 'big')
+        if not length:
+            length = int.from_bytes(recv_exact(self.sock, EXTENDED_HEADER_SIZE - HEADER_SIZE), 'big')
+        return recv_exact(self.sock, length)
+
+def receive_frames(conn, write):
+    buf = bytearray(RECV_BUFFER_SIZE)
+    view = memoryview(buf)
+    start = end = 0
+    body_left = 0
+    pending = []
+
+    while True:
+        if len(buf) - end < MAX_FRAME_SIZE:
+            # Not enough room for another full frame: flush what we have and
+            # move the partial frame (if any) to the front of the buffer.
+            write(pending)
+            pending = []
+            remaining = bytes(view[start:end])
+            view[:len(remaining)] = remaining
+            start, end = 0, len(remaining)
+
+        try:
+            with STATS.phase('recv'):
+                received = conn.recv_into(view[end:], 0, socket.MSG_DONTWAIT)
+        except BlockingIOError:
+            # Socket is drained, so write out the batch before blocking.
+            write(pending)
+            pending = []
+            with STATS.phase('recv'):
+                received = conn.recv_into(view[end:])
+
+        if not received:
+            write(pending)
+            if start != end or body_left:
+                print("Client closed connection unexpectedly!", file=sys.stderr)
+            else:
+                print("Client closed connection. Ending server.", file=sys.stderr)
+            return
+        end += received
+        STATS.count('bytes_received', received)
+
+        while start < end:
+            if body_left:
+                # Inside an extended frame: its payload streams through the
+                # buffer as it arrives.
+                take = min(body_left, end - start)
+                pending.append(view[start:start + take])
+                start += take
+                body_left -= take
+                continue
+            if end - start < HEADER_SIZE:
+                break
+            length = int.from_bytes(view[start:start + HEADER_SIZE], 'big')
+            if not length:
+                if end - start < EXTENDED_HEADER_SIZE:
+                    break
+                body_left = int.from_bytes(view[start + HEADER_SIZE:start + EXTENDED_HEADER_SIZE], 'big')
+                start += EXTENDED_HEADER_SIZE
+                continue
+            if end - start - HEADER_SIZE < length:
+                break
+            if length:
+                pending.append(view[start + HEADER_SIZE:start + HEADER_SIZE + length])
+                STATS.count('frames_received')
+            start += HEADER_SIZE + length
+
+def write_batch(writer, chunks):
+    with STATS.phase('write'):
+        for chunk in chunks:
+            writer.write(chunk)
+
+def serve_resumable(server_socket, path):
+    # Keep accepting until one connection completes the file; each attempt
+    # picks up from the checkpoint the previous one left.
+    while True:
+        conn, addr = server_socket.accept()
+        print(f"Connection accepted from {addr}", file=sys.stderr)
+        with conn:
+            try:
+                target = receive_resumable(FrameChannel(conn), path)
+            except OSError as e:
+                print(f"Transfer interrupted ({e}), waiting for the client to resume...", file=sys.stderr)
+                continue
+        print(f"Received {target.manifest.size} bytes into {path} "
+              f"({target.resumed} of {len(target.manifest)} chunks already present)", file=sys.stderr)
+        return
+
+def run_server(port, output_dir=None, resume_file=None):
     with socket.socket(socket.AF_INET, socket.SOCK_STREAM) as server_socket:
         server_socket.bind(('0.0.0.0', port))
         server_socket.listen(1)
         print(f"Server listening on port {port}...", file=sys.stderr)
-        conn, addr = server_socket.accept()
+        if resume_file:
+            serve_resumable(server_socket, resume_file)
+            return
+        with STATS.phase('accept'):
+            conn, addr = server_socket.accept()
         print(f"Connection accepted from {addr}", file=sys.stderr)
         with conn:
-            while True:
-                length_bytes = b''
-                while len(length_bytes) < 2:
-                    chunk = conn.recv(2 - len(length_bytes))
-                    if not chunk:
-                        print("Client closed connection. Ending server.", file=sys.stderr)
-                        return
-                    length_bytes += chunk
-                
-                length = int.from_bytes(length_bytes, 'big')
-
-                data = b''
-                while len(data) < length:
-                    chunk = conn.recv(length - len(data))
-                    if not chunk:
-                        print("Client closed connection unexpectedly!", file=sys.stderr)
-                        return
-                    data += chunk
-
-                sys.stdout.buffer.write(data)
-                sys.stdout.buffer.flush()
-
-def run_client(host, port):
+            if output_dir is None:
+                out_fd = sys.stdout.buffer.fileno()
+                receive_frames(conn, lambda chunks: write_all(out_fd, chunks))
+                return
+            writer = BatchWriter(output_dir)
+            try:
+                receive_frames(conn, lambda chunks: write_batch(writer, chunks))
+                writer.close()
+            except ValueError as e:
+                print(f"Batch failed: {e}", file=sys.stderr)
+                sys.exit(1)
+            print(f"Received {writer.files} files ({writer.bytes} bytes) into {output_dir}", file=sys.stderr)
+
+def send_buffered(sock, stdin, buffer_size):
+    buf = bytearray(buffer_size)
+    view = memoryview(buf)
+    while True:
+        with STATS.phase('read'):
+            length = stdin.readinto(view)
+        if not length:
+            break
+        send_parts(sock, (frame_header(length), view[:length]))
+        STATS.count('frames_sent')
+
+def send_file(sock, fd):
+    offset = os.lseek(fd, 0, os.SEEK_CUR)
+    size = os.fstat(fd).st_size - offset
+    if size <= 0:
+        return
+    sock.sendall(frame_header(size))
+    end = offset + size
+    with STATS.phase('send'):
+        while offset < end:
+            sent = os.sendfile(sock.fileno(), fd, offset, end - offset)
+            if not sent:
+                raise ConnectionError("Input file shrank during transfer")
+            offset += sent
+    STATS.count('bytes_sent', size)
+
+def send_pipe(sock, fd):
+    import fcntl
+    import termios
+
+    try:
+        fcntl.fcntl(fd, fcntl.F_SETPIPE_SZ, PIPE_SIZE)
+    except (AttributeError, OSError):
+        pass
+
+    count = bytearray(4)
+    while True:
+        select.select([fd], [], [])
+        fcntl.ioctl(fd, termios.FIONREAD, count)
+        available = int.from_bytes(count, sys.byteorder)
+        if not available:
+            return
+        # We are the only reader, so everything FIONREAD reported can be
+        # spliced into the frame we just announced.
+        sock.sendall(frame_header(available))
+        STATS.count('bytes_sent', available)
+        with STATS.phase('send'):
+            while available:
+                available -= os.splice(fd, sock.fileno(), available)
+
+def run_resumable_client(host, port):
+    fd = sys.stdin.buffer.fileno()
+    manifest = Manifest.from_fd(fd)
+    for attempt in range(RESUME_RETRIES + 1):
+        try:
+            with socket.create_connection((host, port)) as client_socket:
+                print(f"Connected to server {host}:{port}")
+                send_resumable(FrameChannel(client_socket), fd, manifest)
+                print("Finished sending file. Client exiting.")
+                return
+        except OSError as e:
+            if attempt == RESUME_RETRIES:
+                raise
+            print(f"Transfer interrupted ({e}), retrying in {RESUME_RETRY_DELAY}s...", file=sys.stderr)
+            time.sleep(RESUME_RETRY_DELAY)
+
+def run_client(host, port, buffer_size=BUFFER_SIZE, zero_copy=False, batch=None):
     with socket.socket(socket.AF_INET, socket.SOCK_STREAM) as client_socket:
-        client_socket.connect((host, port))
+        with STATS.phase('connect'):
+            client_socket.connect((host, port))
         print(f"Connected to server {host}:{port}")
-        while True:
-            data = sys.stdin.buffer.read(BUFFER_SIZE)
-            if not data:
-                break
-            length = len(data)
-            length_bytes = length.to_bytes(2, 'big')
-
-            client_socket.sendall(length_bytes)
-            client_socket.sendall(data)
+        if batch:
+            send_buffered(client_socket, BatchReader(batch), buffer_size)
+            client_socket.shutdown(socket.SHUT_WR)
+            print("Finished sending batch. Client exiting.")
+            return
+        stdin = sys.stdin.buffer
+        input_mode = os.fstat(stdin.fileno()).st_mode
+        if zero_copy and stat.S_ISREG(input_mode):
+            send_file(client_socket, stdin.fileno())
+        elif zero_copy and stat.S_ISFIFO(input_mode) and hasattr(os, 'splice'):
+            send_pipe(client_socket, stdin.fileno())
+        else:
+            send_buffered(client_socket, stdin, buffer_size)
         client_socket.shutdown(socket.SHUT_WR)
         print("Finished sending file. Client exiting.")
 
 
 def main():
-    if len(sys.argv) == 3 and sys.argv[1] == '-l':
-       # Server mode
-       try:
-           port = int(sys.argv[2])
-       except ValueError:
-           print_usage_and_exit()
-       run_server(port)
-
-    elif len(sys.argv) == 3:
-        #Client mode
-        host = sys.argv[1]
-        try:
-            port = int(sys.argv[2])
-        except ValueError:
-            print_usage_and_exit()
-        run_client(host, port)
-
+    mode, args = parse_args()
+    enable_stats('uft', mode, args.stats)
+    if mode == 'server':
+        run_server(args.listen_port, args.output_dir, args.resume_file)
+    elif args.resumable:
+        run_resumable_client(args.host, args.port)
     else:
-         print_usage_and_exit()
-    
+        run_client(args.host, args.port, args.buffer_size, args.zero_copy, args.batch)
+
 
 if __name__ == "__main__":
     main()
-